@@ -78,8 +78,16 @@ from .conditional import currently_under_condition
 # block simulation support
 from .simulation import Simulation
 from .simulation import FastSimulation
+from .simulation import LaneParallelSimulation
 from .simulation import SimulationTrace
+from .simulation import VcdWriter
+from .simulation import compare_traces
+from .simulation import TraceDiff
+from .simulation import SimulationProfile
+from .simulation import ToggleActivity
 from .compilesim import CompiledSimulation
+from .batchsim import BatchSimulation
+from .tieredsim import TieredSimulation
 
 # input and output to file format routines
 from .inputoutput import input_from_blif
@@ -90,6 +98,7 @@ from .inputoutput import output_to_firrtl
 from .inputoutput import block_to_graphviz_string
 from .inputoutput import block_to_svg
 from .inputoutput import trace_to_html
+from .inputoutput import trace_from_vcd
 
 # extraction to verilog and verilog testbench
 from .verilog import output_to_verilog
@@ -1,3 +1,4 @@
 from .estimate import area_estimation
+from .estimate import switching_power_estimation
 from .estimate import TimingAnalysis
 from .estimate import yosys_area_delay
@@ -14,7 +14,7 @@ import subprocess
 import sys
 
 from ..core import working_block
-from ..wire import Input, Const, Register
+from ..wire import Input, Output, Const, Register
 from ..pyrtlexceptions import PyrtlError, PyrtlInternalError
 from ..verilog import output_to_verilog
 from ..memory import RomBlock
@@ -134,6 +134,57 @@ def _bits_ports_and_isrom_from_memory(mem):
     return bits, ports, is_rom
 
 
+def switching_power_estimation(activity, frequency_in_mhz=100, tech_in_nm=130, voltage=None):
+    """ Estimates the dynamic power of a block from the toggles counted in simulation.
+
+    :param activity: the ToggleActivity of a FastSimulation or CompiledSimulation
+        run with activity counting turned on (for example, sim.activity)
+    :param frequency_in_mhz: the clock frequency of the design
+    :param tech_in_nm: the size of the circuit technology to be estimated
+        (for example, 65 is 65nm and 250 is 0.25um)
+    :param voltage: the supply voltage, defaulting to the usual one of that technology
+    :return: tuple of estimated power (switching, clock) in terms of mW
+
+    Each toggle of a bit charges or discharges the inputs that the bit drives, and so
+    costs 1/2 C V^2, where C grows with the number of nets reading the wire.  Only the
+    wires whose toggles were counted are included, so count every wire (activity=True)
+    for an estimate of the whole block.  The clock power is that of the clock input of
+    every register bit, which switches on each cycle.  Memories are not included.
+    As with area_estimation, the model is based off of 130nm stdcell designs and is
+    not validated; use it to compare designs and workloads rather than for sign-off.
+    """
+
+    # Roughly 3 fF of gate and wire load for each net reading a bit, and 2 fF
+    # of clock load for each register bit, in 130nm.  Loads shrink with the
+    # feature size.
+    load_per_reader_in_ff = 3.0
+    clock_load_in_ff = 2.0
+    # nominal supply voltages of common technologies
+    voltages = {250: 2.5, 180: 1.8, 130: 1.2, 90: 1.0, 65: 1.0, 45: 0.9, 32: 0.9, 22: 0.8}
+
+    if voltage is None:
+        voltage = voltages[min(voltages, key=lambda tech: abs(tech - tech_in_nm))]
+    block = working_block(activity.block)
+    _, dest_dict = block.net_connections()
+    scale = tech_in_nm / 130.0
+    energy_per_ff = 0.5 * 1e-15 * voltage**2  # of each toggle, in joules
+
+    switching_energy = 0  # per cycle
+    if activity.cycles:
+        for wire in activity.wires:
+            # wiring (w, s, c) is no load itself: the wires it drives carry the load
+            readers = sum(1 for net in dest_dict.get(wire, ()) if net.op not in 'wsc')
+            if isinstance(wire, Output):
+                readers += 1
+            load = readers * load_per_reader_in_ff * scale
+            switching_energy += load * energy_per_ff * activity.toggles(wire) / activity.cycles
+    clock_bits = sum(len(r) for r in block.wirevector_subset(Register))
+    clock_energy = clock_bits * clock_load_in_ff * scale * 2 * energy_per_ff
+
+    frequency = frequency_in_mhz * 1e6
+    return switching_energy * frequency * 1e3, clock_energy * frequency * 1e3
+
+
 # --------------------------------------------------------------------
 #   ___                 __        /\                     __      __
 #    |  |  |\/| | |\ | /  `      /~~\ |\ |  /\  |  \_/  /__` |  /__`
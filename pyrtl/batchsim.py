@@ -0,0 +1,233 @@
+"""Vectorized evaluation of combinational blocks over many input vectors at once."""
+
+from __future__ import print_function, unicode_literals
+
+from .core import working_block
+from .wire import Input, Output, Const
+from .memory import RomBlock
+from .pyrtlexceptions import PyrtlError, PyrtlInternalError
+
+
+__all__ = ['BatchSimulation']
+
+
+class BatchSimulation(object):
+    """Evaluate a purely combinational block on whole arrays of input vectors.
+
+    Rather than stepping a simulation once per input vector, the block is walked
+    a single time in topological order and each op is applied to NumPy arrays
+    holding the value of a wire for every vector.  Wires of up to 64 bits are
+    held in uint64 arrays, while wider wires use arrays of Python ints (dtype
+    object), so the results are exact for any bitwidth.
+
+    This requires NumPy.  The block may not contain registers or writable
+    memories, though reads of RomBlocks are supported.
+
+    Example ::
+
+        sim = pyrtl.BatchSimulation()
+        outs = sim.evaluate({'a': numpy.arange(1000), 'b': numpy.arange(1000)})
+        outs['sum']  # an array with the value of Output 'sum' for each vector
+
+        ins, outs = sim.exhaustive()  # every combination of the input values
+    """
+
+    def __init__(self, block=None):
+        """ Prepare the evaluation of a block.
+
+        :param block: the combinational block to evaluate (defaults to the working block)
+        """
+        import numpy  # pylint: disable=import-error
+        self._np = numpy
+
+        self.block = working_block(block)
+        self.block.sanity_check()
+        for net in self.block.logic:
+            if net.op in 'r@' or (net.op == 'm' and not isinstance(net.op_param[1], RomBlock)):
+                raise PyrtlError(
+                    'BatchSimulation can only evaluate purely combinational blocks '
+                    '(found the state holding primitive "%s")' % net.op)
+
+        self.ordered_nets = tuple(self.block)
+        self.inputs = sorted(self.block.wirevector_subset(Input), key=lambda w: w.name)
+        self.outputs = sorted(self.block.wirevector_subset(Output), key=lambda w: w.name)
+
+        # index of the last net reading each wire, so that intermediate arrays can
+        # be released as soon as they are no longer needed
+        self._last_use = {}
+        for i, net in enumerate(self.ordered_nets):
+            for arg in net.args:
+                self._last_use[arg] = i
+
+    def _dtype(self, bitwidth):
+        return self._np.uint64 if bitwidth <= 64 else object
+
+    def _cast(self, arr, dtype):
+        if arr.dtype == dtype:
+            return arr
+        return arr.astype(dtype)
+
+    def _to_array(self, wire, values):
+        """ Convert the values provided for an input into an array, checking their range. """
+        np = self._np
+        arr = np.asarray(values)
+        if wire.bitwidth <= 64 and arr.dtype.kind in 'ui':
+            if arr.dtype.kind == 'i' and (arr < 0).any():
+                raise PyrtlError('Wire {} has a negative value'.format(wire))
+            arr = arr.astype(np.uint64)
+            if wire.bitwidth < 64 and (arr > np.uint64(wire.bitmask)).any():
+                raise PyrtlError('Wire {} has a value which cannot be represented '
+                                 'using its bitwidth'.format(wire))
+            return arr
+        # anything else (such as lists of large Python ints) goes through exact ints
+        arr = np.array([int(v) for v in values], dtype=object)
+        if any(v < 0 or v > wire.bitmask for v in arr):
+            raise PyrtlError('Wire {} has a value which cannot be represented '
+                             'using its bitwidth'.format(wire))
+        return arr.astype(self._dtype(wire.bitwidth))
+
+    def evaluate(self, provided_inputs, wires=None):
+        """ Evaluate the block for every vector of input values.
+
+        :param provided_inputs: a dictionary mapping each Input (or its name) to an
+          array or sequence of its values, all of the same length
+        :param wires: names of the wires whose values should be returned
+          (defaults to all of the Outputs)
+        :return: a dictionary mapping wire names to arrays of their values
+        """
+        values = {}
+        length = None
+        for wire, vals in provided_inputs.items():
+            name = getattr(wire, 'name', wire)
+            wire = self.block.get_wirevector_by_name(name)
+            if not isinstance(wire, Input):
+                raise PyrtlError('"%s" is not an Input of the block' % name)
+            arr = self._to_array(wire, vals)
+            if length is None:
+                length = len(arr)
+            elif len(arr) != length:
+                raise PyrtlError('all inputs must be given the same number of values')
+            values[wire] = arr
+        for wire in self.inputs:
+            if wire not in values:
+                raise PyrtlError('Input "%s" has no input value specified' % wire.name)
+        if length is None:
+            raise PyrtlError('need input values for a block without inputs')
+        return self._evaluate(values, length, wires)
+
+    def _evaluate(self, values, length, wires):
+        """ Evaluate the block on length vectors, given the arrays of each Input. """
+        np = self._np
+        if wires is None:
+            keep = set(self.outputs)
+        else:
+            keep = {self.block.get_wirevector_by_name(getattr(w, 'name', w), strict=True)
+                    for w in wires}
+
+        for const in self.block.wirevector_subset(Const):
+            values[const] = np.full(length, const.val, dtype=self._dtype(const.bitwidth))
+
+        for i, net in enumerate(self.ordered_nets):
+            values[net.dests[0]] = self._execute(net, values)
+            for arg in set(net.args):
+                if self._last_use[arg] == i and arg not in keep:
+                    del values[arg]
+
+        return {w.name: values[w] for w in keep}
+
+    def exhaustive(self, max_input_bits=24):
+        """ Evaluate the block on every possible combination of input values.
+
+        :param max_input_bits: refuse blocks with more input bits than this,
+          as the number of vectors is 2 to the power of the total input bits
+        :return: a pair of dictionaries (inputs, outputs) mapping names to arrays,
+          where element n of every array belongs to the same input vector.  A block
+          without Inputs is evaluated once, so its outputs are arrays of one value.
+        """
+        np = self._np
+        total = sum(w.bitwidth for w in self.inputs)
+        if total > max_input_bits:
+            raise PyrtlError('block has %d input bits, more than the max_input_bits of %d'
+                             % (total, max_input_bits))
+        if not self.inputs:
+            return {}, self._evaluate({}, 1, None)
+        counter = np.arange(1 << total, dtype=np.uint64)
+        inputs = {}
+        shift = 0
+        for wire in self.inputs:
+            inputs[wire.name] = (counter >> np.uint64(shift)) & np.uint64(wire.bitmask)
+            shift += wire.bitwidth
+        return inputs, self.evaluate(inputs)
+
+    def _execute(self, net, values):
+        """Handle the combinational logic rules for the given net on whole arrays.
+
+        Each op is computed in uint64 when the destination and all of the arguments
+        fit in 64 bits (relying on the final mask to correct any wraparound), and
+        with Python ints otherwise.
+        """
+        np = self._np
+        dest = net.dests[0]
+        widest = max([dest.bitwidth] + [a.bitwidth for a in net.args])
+        work = self._dtype(widest)
+        args = [self._cast(values[a], work) for a in net.args]
+
+        def const(v):
+            return np.uint64(v) if work is np.uint64 else v
+
+        mask = const(dest.bitmask)
+        op = net.op
+        if op == 'w':
+            result = args[0]
+        elif op == '~':
+            result = ~args[0]
+        elif op == '&':
+            result = args[0] & args[1]
+        elif op == '|':
+            result = args[0] | args[1]
+        elif op == '^':
+            result = args[0] ^ args[1]
+        elif op == 'n':
+            result = ~(args[0] & args[1])
+        elif op == '+':
+            result = args[0] + args[1]
+        elif op == '-':
+            result = args[0] - args[1]
+        elif op == '*':
+            result = args[0] * args[1]
+        elif op == '<':
+            result = (args[0] < args[1]).astype(work)
+        elif op == '>':
+            result = (args[0] > args[1]).astype(work)
+        elif op == '=':
+            result = (args[0] == args[1]).astype(work)
+        elif op == 'x':
+            result = np.where(args[0] != 0, args[2], args[1])
+        elif op == 'c':
+            result = args[0]
+            for arg, wire in zip(args[1:], net.args[1:]):
+                result = (result << const(wire.bitwidth)) | arg
+        elif op == 's':
+            source = args[0]
+            start = net.op_param[0]
+            if tuple(net.op_param) == tuple(range(start, start + len(net.op_param))):
+                result = source >> const(start)  # a contiguous slice is just a shift
+            else:
+                result = np.zeros(len(source), dtype=work)
+                for i, b in enumerate(net.op_param):
+                    result = result | (((source >> const(b)) & const(1)) << const(i))
+        elif op == 'm':
+            result = self._rom_read(net.op_param[1], values[net.args[0]], work)
+        else:
+            raise PyrtlInternalError('error, unknown op type')
+
+        return self._cast(result & mask, self._dtype(dest.bitwidth))
+
+    def _rom_read(self, rom, addrs, work):
+        np = self._np
+        if rom.addrwidth <= 20:
+            table = np.array([rom._get_read_data(a) for a in range(1 << rom.addrwidth)],
+                             dtype=work)
+            return table[addrs.astype(np.intp)]
+        data = [rom._get_read_data(int(a)) for a in addrs]
+        return np.array(data, dtype=object).astype(work)
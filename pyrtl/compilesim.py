@@ -1,37 +1,57 @@
 from __future__ import print_function, unicode_literals
 
+import copy
 import ctypes
 import subprocess
 import tempfile
 import shutil
 import collections
+import hashlib
+import numbers
+import heapq
+import multiprocessing
+import os
 from os import path
 import platform
+import stat
 import sys
+import threading
+import weakref
 import _ctypes
 
 from .core import working_block
 from .wire import Input, Output, Const, WireVector, Register
 from .memory import MemBlock, RomBlock
 from .pyrtlexceptions import PyrtlError, PyrtlInternalError
-from .simulation import SimulationTrace, _trace_sort_key
+from .simulation import (SimulationTrace, ToggleActivity, _trace_sort_key, _stateful_memories,
+                         _resolve_snapshot, _initial_snapshot, _activity_wires,
+                         _assertion_names, _assertion_failure)
 
 
 __all__ = ['CompiledSimulation']
 
 
 class DllMemInspector(collections.Mapping):
-    """Dictionary-like access to a hashmap in a CompiledSimulation."""
+    """Dictionary-like access to a memory (hashmap or dense array) in a CompiledSimulation."""
 
     def __init__(self, sim, mem):
         self._aw = mem.addrwidth
         self._limbs = sim._limbs(mem)
         self._vn = vn = sim.varname[mem]
-        self._mem = ctypes.c_void_p.in_dll(sim._dll, vn)
-        self._sim = sim  # keep reference to avoid freeing dll
+        if mem in sim._dense_mems:
+            self._array = sim._mem_array(mem)
+        else:
+            self._array = None
+            self._mem = sim._hash_map(mem)
+        self._sim = sim  # keep reference to avoid freeing the state
 
     def __getitem__(self, ind):
-        arr = self._sim._mem_lookup(self._mem, ind)
+        if self._array is not None:
+            if not 0 <= ind < len(self):
+                raise KeyError(ind)
+            arr = self._array[ind * self._limbs:(ind + 1) * self._limbs]
+        else:
+            arr = self._sim._lib.lookup(self._mem, ind)
         val = 0
         for n in reversed(range(self._limbs)):
             val <<= 64
@@ -62,57 +82,228 @@ class CompiledSimulation(object):
     at the cost of somewhat longer setup time.
     Generally this will do better than FastSimulation for simulations requiring over 1000 steps.
     It is not built to be a debugging tool, though it may help with debugging.
-    Note that only Input and Output wires can be traced using CompiledSimulation.
+
+    Any wire in the tracer can be traced: the generated code copies internal wires into
+    a separate trace buffer every cycle.  To keep only the most recent history of a long
+    run, pass trace_ring_size=K, after which the tracer holds only the last K cycles and
+    internal wires are recorded into a fixed ring buffer of K cycles in C.
 
     In order to use this, you need:
         - A 64-bit processor
-        - GCC (tested on version 4.8.4)
+        - GCC (tested on version 4.8.4), with support for unsigned __int128
         - A 64-bit build of Python
-    If using the multiplication operand, only some architectures are supported:
-        - x86-64 / amd64
-        - arm64 / aarch64 (untested)
-        - mips64 (untested)
 
     default_value is currently only implemented for registers, not memories.
+
+    MemBlocks with an addrwidth of at most dense_mem_addrwidth are stored as flat arrays
+    indexed directly by address, which makes reads and writes cheap.  Larger memories
+    use a hash map, so that huge but sparsely used address spaces stay small.
+
+    Compiled libraries are kept in an on-disk cache keyed by a hash of the generated
+    C code, the compiler flags and the platform (including the CPU that -march=native
+    resolves to), so that constructing a simulation of an unchanged design again (even
+    from another process) does not rerun gcc.  By default the cache lives in the
+    directory named by the PYRTL_COMPILE_CACHE environment variable, or else in a
+    "pyrtl-compile-cache" directory in the user's cache directory (~/.cache, or
+    $XDG_CACHE_HOME), created readable by its owner only.  Pass a directory as cache_dir
+    to use another location, or cache_dir=False to always compile from scratch.  As the
+    libraries are loaded into the simulating process, a cache directory or entry that
+    is not owned by the current user, or that others can write to, is never used.  Once
+    the cache grows beyond cache_size_limit bytes, the least recently used libraries
+    are removed from it.
+
+    Pass activity=True (or a list of wires) to have the generated code count the toggles
+    of every wire (or of those wires) into the ToggleActivity kept in .activity.  This
+    needs no tracer, so it can be combined with tracer=None, in which case only the
+    Outputs can be inspected.  A fork counts the same wires from scratch.
+
+    The rtl_assert assertions of the block are checked by the compiled code after each
+    cycle, and a run stops at the first cycle in which one fails: the results of the
+    cycles up to and including it are kept, and then the registered exception is raised.
+
+    The combinational logic is generated as a series of C functions of a bounded number
+    of nets each, rather than as one huge function, and the wires live in a struct
+    rather than on the stack, so large designs neither overflow the stack nor make gcc
+    slow down on a single enormous function.  The functions are split between several
+    C files (shards=N of them, or by default one for every 20000 nets, up to the number
+    of CPUs), which are compiled by concurrent gcc processes and then linked, so the
+    compile time of a large design scales with the number of cores.
+
+    All of the state of the simulation (wires, registers, memories and toggle counts)
+    is kept in that struct, which each simulation allocates for itself, so simulations
+    of the same design in a process, and their forks, share one loaded library.  The
+    compiled code runs without holding the GIL, so run_batch can simulate many
+    independent sets of inputs at once on a pool of threads.
+
+    The code is compiled with -O0 by default, which compiles quickly.  For long runs of
+    datapath-heavy designs, pass opt_level=2 (or 1, 3 or 's') to have gcc optimize it,
+    at the cost of a longer compile.  Arithmetic on values of up to 128 bits is done
+    with unsigned __int128, which the optimizer handles well; wider values are
+    computed 64 bits at a time by straight-line code.
     """
 
+    _nets_per_function = 1000  # nets of combinational logic in each generated C function
+    _nets_per_shard = 20000  # nets in each C file, when the number of shards is automatic
+
     def __init__(
             self, tracer=True, register_value_map={}, memory_value_map={},
-            default_value=0, block=None):
-        self._dll = self._dir = None
+            default_value=0, block=None, cache_dir=True, cache_size_limit=256 * 1024 * 1024,
+            dense_mem_addrwidth=16, trace_ring_size=None, activity=False, shards=None,
+            opt_level=0):
+        self._lib = self._state = None
         self.block = working_block(block)
         self.block.sanity_check()
 
         if tracer is True:
             tracer = SimulationTrace()
         self.tracer = tracer
-        self._remove_untraceable()
+        if trace_ring_size is not None and trace_ring_size < 1:
+            raise PyrtlError('trace_ring_size must be at least 1')
+        self._ring_size = trace_ring_size
+        if shards is not None and shards < 1:
+            raise PyrtlError('shards must be at least 1')
+        self._shards = shards
+        if opt_level not in (0, 1, 2, 3, 's'):
+            raise PyrtlError("opt_level must be one of 0, 1, 2, 3 or 's'")
+        self._opt_level = opt_level
+        self._ring_pos = self._ring_count = 0  # next slot and number of valid ring entries
+        self._last_values = {}  # values of wires in the latest step, for inspect
+        self._cycle = 0  # cycles run since the simulation was created or reset
 
         self.default_value = default_value
         self._regmap, self._memmap = register_value_map, memory_value_map
         self._uid_counter = 0
         self.varname = {}  # mapping from wires and memories to C variables
+        self._dense_mem_addrwidth = dense_mem_addrwidth
+        self._dense_mems = set()  # memories stored as flat arrays rather than hashmaps
+        # only the layout of the counts until the state is allocated (see _new_state)
+        self.activity = (ToggleActivity(_activity_wires(self.block, activity))
+                         if activity else None)
+
+        if cache_dir is True:
+            cache_dir = os.environ.get('PYRTL_COMPILE_CACHE')
+            if not cache_dir:
+                user_cache = os.environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache')
+                cache_dir = path.join(user_cache, 'pyrtl-compile-cache')
+        self._cache_dir = cache_dir
+        self._cache_size_limit = cache_size_limit
+        self.cache_hit = False  # True if the library was taken from the compile cache
 
         self._create_dll()
-        self._initialize_mems()
+        self._new_state()
+        # initial values are set from here rather than compiled in, so the compiled
+        # code does not depend on them
+        self.restore(_initial_snapshot(self.block, self._regmap, self._memmap))
+        if self._ring_size is not None:
+            self._ring = (ctypes.c_uint64 * (self._ring_size * self._tbufsz))()
 
     def inspect_mem(self, mem):
         """Get a view into the contents of a MemBlock."""
         return DllMemInspector(self, mem)
 
+    def snapshot(self):
+        """Capture the register and memory state of the simulation.
+
+        The state is read straight out of the compiled library; see
+        Simulation.snapshot for the format of the returned dictionary.
+        Memory addresses holding 0 are left out.
+        """
+        registers = {reg.name: self._read_limbs(self._reg_array(reg), 0, self._limbs(reg))
+                     for reg in self.block.wirevector_subset(Register)}
+        memories = {}
+        for name, mem in _stateful_memories(self.block).items():
+            limbs = self._limbs(mem)
+            if mem in self._dense_mems:
+                arr = self._mem_array(mem)
+                addrs = range(1 << mem.addrwidth)
+            else:
+                count = self._lib.hash_map_count(self._hash_map(mem))
+                keys = (ctypes.c_uint64 * count)()
+                arr = (ctypes.c_uint64 * (count * limbs))()
+                self._lib.hash_map_dump(self._hash_map(mem), keys, arr)
+                addrs = keys
+            contents = {}
+            for n, addr in enumerate(addrs):
+                value = self._read_limbs(arr, n * limbs, limbs)
+                if value:
+                    contents[addr] = value
+            memories[name] = contents
+        return {'registers': registers, 'memories': memories}
+
+    def restore(self, snapshot):
+        """Return the registers and memories to a state captured by snapshot().
+
+        The state is written straight into the compiled library, so nothing is
+        recompiled.  See Simulation.restore for details.
+        """
+        registers, memories = _resolve_snapshot(self.block, snapshot, self.default_value)
+        for reg, value in registers.items():
+            self._write_limbs(self._reg_array(reg), 0, self._limbs(reg), value)
+        for mem, contents in memories.items():
+            limbs = self._limbs(mem)
+            if mem in self._dense_mems:
+                arr = self._mem_array(mem)
+                ctypes.memset(arr, 0, ctypes.sizeof(arr))
+                for addr, value in contents.items():
+                    self._write_limbs(arr, addr * limbs, limbs, value)
+            else:
+                self._lib.clear_hash_map(self._hash_map(mem))
+                val = (ctypes.c_uint64 * limbs)()
+                for addr, value in contents.items():
+                    self._write_limbs(val, 0, limbs, value)
+                    self._lib.insert(self._hash_map(mem), addr, val)
+
+    def reset(self, register_value_map=None, memory_value_map=None):
+        """Return the simulation to its initial state, without compiling again.
+
+        See Simulation.reset for the arguments.  The registers and memories are
+        rewritten in the loaded library, and the tracer is cleared.
+        """
+        self.restore(_initial_snapshot(self.block, register_value_map, memory_value_map))
+        self._last_values = {}
+        self._ring_pos = self._ring_count = 0
+        self._cycle = 0
+        if self.tracer is not None:
+            self.tracer.clear()
+
+    def fork(self, tracer=True):
+        """Create an independent simulation starting from the current state of this one.
+
+        :param tracer: the tracer of the new simulation; True (the default) creates a
+          new SimulationTrace of the same wires as the tracer of this simulation
+        :return: a new CompiledSimulation with a copy of the state of this one
+
+        The new simulation shares the already compiled library, with a state of its
+        own, so gcc is not run again.
+        """
+        if tracer is True:
+            tracer = self.tracer._fork(self.block) if self.tracer is not None else None
+        for name in (tracer.trace if tracer is not None else ()):
+            if name not in self._inputpos and name not in self._outputpos \
+                    and name not in self._tracepos:
+                raise PyrtlError('wire "{}" was not traced when the simulation was compiled'
+                                 .format(name))
+        sim = copy.copy(self)
+        sim._new_state()
+        sim.tracer = tracer
+        sim._last_values = {}
+        sim._ring_pos = sim._ring_count = 0
+        if sim._ring_size is not None:
+            sim._ring = (ctypes.c_uint64 * (sim._ring_size * sim._tbufsz))()
+        sim.restore(self.snapshot())
+        return sim
+
     def inspect(self, w):
         """Get the latest value of the wire given, if possible."""
         if isinstance(w, WireVector):
             w = w.name
         try:
-            vals = self.tracer.trace[w]
+            return self._last_values[w]
         except KeyError:
             pass
-        else:
-            if not vals:
-                raise PyrtlError('No context available. Please run a simulation step')
-            return vals[-1]
-        raise PyrtlError('CompiledSimulation does not support inspecting internal WireVectors')
+        if self.tracer is not None and w in self.tracer.trace:
+            raise PyrtlError('No context available. Please run a simulation step')
+        raise PyrtlError('CompiledSimulation can only inspect WireVectors in its tracer')
 
     def step(self, inputs):
         """Run one step of the simulation.
@@ -200,18 +391,37 @@ class CompiledSimulation(object):
                 "any expected outputs must have a supplied value "
                 "each step of simulation")
 
-        failed = []
-        for i in range(nsteps):
-            self.step({w: int(v[i]) for w, v in provided_inputs.items()})
+        if stop_after_first_error or self._ring_size is not None:
+            # the early stop is checked between individual steps, and the ring only
+            # holds the internal wires of the latest steps
+            failed = []
+            for i in range(nsteps):
+                self.step({w: int(v[i]) for w, v in provided_inputs.items()})
 
-            for expvar in expected_outputs.keys():
-                expected = int(expected_outputs[expvar][i])
-                actual = self.inspect(expvar)
-                if expected != actual:
-                    failed.append((i, expvar, expected, actual))
+                for expvar in expected_outputs.keys():
+                    expected = int(expected_outputs[expvar][i])
+                    actual = self.inspect(expvar)
+                    if expected != actual:
+                        failed.append((i, expvar, expected, actual))
 
-            if failed and stop_after_first_error:
-                break
+                if failed:
+                    break
+        else:
+            names = {expvar: expvar.name if isinstance(expvar, WireVector) else expvar
+                     for expvar in expected_outputs}
+            for name in names.values():
+                if name not in self._outputpos and name not in self._inputpos \
+                        and name not in self._tracepos:
+                    raise PyrtlError(
+                        'CompiledSimulation can only inspect WireVectors in its tracer')
+            observed = self._run_multiple(provided_inputs, nsteps, set(names.values()))
+            failed = []
+            for expvar in expected_outputs.keys():
+                actual_values = observed[names[expvar]]
+                for i in range(nsteps):
+                    expected = int(expected_outputs[expvar][i])
+                    if expected != actual_values[i]:
+                        failed.append((i, expvar, expected, actual_values[i]))
 
         if failed:
             if stop_after_first_error:
@@ -238,14 +448,7 @@ class CompiledSimulation(object):
         and its length is the number of steps to be executed.
         """
         steps = len(inputs)
-        # create i/o arrays of the appropriate length
-        ibuf_type = ctypes.c_uint64 * (steps * self._ibufsz)
-        obuf_type = ctypes.c_uint64 * (steps * self._obufsz)
-        ibuf = ibuf_type()
-        obuf = obuf_type()
-        # these array will be passed to _crun
-        self._crun.argtypes = [ctypes.c_uint64, ibuf_type, obuf_type]
-
+        ibuf = (ctypes.c_uint64 * (steps * self._ibufsz))()
         # build the input array
         for n, inmap in enumerate(inputs):
             for w in inmap:
@@ -253,88 +456,573 @@ class CompiledSimulation(object):
                     name = w.name
                 else:
                     name = w
-                start, count = self._inputpos[name]
-                start += n * self._ibufsz
-                val = inmap[w]
-                if val >= 1 << self._inputbw[name]:
-                    raise PyrtlError(
-                        'Wire {} has value {} which cannot be represented '
-                        'using its bitwidth'.format(name, val))
-                # pack input
-                for pos in range(start, start + count):
-                    ibuf[pos] = val & ((1 << 64) - 1)
-                    val >>= 64
+                self._pack_input(ibuf, n, name, inmap[w])
+        self._run_buffer(steps, ibuf)
 
-        # run the simulation
-        self._crun(steps, ibuf, obuf)
+    def _run_multiple(self, provided_inputs, nsteps, observe=()):
+        """Run nsteps cycles in a single call of the compiled code.
+
+        :param provided_inputs: a dictionary mapping wirevectors (or their names)
+          to sequences of at least nsteps values; inputs not given are 0
+        :param nsteps: the number of cycles to run
+        :param observe: names of traced wires whose values should be returned
+        :return: a dictionary mapping each observed wire name to its values
+        """
+        ibuf = (ctypes.c_uint64 * (nsteps * self._ibufsz))()
+        for w, vals in provided_inputs.items():
+            name = w.name if isinstance(w, WireVector) else w
+            if name not in self._inputpos:
+                raise PyrtlError('"{}" is not an Input of the block'.format(name))
+            for n in range(nsteps):
+                self._pack_input(ibuf, n, name, int(vals[n]))
+        return self._run_buffer(nsteps, ibuf, observe)
+
+    def _pack_input(self, ibuf, n, name, val):
+        """Store the value of an input for step n into the input array."""
+        start, count = self._inputpos[name]
+        start += n * self._ibufsz
+        if val >= 1 << self._inputbw[name] or val < 0:
+            raise PyrtlError(
+                'Wire {} has value {} which cannot be represented '
+                'using its bitwidth'.format(name, val))
+        # pack input
+        for pos in range(start, start + count):
+            ibuf[pos] = val & ((1 << 64) - 1)
+            val >>= 64
+
+    def _run_buffer(self, steps, ibuf, observe=()):
+        """Run the steps held in an input array, returning the values of the observed wires."""
+        # create output arrays of the appropriate length
+        obuf = (ctypes.c_uint64 * (steps * self._obufsz))()
+        if self._ring_size is None:
+            tbuf = (ctypes.c_uint64 * (steps * self._tbufsz))()
+            trace_pos, trace_len = 0, max(steps, 1)
+        else:
+            tbuf = self._ring
+            trace_pos, trace_len = self._ring_pos, self._ring_size
+        # run the simulation, which stops early if an assertion fails
+        steps = self._lib.sim_run_all(self._state, steps, ibuf, obuf, tbuf, trace_pos, trace_len)
 
         # save traced wires
-        for name in self.tracer.trace:
-            rname = self._probe_mapping.get(name, name)
-            if rname in self._outputpos:
-                start, count = self._outputpos[rname]
-                buf, sz = obuf, self._obufsz
-            elif rname in self._inputpos:
-                start, count = self._inputpos[rname]
-                buf, sz = ibuf, self._ibufsz
+        def values(name, records):
+            if name in self._outputpos:
+                return self._unpack(obuf, self._obufsz, self._outputpos[name], records)
+            if name in self._inputpos:
+                return self._unpack(ibuf, self._ibufsz, self._inputpos[name], records)
+            return self._unpack(tbuf, self._tbufsz, self._tracepos[name], records)
+        self._update_tracer(steps, tbuf, values)
+        observed = {name: values(name, range(steps)) for name in observe}
+        self._check_assertions(steps)
+        return observed
+
+    def run_columns(self, inputs, nsteps=None, trace=False):
+        """Run many steps of the simulation on whole columns of input values.
+
+        :param inputs: a dictionary mapping each Input (or its name) to the values it
+          takes in each step, as a NumPy array or any object supporting the buffer
+          protocol.  Inputs not given are 0.  Values of wires wider than 64 bits are
+          given as a 2D array with one row of little-endian 64-bit limbs per step,
+          or as a sequence of Python ints.
+        :param nsteps: number of steps to run (defaults to the length of the inputs)
+        :param trace: if True, also append the values of the traced wires to the tracer
+        :return: a dictionary mapping the name of each Output (and of each traced
+          internal wire, unless trace_ring_size is in use) to a NumPy view of the
+          values it took in each step
+
+        This requires NumPy.  Columns that are already contiguous uint64 arrays are
+        handed to the compiled code without copying, and the results are views into
+        the buffer written by the compiled code, so Python ints are only created if
+        they are asked for (e.g. with tolist()) or when trace is True.
+        """
+        return self._run_columns(inputs, nsteps, trace, {})
+
+    def stream(self, chunks, trace=False):
+        """Run the simulation over a stream of input chunks, using bounded memory.
+
+        :param chunks: an iterable (such as a generator) of input chunks, each either
+          a dictionary of input columns as taken by run_columns, or just a number of
+          steps to run for designs without inputs
+        :param trace: if True, also append the values of the traced wires to the tracer
+        :return: a generator yielding, for each chunk, a pair of the cycle at which the
+          chunk started and a dictionary of output columns as returned by run_columns
+
+        The output buffers are allocated once (growing only for a chunk larger than any
+        before it) and reused for every chunk, so the columns yielded for a chunk are
+        only valid until the next chunk is requested: copy anything that must be kept.
+        With trace left as False (or trace_ring_size set on the simulation) memory use
+        stays constant no matter how many cycles are run.
+        """
+        return self._stream(chunks, trace, {})
+
+    def _stream(self, chunks, trace, buffers):
+        cycle = 0
+        for chunk in chunks:
+            if isinstance(chunk, numbers.Integral):
+                inputs, nsteps = {}, chunk
             else:
-                raise PyrtlInternalError('Untraceable wire in tracer')
-            res = []
-            for n in range(steps):
-                val = 0
-                # unpack output
-                for pos in reversed(range(start, start + count)):
-                    val <<= 64
-                    val |= buf[pos]
-                res.append(val)
-                start += sz
-            self.tracer.trace[name].extend(res)
-
-    def _traceable(self, wv):
-        """Check if wv is able to be traced
-
-        If it is traceable due to a probe, record that probe in _probe_mapping.
+                inputs, nsteps = chunk, None
+            result = self._run_columns(inputs, nsteps, trace, buffers)
+            yield cycle, result
+            cycle += buffers['nsteps']
+
+    def run_stream(self, chunks, sink, trace=False):
+        """Run the simulation over a stream of input chunks, passing the outputs to a sink.
+
+        :param chunks: an iterable of input chunks, as taken by stream
+        :param sink: a function called as sink(cycle, outputs) after each chunk is run,
+          where outputs is only valid for the duration of the call
+        :param trace: if True, also append the values of the traced wires to the tracer
+        :return: the total number of cycles run
+
+        Example, checking a long run a million cycles at a time::
+
+            def chunks():
+                for _ in range(1000):
+                    yield {'a': numpy.random.randint(0, 256, 10**6, dtype=numpy.uint64)}
+
+            def check(cycle, outputs):
+                assert not outputs['error'].any(), 'error near cycle %d' % cycle
+
+            sim.run_stream(chunks(), check)
         """
-        if isinstance(wv, (Input, Output)):
-            return True
-        for net in self.block.logic:
-            if net.op == 'w' and net.args[0].name == wv.name and isinstance(net.dests[0], Output):
-                self._probe_mapping[wv.name] = net.dests[0].name
-                return True
-        return False
+        buffers = {}
+        cycle = 0
+        for cycle, result in self._stream(chunks, trace, buffers):
+            sink(cycle, result)
+        return cycle + buffers.get('nsteps', 0)
+
+    def run_batch(self, stimuli, nsteps=None, threads=None):
+        """Run many independent sets of inputs concurrently, each from the current state.
+
+        :param stimuli: a list of dictionaries of input columns, as taken by run_columns
+        :param nsteps: number of steps to run each set for (defaults to the length of
+          its inputs)
+        :param threads: number of threads to run them on (defaults to the number of CPUs)
+        :return: a list of the results of each set, as returned by run_columns
+
+        Each set is run by run_columns in a fork of this simulation without a tracer,
+        so this simulation is left as it was.  The forks share the compiled library,
+        which runs without holding the GIL, so the sets are simulated in parallel.
+        If an rtl_assert fails in any of them, its exception is raised.
+        """
+        from multiprocessing.pool import ThreadPool
 
-    def _remove_untraceable(self):
-        """Remove from the tracer those wires that CompiledSimulation cannot track.
+        def run(inputs):
+            return self.fork(tracer=None).run_columns(inputs, nsteps)
 
-        Create _probe_mapping for wires only traceable via probes.
+        pool = ThreadPool(threads or multiprocessing.cpu_count())
+        try:
+            return pool.map(run, stimuli)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_columns(self, inputs, nsteps, trace, buffers):
+        """Run one batch of columnar inputs, reusing the arrays in buffers when possible."""
+        import numpy  # pylint: disable=import-error
+
+        columns = {}
+        for w, vals in inputs.items():
+            name = w.name if isinstance(w, WireVector) else w
+            if name not in self._inputpos:
+                raise PyrtlError('"{}" is not an Input of the block'.format(name))
+            columns[name] = self._to_column(numpy, name, vals)
+        if nsteps is None:
+            if not columns:
+                raise PyrtlError('need to supply either input values or a number of steps')
+            nsteps = min(len(c) for c in columns.values())
+        if nsteps < 1:
+            raise PyrtlError('must simulate at least one step')
+        if any(len(c) < nsteps for c in columns.values()):
+            raise PyrtlError('must supply a value for each provided wire '
+                             'for each step of simulation')
+
+        def buffer(key, width):
+            buf = buffers.get(key)
+            if buf is None or len(buf) < nsteps:
+                buf = buffers[key] = numpy.zeros((nsteps, width), numpy.uint64)
+            return buf[:nsteps]
+
+        for name in self._input_order:
+            if name not in columns:
+                columns[name] = buffer(('zeros', name), self._inputpos[name][1])
+        buffers['nsteps'] = nsteps
+
+        obuf = buffer('outputs', self._obufsz)
+        if self._ring_size is None:
+            tbuf = buffer('traces', self._tbufsz)
+            tptr, trace_pos, trace_len = tbuf.ctypes.data, 0, max(nsteps, 1)
+        else:
+            tbuf = self._ring
+            tptr, trace_pos, trace_len = ctypes.addressof(tbuf), self._ring_pos, self._ring_size
+        colptrs = (ctypes.c_void_p * max(len(self._input_order), 1))(
+            *[columns[name].ctypes.data for name in self._input_order])
+        nsteps = self._lib.sim_run_columns(
+            self._state, nsteps, colptrs, obuf.ctypes.data, tptr, trace_pos, trace_len)
+        buffers['nsteps'] = nsteps  # fewer if an assertion failed
+        obuf = obuf[:nsteps]
+        if self._ring_size is None:
+            tbuf = tbuf[:nsteps]
+
+        def view(buf, pos):
+            start, count = pos
+            return buf[:, start] if count == 1 else buf[:, start:start + count]
+
+        result = {name: view(obuf, pos) for name, pos in self._outputpos.items()}
+        if self._ring_size is None:
+            result.update((name, view(tbuf, pos)) for name, pos in self._tracepos.items())
+
+        if trace:
+            def values(name, records):
+                col = result[name] if name in result else columns[name]
+                return self._column_ints(col[records.start:records.stop])
+            self._update_tracer(nsteps, tbuf, values)
+        else:
+            # keep what inspect needs without building the whole trace
+            self._ring_advance(nsteps)
+            self._last_values = {
+                name: self._column_ints(col[nsteps - 1:nsteps])[0]
+                for name, col in list(result.items()) + list(columns.items())}
+        self._check_assertions(nsteps)
+        return result
+
+    def _check_assertions(self, steps):
+        """Count the steps just run, raising the exception of an assertion that failed."""
+        self._cycle += steps
+        failed = self._state_field(ctypes.c_uint64, 'assert_failed').value
+        if failed:
+            raise _assertion_failure(
+                self.block, _assertion_names(self.block)[failed - 1], self._cycle - 1)
+
+    def _to_column(self, numpy, name, vals):
+        """Turn the values given for an input into a uint64 array of nsteps rows of limbs."""
+        limbs = self._inputpos[name][1]
+        bitwidth = self._inputbw[name]
+        if not isinstance(vals, numpy.ndarray):
+            try:
+                vals = numpy.asarray(memoryview(vals))
+            except TypeError:
+                vals = numpy.array(list(vals), dtype=object)
+        if vals.dtype.kind in 'ui' and vals.ndim == 1 and limbs == 1:
+            if vals.dtype.kind == 'i' and (vals < 0).any():
+                raise PyrtlError('Wire {} has a negative value'.format(name))
+            col = numpy.ascontiguousarray(vals, dtype=numpy.uint64)
+            if bitwidth < 64 and (col >> numpy.uint64(bitwidth)).any():
+                raise PyrtlError('Wire {} has a value which cannot be represented '
+                                 'using its bitwidth'.format(name))
+            return col
+        if vals.dtype == numpy.uint64 and vals.ndim == 2 and vals.shape[1] == limbs:
+            col = numpy.ascontiguousarray(vals)
+            if bitwidth % 64 and (col[:, -1] >> numpy.uint64(bitwidth % 64)).any():
+                raise PyrtlError('Wire {} has a value which cannot be represented '
+                                 'using its bitwidth'.format(name))
+            return col
+        # anything else is a sequence of Python ints, split into limbs here
+        col = numpy.zeros((len(vals), limbs), numpy.uint64)
+        for n, val in enumerate(vals):
+            val = int(val)
+            if val < 0 or val >> bitwidth:
+                raise PyrtlError('Wire {} has value {} which cannot be represented '
+                                 'using its bitwidth'.format(name, val))
+            for limb in range(limbs):
+                col[n, limb] = val & ((1 << 64) - 1)
+                val >>= 64
+        return col
+
+    def _column_ints(self, col):
+        """Python ints from a column of values (a 1D array, or a 2D array of limbs)."""
+        if col.ndim == 1:
+            return col.tolist()
+        res = []
+        for row in col.tolist():
+            val = 0
+            for limb in reversed(row):
+                val = (val << 64) | limb
+            res.append(val)
+        return res
+
+    def _ring_advance(self, steps):
+        """Account for steps written into the trace ring, returning the retained records."""
+        if self._ring_size is None:
+            return None
+        self._ring_pos = (self._ring_pos + steps) % self._ring_size
+        self._ring_count = min(self._ring_count + steps, self._ring_size)
+        return [(self._ring_pos - self._ring_count + n) % self._ring_size
+                for n in range(self._ring_count)]
+
+    def _update_tracer(self, steps, tbuf, values):
+        """Append the values of the last steps to the tracer.
+
+        values(name, records) gives the values of a wire in the given range of the
+        last steps, except for internal wires in ring mode, which are rebuilt from
+        the ring buffer tbuf.
         """
-        self._probe_mapping = {}
-        wvs = {wv for wv in self.tracer.wires_to_track if self._traceable(wv)}
-        self.tracer.wires_to_track = wvs
-        self.tracer._wires = {wv.name: wv for wv in wvs}
-        self.tracer.trace.__init__(wvs)
+        ring_records = self._ring_advance(steps)
+        if self.tracer is None:
+            if steps:  # only the last step is kept, for inspect
+                last = range(steps - 1, steps)
+                self._last_values = {name: values(name, last)[0] for name in self._outputpos}
+            return
+        for name in self.tracer.trace:
+            if name not in self._outputpos and name not in self._inputpos \
+                    and name not in self._tracepos:
+                raise PyrtlInternalError('Untraceable wire in tracer')
+            trace = self.tracer.trace[name]
+            if ring_records is not None and name in self._tracepos:
+                # the ring holds the full retained history of internal wires
+                trace[:] = self._unpack(tbuf, self._tbufsz, self._tracepos[name], ring_records)
+                continue
+            trace.extend(values(name, range(steps)))
+            if ring_records is not None:
+                del trace[:-self._ring_size]
+        self._last_values = {name: vals[-1] for name, vals in self.tracer.trace.items() if vals}
+
+    def _unpack(self, buf, sz, pos, records):
+        """Rebuild the values of one wire from the given records of an i/o buffer."""
+        start, count = pos
+        res = []
+        for n in records:
+            val = 0
+            pos = n * sz + start
+            for p in reversed(range(pos, pos + count)):
+                val <<= 64
+                val |= buf[p]
+            res.append(val)
+        return res
+
+    _libraries = weakref.WeakValueDictionary()  # loaded libraries, by cache entry
+    _libraries_lock = threading.Lock()
 
     def _create_dll(self):
-        """Create a dynamically-linked library implementing the simulation logic."""
-        self._dir = tempfile.mkdtemp()
-        with open(path.join(self._dir, 'pyrtlsim.c'), 'w') as f:
-            self._create_code(lambda s: f.write(s + '\n'))
+        """Create a dynamically-linked library implementing the simulation logic.
+
+        A library already loaded by another simulation of the same code in this
+        process is shared rather than loaded again, as all of the state lives in
+        memory allocated by each simulation (see _new_state).
+        """
+        files = self._create_code()
         if platform.system() == 'Darwin':
             shared = '-dynamiclib'
         else:
             shared = '-shared'
-        subprocess.check_call(['gcc', '-O0', '-march=native', '-std=c99', '-m64',
-                               shared, '-fPIC',
-                               path.join(self._dir, 'pyrtlsim.c'),
-                               '-o', path.join(self._dir, 'pyrtlsim.so'), ],
-                              shell=(platform.system() == 'Windows'))
-        self._dll = ctypes.CDLL(path.join(self._dir, 'pyrtlsim.so'))
-        self._crun = self._dll.sim_run_all
-        self._crun.restype = None  # argtypes set on use
-        self._initialize_mems = self._dll.initialize_mems
-        self._initialize_mems.restype = None
-        self._mem_lookup = self._dll.lookup
-        self._mem_lookup.restype = ctypes.POINTER(ctypes.c_uint64)
+        flags = ['-O{}'.format(self._opt_level), '-march=native', '-std=c99', '-m64', '-fPIC']
+        cached = self._cache_lookup(
+            '\0'.join(name + '\0' + code for name, code in files), flags + [shared])
+        if cached is not None:
+            with self._libraries_lock:
+                self._lib = self._libraries.get(cached)
+            if self._lib is not None:
+                self.cache_hit = True
+                return
+
+        # The library is loaded from our private directory, even on a cache hit, so
+        # that evicting the cache entry cannot remove it while it is in use.
+        libdir = tempfile.mkdtemp()
+        try:
+            sources = []
+            for name, code in files:
+                with open(path.join(libdir, name), 'w') as f:
+                    f.write(code)
+                if name.endswith('.c'):
+                    sources.append(path.join(libdir, name))
+            libpath = path.join(libdir, 'pyrtlsim.so')
+            if cached is not None:
+                try:
+                    with open(cached, 'rb') as src:
+                        # anyone else able to write the entry could have planted it
+                        if _owned_privately(os.fstat(src.fileno())):
+                            with open(libpath, 'wb') as dst:
+                                shutil.copyfileobj(src, dst)
+                            self.cache_hit = True
+                    if self.cache_hit:
+                        os.utime(cached, None)  # mark as recently used for eviction
+                except (IOError, OSError):
+                    pass  # removed by a concurrent eviction; just compile it again
+            if not self.cache_hit:
+                self._compile(flags, shared, sources, libpath)
+                if cached is not None:
+                    self._cache_store(libpath, cached)
+            self._lib = _CompiledLibrary(libdir, libpath, self._state_fields)
+        except BaseException:
+            shutil.rmtree(libdir)
+            raise
+        if cached is not None:
+            with self._libraries_lock:
+                self._libraries[cached] = self._lib
+
+    def _compile(self, flags, shared, sources, libpath):
+        """Compile the C files into the library at libpath.
+
+        A single file is compiled and linked by one gcc call.  Otherwise each file is
+        compiled into an object file by a gcc process of its own, with up to one
+        running per CPU, and the object files are then linked.
+        """
+        windows = platform.system() == 'Windows'
+        if len(sources) == 1:
+            subprocess.check_call(['gcc'] + flags + [shared] + sources + ['-o', libpath],
+                                  shell=windows)
+            return
+        objects = [src[:-len('.c')] + '.o' for src in sources]
+        jobs = multiprocessing.cpu_count()
+        running = []
+
+        def finish(job):
+            command, proc = job
+            if proc.wait():
+                raise subprocess.CalledProcessError(proc.returncode, command)
+
+        try:
+            for src, obj in zip(sources, objects):
+                if len(running) == jobs:
+                    finish(running.pop(0))
+                command = ['gcc'] + flags + ['-c', src, '-o', obj]
+                running.append((command, subprocess.Popen(command, shell=windows)))
+            while running:
+                finish(running.pop(0))
+        finally:
+            for _, proc in running:  # still running if another one failed
+                proc.wait()
+        subprocess.check_call(['gcc'] + flags + [shared] + objects + ['-o', libpath],
+                              shell=windows)
+
+    def _new_state(self):
+        """Allocate the state of the simulation, which the compiled code runs on."""
+        self._state = (ctypes.c_uint64 * (self._lib.state_size // 8))()
+        self._lib.initialize_mems(self._state)
+        if self.activity is not None:
+            # the counts live in the state, so they start from zero in each simulation
+            act = self.activity
+
+            def array(ctype, name, size):
+                return self._state_field(ctype * max(size, 1), name)
+            self.activity = ToggleActivity(
+                act.wires, limbs=True,
+                prev=array(ctypes.c_uint64, 'act_prev', sum(self._limbs(w) for w in act.wires)),
+                counts=array(ctypes.c_uint64, 'act_counts', len(act._counts)),
+                high=array(ctypes.c_int64, 'act_high', len(act._high)),
+                cycle=array(ctypes.c_int64, 'act_cycle', 1))
+
+    def _state_field(self, ctype, name):
+        """A ctypes view of a member of the state_t struct of this simulation."""
+        return ctype.from_buffer(self._state, self._lib.offsets[name])
+
+    def _cache_lookup(self, code, flags):
+        """Path of the cache entry for the given code and flags, or None if caching is off."""
+        if not self._cache_dir:
+            return None
+        try:
+            os.makedirs(self._cache_dir, 0o700)
+        except OSError:
+            if not path.isdir(self._cache_dir):
+                return None  # cache location unusable; fall back to plain compilation
+        if not _owned_privately(os.stat(self._cache_dir)):
+            import warnings
+            warnings.warn('not using the compile cache in "%s", as it is not owned by the '
+                          'current user or others can write to it' % self._cache_dir)
+            return None
+        target = self._compiler_target()
+        if target is None:
+            return None  # what -march=native builds for is unknown, so it cannot be cached
+        key = hashlib.sha256()
+        for part in [code, ' '.join(flags), platform.platform(), platform.machine(),
+                     platform.processor(), self._compiler_version(), target]:
+            key.update(part.encode('utf-8'))
+            key.update(b'\0')
+        return path.join(self._cache_dir, 'pyrtlsim-{}.so'.format(key.hexdigest()))
+
+    _gcc_version = None
+
+    @classmethod
+    def _compiler_version(cls):
+        if cls._gcc_version is None:
+            version = subprocess.check_output(['gcc', '--version'],
+                                              shell=(platform.system() == 'Windows'))
+            cls._gcc_version = version.decode('utf-8', 'replace')
+        return cls._gcc_version
+
+    _gcc_target = False  # not yet asked for; None if gcc cannot say
+
+    @classmethod
+    def _compiler_target(cls):
+        """The target options (such as the CPU) that -march=native resolves to."""
+        if cls._gcc_target is False:
+            try:
+                target = subprocess.check_output(
+                    ['gcc', '-march=native', '-Q', '--help=target'],
+                    shell=(platform.system() == 'Windows'))
+                cls._gcc_target = target.decode('utf-8', 'replace')
+            except (OSError, subprocess.CalledProcessError):
+                cls._gcc_target = None
+        return cls._gcc_target
+
+    def _cache_store(self, libpath, cached):
+        """Add a freshly compiled library to the cache and evict old entries if needed.
+
+        The library is first copied to a file unique to this process and then renamed
+        into place, so concurrent readers never see a partially written library.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self._cache_dir, prefix='.pyrtlsim-', suffix='.tmp')
+        try:
+            os.close(fd)
+            shutil.copyfile(libpath, tmp)
+            try:
+                os.rename(tmp, cached)
+            except OSError:
+                # on Windows, rename fails if another process stored the same entry first
+                if not path.exists(cached):
+                    raise
+            self._cache_evict()
+        except (IOError, OSError):
+            pass  # the cache is only an optimization; never fail the simulation for it
+        finally:
+            if path.exists(tmp):
+                os.remove(tmp)
+
+    def _cache_evict(self):
+        """Remove the least recently used libraries until the cache fits its size limit."""
+        entries = []
+        for name in os.listdir(self._cache_dir):
+            if name.startswith('pyrtlsim-') and name.endswith('.so'):
+                try:
+                    st = os.stat(path.join(self._cache_dir, name))
+                except OSError:
+                    continue  # removed by another process
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self._cache_size_limit:
+                break
+            try:
+                os.remove(path.join(self._cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+    def _mem_array(self, mem):
+        """A ctypes view of the flat array storing a dense memory."""
+        size = (1 << mem.addrwidth) * self._limbs(mem)
+        return self._state_field(ctypes.c_uint64 * size, self._field[mem])
+
+    def _hash_map(self, mem):
+        """The address of the hashmap storing a sparse memory."""
+        return self._state_field(ctypes.c_void_p, self._field[mem]).value
+
+    def _reg_array(self, reg):
+        """A ctypes view of the limbs of a register."""
+        return self._state_field(ctypes.c_uint64 * self._limbs(reg), self._field[reg])
+
+    def _read_limbs(self, arr, start, limbs):
+        """The value held in limbs consecutive 64-bit words of arr, starting at start."""
+        val = 0
+        for n in reversed(range(start, start + limbs)):
+            val = (val << 64) | arr[n]
+        return val
+
+    def _write_limbs(self, arr, start, limbs, val):
+        """Store val into limbs consecutive 64-bit words of arr, starting at start."""
+        for n in range(start, start + limbs):
+            arr[n] = val & ((1 << 64) - 1)
+            val >>= 64
 
     def _limbs(self, w):
         """Number of 64-bit words needed to store value of wire."""
@@ -388,58 +1076,70 @@ class CompiledSimulation(object):
         self._uid_counter += 1
         return x
 
-    def _declare_roms(self, write, roms):
+    # The _declare methods write the declarations for the header shared by all the C
+    # files with declare, and the definitions for the main C file with write.  The
+    # state of the simulation is declared with field(name, declaration), as a member
+    # of the state_t struct, which the generated functions are passed a pointer s to.
+
+    def _declare_roms(self, declare, write, roms):
         for mem in roms:
             self.varname[mem] = vn = self._clean_name('m', mem)
             # extract data from mem
             romval = [mem._get_read_data(n) for n in range(1 << mem.addrwidth)]
-            write('static const uint{width}_t {name}[][{limbs}] = {{'.format(
-                name=vn, width=self._romwidth(mem), limbs=self._limbs(mem)))
+            rom = 'const uint{width}_t {name}[][{limbs}]'.format(
+                name=vn, width=self._romwidth(mem), limbs=self._limbs(mem))
+            declare('extern HIDDEN {};'.format(rom))
+            write('HIDDEN {} = {{'.format(rom))
             for rv in romval:
                 write(self._makeini(mem, rv) + ',')
             write('};')
 
-    def _declare_mems(self, write, mems):
+    def _declare_dense_mems(self, field, mems):
         for mem in mems:
-            self.varname[mem] = vn = self._clean_name('m', mem)
-            write('EXPORT')
-            write('hashmap_t *{name};'.format(name=vn))
+            vn = self._clean_name('m', mem)
+            self.varname[mem] = 's->' + vn
+            self._field[mem] = vn
+            self._dense_mems.add(mem)
+            field(vn, 'uint64_t {name}[{size}][{limbs}];'.format(
+                name=vn, size=1 << mem.addrwidth, limbs=self._limbs(mem)))
+
+    def _declare_mems(self, field, write, mems):
+        for mem in mems:
+            vn = self._clean_name('m', mem)
+            self.varname[mem] = 's->' + vn
+            self._field[mem] = vn
+            field(vn, 'hashmap_t *{name};'.format(name=vn))
 
-        next_tmp = 0
+        # initial contents are inserted from Python (see restore)
         write('EXPORT')
-        write('void initialize_mems() {')
+        write('void initialize_mems(state_t *s) {')
         for mem in mems:
             # Create hashmap
             write('{name} = create_hash_map(256, {limbs});'.format(
                 name=self.varname[mem], limbs=self._limbs(mem)
             ))
-            if mem in self._memmap:
-                # Insert default values
-                for k, v in self._memmap[mem].items():
-                    write('val_t t{n}[] = {val};'.format(
-                        n=next_tmp, val=self._makeini(mem, v)))
-                    write('insert({name}, {key}, t{n});'.format(
-                        name=self.varname[mem], key=k, n=next_tmp
-                    ))
-                    next_tmp += 1
+        write('}')
+        write('EXPORT')
+        write('void free_mems(state_t *s) {')
+        for mem in mems:
+            write('free_hash_map({name});'.format(name=self.varname[mem]))
         write('}')
 
-    def _declare_wv(self, write, w):
-        self.varname[w] = vn = self._clean_name('w', w)
+    def _declare_wv(self, declare, field, w):
+        vn = self._clean_name('w', w)
         if isinstance(w, Const):
-            write('const uint64_t {name}[{limbs}] = {val};'.format(
+            self.varname[w] = vn
+            declare('static const uint64_t {name}[{limbs}] = {val};'.format(
                 limbs=self._limbs(w), name=vn, val=self._makeini(w, w.val)))
-        elif isinstance(w, Register):
-            write('static uint64_t {name}[{limbs}] = {val};'.format(
-                limbs=self._limbs(w), name=vn,
-                val=self._makeini(w, self._regmap.get(w, self.default_value))))
         else:
-            write('uint64_t {name}[{limbs}];'.format(limbs=self._limbs(w), name=vn))
+            self.varname[w] = 's->' + vn
+            self._field[w] = vn
+            field(vn, 'uint64_t {name}[{limbs}];'.format(limbs=self._limbs(w), name=vn))
 
     def _build_memread(self, write, op, param, args, dest):
         mem = param[1]
         for n in range(self._limbs(dest)):
-            if isinstance(mem, RomBlock):
+            if isinstance(mem, RomBlock) or mem in self._dense_mems:
                 write('{dest}[{n}] = {mem}[{addr}[0]][{n}]{mask};'.format(
                     dest=self.varname[dest], n=n, mem=self.varname[mem],
                     addr=self.varname[args[0]], mask=self._makemask(dest, mem.bitwidth, n)))
@@ -485,6 +1185,11 @@ class CompiledSimulation(object):
         write('{dest}[0] = {cond};'.format(dest=self.varname[dest], cond='&&'.join(cond)))
 
     def _build_cmp(self, write, op, param, args, dest):  # <, > only
+        if max(self._limbs(args[0]), self._limbs(args[1])) == 2:
+            write('{dest}[0] = {arg0}{op}{arg1};'.format(
+                dest=self.varname[dest], op=op,
+                arg0=self._getarg128(args[0]), arg1=self._getarg128(args[1])))
+            return
         cond = None
         for n in range(max(self._limbs(args[0]), self._limbs(args[1]))):
             arg0 = self._getarglimb(args[0], n)
@@ -510,19 +1215,49 @@ class CompiledSimulation(object):
                 mask=self._makemask(dest, args[1].bitwidth, n)))
         write('}')
 
+    def _getarg128(self, arg):
+        """Get the value of a wire of at most 128 bits as an unsigned __int128."""
+        if self._limbs(arg) == 1:
+            return '(u128){vn}[0]'.format(vn=self.varname[arg])
+        return '((u128){vn}[1]<<64|{vn}[0])'.format(vn=self.varname[arg])
+
+    def _build_arith128(self, write, op, args, dest, res):
+        """Compute +, - or * with unsigned __int128, when no wire is over 128 bits.
+
+        Returns False, writing nothing, if some wire is wider.  With a single limb
+        of result, plain 64-bit arithmetic gives the same low bits.
+        """
+        if max(self._limbs(dest), self._limbs(args[0]), self._limbs(args[1])) > 2:
+            return False
+        if self._limbs(dest) == 1:
+            write('{dest}[0] = ({arg0}{op}{arg1}){mask};'.format(
+                dest=self.varname[dest], op=op, mask=self._makemask(dest, res, 0),
+                arg0=self._getarglimb(args[0], 0), arg1=self._getarglimb(args[1], 0)))
+            return True
+        write('tmp128 = {arg0}{op}{arg1};'.format(
+            op=op, arg0=self._getarg128(args[0]), arg1=self._getarg128(args[1])))
+        write('{dest}[0] = (uint64_t)tmp128;'.format(dest=self.varname[dest]))
+        write('{dest}[1] = (uint64_t)(tmp128>>64){mask};'.format(
+            dest=self.varname[dest], mask=self._makemask(dest, res, 1)))
+        return True
+
     def _build_add(self, write, op, param, args, dest):
+        res = max(args[0].bitwidth, args[1].bitwidth) + 1
+        if self._build_arith128(write, '+', args, dest, res):
+            return
         write('carry = 0;')
         for n in range(self._limbs(dest)):
             arg0 = self._getarglimb(args[0], n)
             arg1 = self._getarglimb(args[1], n)
             write('tmp = {arg0}+{arg1};'.format(arg0=arg0, arg1=arg1))
             write('{dest}[{n}] = (tmp + carry){mask};'.format(
-                dest=self.varname[dest], n=n,
-                mask=self._makemask(dest, max(args[0].bitwidth, args[1].bitwidth) + 1, n)))
+                dest=self.varname[dest], n=n, mask=self._makemask(dest, res, n)))
             write('carry = (tmp < {arg0})|({dest}[{n}] < tmp);'.format(
                 arg0=arg0, dest=self.varname[dest], n=n))
 
     def _build_sub(self, write, op, param, args, dest):
+        if self._build_arith128(write, '-', args, dest, None):
+            return
         write('carry = 0;')
         for n in range(self._limbs(dest)):
             arg0 = self._getarglimb(args[0], n)
@@ -534,6 +1269,9 @@ class CompiledSimulation(object):
                 arg0=arg0, dest=self.varname[dest], n=n))
 
     def _build_mul(self, write, op, param, args, dest):
+        res = args[0].bitwidth + args[1].bitwidth
+        if self._build_arith128(write, '*', args, dest, res):
+            return
         for n in range(self._limbs(dest)):
             write('{dest}[{n}] = 0;'.format(dest=self.varname[dest], n=n))
         for p0 in range(self._limbs(args[0])):
@@ -543,18 +1281,18 @@ class CompiledSimulation(object):
                 if self._limbs(dest) <= p0 + p1:
                     break
                 arg1 = self._getarglimb(args[1], p1)
-                write('mul128({arg0}, {arg1}, tmplo, tmphi);'.format(arg0=arg0, arg1=arg1))
+                write('tmp128 = (u128){arg0}*{arg1};'.format(arg0=arg0, arg1=arg1))
+                write('tmplo = (uint64_t)tmp128; tmphi = (uint64_t)(tmp128>>64);')
                 write('tmp = {dest}[{p}];'.format(dest=self.varname[dest], p=p0 + p1))
                 write('tmplo += carry; carry = tmplo < carry; tmplo += tmp;')
                 write('tmphi += carry + (tmplo < tmp); carry = tmphi;')
                 write('{dest}[{p}] = tmplo{mask};'.format(
                     dest=self.varname[dest], p=p0 + p1,
-                    mask=self._makemask(dest, args[0].bitwidth + args[1].bitwidth, p0 + p1)))
+                    mask=self._makemask(dest, res, p0 + p1)))
             if self._limbs(dest) > p0 + self._limbs(args[1]):
                 write('{dest}[{p}] = carry{mask};'.format(
                     dest=self.varname[dest], p=p0 + self._limbs(args[1]),
-                    mask=self._makemask(
-                        dest, args[0].bitwidth + args[1].bitwidth, p0 + self._limbs(args[1]))))
+                    mask=self._makemask(dest, res, p0 + self._limbs(args[1]))))
 
     def _build_concat(self, write, op, param, args, dest):
         cattotal = sum(x.bitwidth for x in args)
@@ -570,11 +1308,12 @@ class CompiledSimulation(object):
                 res.append('(({arg}[{limb}]>>{start})<<{pos})'.format(
                     arg=arg, limb=alimb, start=astart, pos=dpos))
                 dpos += asize
-                if dpos >= dest.bitwidth - 64 * n:
-                    break
                 if dpos > 64:
+                    # the rest of this piece starts the next limb
                     curr = (arg, alimb, 64 - (dpos - asize), dpos - 64)
                     break
+                if dpos >= dest.bitwidth - 64 * n:
+                    break
                 curr = next(pieces)
                 if dpos == 64:
                     break
@@ -591,8 +1330,8 @@ class CompiledSimulation(object):
             write('{dest}[{n}] = {bits};'.format(
                 dest=self.varname[dest], n=n, bits='|'.join(bits)))
 
-    def _declare_mem_helpers(self, write):
-        helpers = '''
+    def _declare_mem_helpers(self, declare, write):
+        types = '''
             typedef uint64_t val_t;
 
             typedef struct node
@@ -610,6 +1349,10 @@ class CompiledSimulation(object):
                 node_t **list;
             } hashmap_t;
 
+            val_t* lookup(hashmap_t *h, uint64_t key);
+        '''
+        declare(types)
+        helpers = '''
             hashmap_t *create_hash_map(int size, int val_limbs)
             {
                 int i;
@@ -630,6 +1373,7 @@ class CompiledSimulation(object):
                 return key % h->size;
             }
 
+            EXPORT
             void insert(hashmap_t *h, uint64_t key, val_t val[])
             {
                 int pos = hash_code(h, key);
@@ -668,35 +1412,191 @@ class CompiledSimulation(object):
                 }
                 return h->default_value;
             }
+
+            EXPORT
+            void clear_hash_map(hashmap_t *h)
+            {
+                int i;
+                for (i = 0; i < h->size; i++)
+                {
+                    node_t *temp = h->list[i];
+                    while (temp)
+                    {
+                        node_t *next = temp->next;
+                        free(temp->val);
+                        free(temp);
+                        temp = next;
+                    }
+                    h->list[i] = NULL;
+                }
+            }
+
+            void free_hash_map(hashmap_t *h)
+            {
+                clear_hash_map(h);
+                free(h->list);
+                free(h->default_value);
+                free(h);
+            }
+
+            EXPORT
+            uint64_t hash_map_count(hashmap_t *h)
+            {
+                int i;
+                uint64_t count = 0;
+                node_t *temp;
+                for (i = 0; i < h->size; i++)
+                    for (temp = h->list[i]; temp; temp = temp->next)
+                        count++;
+                return count;
+            }
+
+            EXPORT
+            void hash_map_dump(hashmap_t *h, uint64_t keys[], val_t vals[])
+            {
+                int i;
+                uint64_t n = 0;
+                node_t *temp;
+                for (i = 0; i < h->size; i++)
+                    for (temp = h->list[i]; temp; temp = temp->next)
+                    {
+                        keys[n] = temp->key;
+                        memcpy(vals + n * h->val_limbs, temp->val, sizeof(val_t) * h->val_limbs);
+                        n++;
+                    }
+            }
         '''
         write(helpers)
 
-    def _create_code(self, write):
-        write('#include <stdint.h>')
-        write('#include <stdlib.h>')
-        write('#include <string.h>')
+    def _declare_activity(self, field, write):
+        """Declare the toggle counts, and the function adding the toggles of one limb."""
+        act = self.activity
+        field('act_prev', 'uint64_t act_prev[{}];'.format(
+            max(sum(self._limbs(w) for w in act.wires), 1)))
+        field('act_counts', 'uint64_t act_counts[{}];'.format(max(len(act._counts), 1)))
+        field('act_high', 'int64_t act_high[{}];'.format(max(len(act._high), 1)))
+        field('act_cycle', 'int64_t act_cycle[1];')
+        # see ToggleActivity for how the time spent at 1 is kept
+        write('''
+            static void act_toggled(state_t *s, uint64_t changed, uint64_t value, uint64_t bit)
+            {
+                while (changed)
+                {
+                    int b = __builtin_ctzll(changed);
+                    if (s->act_cycle[0])
+                        s->act_counts[bit + b]++;
+                    s->act_high[bit + b] += ((value >> b) & 1) ? -s->act_cycle[0] : s->act_cycle[0];
+                    changed &= changed - 1;
+                }
+            }
+        ''')
+
+    def _build_activity(self, write):
+        """Count the toggles of the cycle, comparing each limb with its previous value."""
+        act = self.activity
+        write('uint64_t act_changed;')
+        for i, w in enumerate(act.wires):
+            for n in range(self._limbs(w)):
+                write('act_changed = {vn}[{n}] ^ s->act_prev[{pos}];'.format(
+                    vn=self.varname[w], n=n, pos=act._offset[i] + n))
+                write('if (act_changed) {{ s->act_prev[{pos}] = {vn}[{n}]; '
+                      'act_toggled(s, act_changed, {vn}[{n}], {bit}); }}'.format(
+                          pos=act._offset[i] + n, vn=self.varname[w], n=n,
+                          bit=act._base[i] + 64 * n))
+        write('s->act_cycle[0]++;')
+
+    def _local_wires(self, functions):
+        """The wires that can be locals of the function computing them.
+
+        :param functions: the lists of nets computed by each function, in order
+        :return: a dictionary mapping those wires to the index of their function
+
+        These are the wires only read by the function computing them, and not by
+        sim_run_step, which reads the wires that are traced, counted, written to
+        registers or memories, output, or asserted.
+        """
+        function_of = {}
+        for x, nets in enumerate(functions):
+            for net in nets:
+                function_of[net.dests[0]] = x
+        shared = set(self.block.wirevector_subset(Output))
+        if self.tracer is not None:
+            shared.update(self.tracer.wires_to_track)
+        if self.activity is not None:
+            shared.update(self.activity.wires)
+        shared.update(self.block.wirevector_by_name[name]
+                      for name in _assertion_names(self.block))
+        for net in self.block.logic_subset('r@'):
+            shared.update(net.args)
+        for x, nets in enumerate(functions):
+            for net in nets:
+                shared.update(a for a in net.args if function_of.get(a) != x)
+        return {w: x for w, x in function_of.items() if w not in shared}
+
+    def _ordered_logic(self):
+        """The combinational nets in a topological order that is the same on every run.
+
+        Unlike iterating over the block, ties are broken by the name of the net's
+        destination, which keeps the generated code deterministic.
+        """
+        src_dict, dest_dict = self.block.net_connections()
+        comb = [net for net in self.block.logic if net.op not in 'r@']
+        waiting = {}
+        ready = []
+        for net in comb:
+            waiting[net] = len({a for a in net.args if a in src_dict and src_dict[a].op != 'r'})
+            if not waiting[net]:
+                heapq.heappush(ready, (net.dests[0].name, net))
+        ordered = []
+        while ready:
+            _, net = heapq.heappop(ready)
+            ordered.append(net)
+            for reader in set(dest_dict.get(net.dests[0], ())):
+                if reader in waiting:
+                    waiting[reader] -= 1
+                    if not waiting[reader]:
+                        heapq.heappush(ready, (reader.dests[0].name, reader))
+        if len(ordered) != len(comb):
+            raise PyrtlError('Failure in CompiledSimulation due to non-register loops')
+        return ordered
+
+    def _create_code(self):
+        """Generate the C code of the simulation.
+
+        :return: a list of pairs of a file name and its code, starting with the main C
+          file.  If the logic is sharded, it is followed by the header pyrtlsim.h and
+          the C files of the other shards; otherwise the header is at the top of the
+          main file.
+        """
+        header, main = [], []
+        declare, write = header.append, main.append
+        declare('#include <stddef.h>')
+        declare('#include <stdint.h>')
+        declare('#include <stdlib.h>')
+        declare('#include <string.h>')
 
         # windows dllexport needed to make symbols visible
         if platform.system() == 'Windows':
-            write('#define EXPORT __declspec(dllexport)')
+            declare('#define EXPORT __declspec(dllexport)')
+            declare('#define HIDDEN')
         else:
-            write('#define EXPORT')
-
-        # multiplication macro
-        #  for efficient 64x64 -> 128 bit multiplication without uint128_t
-        #  as -O0 optimization does not handle uint128_t well
-        machine_alias = {'amd64': 'x86_64', 'aarch64': 'arm64', 'aarch64_be': 'arm64'}
-        machine = platform.machine().lower()
-        machine = machine_alias.get(machine, machine)
-        mulinstr = {
-            'x86_64': '"mulq %q3":"=a"(pl),"=d"(ph):"%0"(t0),"r"(t1):"cc"',
-            'arm64': '"mul %0, %2, %3\n\tumulh %1, %2, %3":'
-                     '"=&r"(*pl),"=r"(*ph):"r"(t0),"r"(t1):"cc"',
-            'mips64': '"dmultu %2, %3\n\tmflo %0\n\tmfhi %1":'
-                      '"=r"(*pl),"=r"(*ph):"r"(t0),"r"(t1)',
-        }
-        if machine in mulinstr:
-            write('#define mul128(t0, t1, pl, ph) __asm__({})'.format(mulinstr[machine]))
+            declare('#define EXPORT')
+            # kept out of the dynamic symbol table, so -fPIC code accesses them directly
+            declare('#define HIDDEN __attribute__((visibility("hidden")))')
+
+        # 128 bit arithmetic, and the 64x64 -> 128 bit products of wider multiplication
+        declare('typedef unsigned __int128 u128;')
+
+        # the state of the simulation, in the order of the members of state_t
+        self._state_fields = []
+        self._field = {}  # mapping from registers and memories to their members of state_t
+        fields = []
+
+        def field(name, declaration):
+            self._state_fields.append(name)
+            fields.append(declaration)
+        # 1 + the index of the first failing assertion, if any
+        field('assert_failed', 'uint64_t assert_failed;')
 
         # declare memories
         mems = {net.op_param[1] for net in self.block.logic_subset('m@')}
@@ -705,34 +1605,50 @@ class CompiledSimulation(object):
                 raise PyrtlError('unrecognized MemBlock in memory_value_map')
             if isinstance(key, RomBlock):
                 raise PyrtlError('RomBlock in memory_value_map')
-        self._declare_mem_helpers(write)
-        roms = {mem for mem in mems if isinstance(mem, RomBlock)}
-        self._declare_roms(write, roms)
-        mems = {mem for mem in mems if isinstance(mem, MemBlock)}
-        self._declare_mems(write, mems)
-
-        # single step function
-        write('static void sim_run_step(uint64_t inputs[], uint64_t outputs[]) {')
-        write('uint64_t tmp, carry, tmphi, tmplo;')  # temporary variables
+        self._declare_mem_helpers(declare, write)
+        # everything is emitted in a stable order so that the code (and so its
+        # compile cache entry) is the same every time the design is simulated
+        mems = sorted(mems, key=lambda m: m.name)
+        roms = [mem for mem in mems if isinstance(mem, RomBlock)]
+        self._declare_roms(declare, write, roms)
+        mems = [mem for mem in mems if isinstance(mem, MemBlock)]
+        self._declare_dense_mems(
+            field, [mem for mem in mems if mem.addrwidth <= self._dense_mem_addrwidth])
+        self._declare_mems(
+            field, write, [mem for mem in mems if mem.addrwidth > self._dense_mem_addrwidth])
+
+        # the combinational logic is computed by functions of a bounded size
+        logic = self._ordered_logic()
+        size = self._nets_per_function
+        functions = [logic[x:x + size] for x in range(0, len(logic), size)]
+        local = self._local_wires(functions)
+        locals_of = [[] for _ in functions]
+
+        # declare wire vectors; those used by more than one function are part of the
+        # state rather than on the stack, so that the functions can share them
+        for w in sorted(self.block.wirevector_set, key=lambda w: w.name):
+            if w in local:
+                self.varname[w] = self._clean_name('w', w)
+                locals_of[local[w]].append(w)
+            else:
+                self._declare_wv(declare, field, w)
 
-        # declare wire vectors
-        for w in self.block.wirevector_set:
-            self._declare_wv(write, w)
+        if self.activity is not None:
+            self._declare_activity(field, write)
 
-        # inputs copied in
-        inputs = list(self.block.wirevector_subset(Input))
-        self._inputpos = {}  # for each input wire, start and number of elements in input array
-        self._inputbw = {}  # bitwidth of each input wire
-        ipos = 0
-        for w in inputs:
-            self._inputpos[w.name] = ipos, self._limbs(w)
-            self._inputbw[w.name] = w.bitwidth
-            for n in range(self._limbs(w)):
-                write('{vn}[{n}] = inputs[{pos}];'.format(vn=self.varname[w], n=n, pos=ipos))
-                ipos += 1
-        self._ibufsz = ipos  # total length of input array
+        # the state lives in memory allocated by the caller (see _new_state), so that
+        # any number of simulations can share the library
+        declare('typedef struct {')
+        for declaration in fields:
+            declare(declaration)
+        declare('} state_t;')
+        write('EXPORT')
+        write('const uint64_t state_size = sizeof(state_t);')
+        write('EXPORT')
+        write('const uint64_t state_offsets[] = {{{}}};'.format(
+            ', '.join('offsetof(state_t, {})'.format(name) for name in self._state_fields)))
 
-        # combinational logic
+        # combinational logic, in functions of a bounded size spread over the shards
         op_builders = {
             'm': self._build_memread,
             'w': self._build_wire,
@@ -751,27 +1667,87 @@ class CompiledSimulation(object):
             'c': self._build_concat,
             's': self._build_select,
         }
-        for net in self.block:  # topological order
-            if net.op in 'r@':
-                continue  # skip synchronized nets
-            op, param, args, dest = net.op, net.op_param, net.args, net.dests[0]
-            write('// net {op} : {args} -> {dest}'.format(
-                op=op, args=', '.join(self.varname[x] for x in args), dest=self.varname[dest]))
-            op_builders[op](write, op, param, args, dest)
+        shards = self._shards
+        if shards is None:
+            shards = min(multiprocessing.cpu_count(),
+                         (len(logic) + self._nets_per_shard - 1) // self._nets_per_shard)
+        shards = max(1, min(shards, len(functions)))
+        shard_code = [main] + [[] for _ in range(shards - 1)]
+        for x, nets in enumerate(functions):
+            declare('HIDDEN void sim_logic_{}(state_t *s);'.format(x))
+            write_logic = shard_code[x * shards // len(functions)].append
+            write_logic('HIDDEN void sim_logic_{}(state_t *s) {{'.format(x))
+            write_logic('uint64_t tmp, carry, tmphi, tmplo;')  # temporary variables
+            write_logic('u128 tmp128;')
+            for w in locals_of[x]:
+                write_logic('uint64_t {name}[{limbs}];'.format(
+                    name=self.varname[w], limbs=self._limbs(w)))
+            for net in nets:
+                op, param, args, dest = net.op, net.op_param, net.args, net.dests[0]
+                write_logic('// net {op} : {args} -> {dest}'.format(
+                    op=op, args=', '.join(self.varname[a] for a in args),
+                    dest=self.varname[dest]))
+                op_builders[op](write_logic, op, param, args, dest)
+            write_logic('}')
+
+        # single step function, returning 1 + the index of the first failing assertion
+        write('static int sim_run_step(state_t *s, uint64_t inputs[], uint64_t outputs[], '
+              'uint64_t traces[]) {')
+
+        # inputs copied in
+        inputs = sorted(self.block.wirevector_subset(Input), key=lambda w: w.name)
+        self._inputpos = {}  # for each input wire, start and number of elements in input array
+        self._inputbw = {}  # bitwidth of each input wire
+        ipos = 0
+        for w in inputs:
+            self._inputpos[w.name] = ipos, self._limbs(w)
+            self._inputbw[w.name] = w.bitwidth
+            for n in range(self._limbs(w)):
+                write('{vn}[{n}] = inputs[{pos}];'.format(vn=self.varname[w], n=n, pos=ipos))
+                ipos += 1
+        self._ibufsz = ipos  # total length of input array
+        self._input_order = [w.name for w in inputs]
+
+        for x in range(len(functions)):
+            write('sim_logic_{}(s);'.format(x))
+
+        # internal traced wires copied out, before registers take their next values
+        tracked = self.tracer.wires_to_track if self.tracer is not None else ()
+        traced = sorted((w for w in tracked if not isinstance(w, (Input, Output))),
+                        key=lambda w: w.name)
+        self._tracepos = {}  # for each internal traced wire, start and number of elements
+        tpos = 0
+        for w in traced:
+            self._tracepos[w.name] = tpos, self._limbs(w)
+            for n in range(self._limbs(w)):
+                write('traces[{pos}] = {vn}[{n}];'.format(pos=tpos, vn=self.varname[w], n=n))
+                tpos += 1
+        self._tbufsz = tpos  # total length of trace array
+
+        # toggles counted, also before registers take their next values
+        if self.activity is not None:
+            self._build_activity(write)
 
         # memory writes
-        for net in self.block.logic_subset('@'):
+        for net in sorted(self.block.logic_subset('@'),
+                          key=lambda n: tuple(a.name for a in n.args)):
             mem = net.op_param[1]
             write('if ({enable}[0]) {{'.format(enable=self.varname[net.args[2]]))
-            write('insert({mem}, {addr}[0], {vn});'.format(
-                mem=self.varname[mem],
-                addr=self.varname[net.args[0]],
-                vn=self.varname[net.args[1]]
-            ))
+            if mem in self._dense_mems:
+                for n in range(self._limbs(mem)):
+                    write('{mem}[{addr}[0]][{n}] = {vn}[{n}];'.format(
+                        mem=self.varname[mem], addr=self.varname[net.args[0]],
+                        vn=self.varname[net.args[1]], n=n))
+            else:
+                write('insert({mem}, {addr}[0], {vn});'.format(
+                    mem=self.varname[mem],
+                    addr=self.varname[net.args[0]],
+                    vn=self.varname[net.args[1]]
+                ))
             write('}')
 
         # register updates
-        regnets = list(self.block.logic_subset('r'))
+        regnets = sorted(self.block.logic_subset('r'), key=lambda n: n.dests[0].name)
         for x, net in enumerate(regnets):
             rin = net.args[0]
             write('uint64_t regtmp{x}[{limbs}];'.format(x=x, limbs=self._limbs(rin)))
@@ -784,7 +1760,7 @@ class CompiledSimulation(object):
                 write('{vn}[{n}] = regtmp{x}[{n}];'.format(vn=self.varname[rout], x=x, n=n))
 
         # output copied out
-        outputs = list(self.block.wirevector_subset(Output))
+        outputs = sorted(self.block.wirevector_subset(Output), key=lambda w: w.name)
         self._outputpos = {}  # for each output wire, start and number of elements in output array
         opos = 0
         for w in outputs:
@@ -793,27 +1769,115 @@ class CompiledSimulation(object):
                 write('outputs[{pos}] = {vn}[{n}];'.format(pos=opos, vn=self.varname[w], n=n))
                 opos += 1
         self._obufsz = opos  # total length of output array
+
+        # assertions checked once the cycle is complete
+        for x, name in enumerate(_assertion_names(self.block)):
+            w = self.block.wirevector_by_name[name]
+            write('if (!{vn}[0]) return {x};'.format(vn=self.varname[w], x=x + 1))
+        write('return 0;')
         write('}')
 
-        # entry point
+        # the entry points return the number of steps run, which is fewer than
+        # stepcount if an assertion failed; assert_failed then says which one
+        stop = self.block.rtl_assert_dict and 'if (s->assert_failed) return stepnum + 1;'
         write('EXPORT')
-        write('void sim_run_all(uint64_t stepcount, uint64_t inputs[], uint64_t outputs[]) {')
+        write('uint64_t sim_run_all(state_t *s, uint64_t stepcount, uint64_t inputs[], '
+              'uint64_t outputs[], uint64_t traces[], uint64_t trace_pos, uint64_t trace_len) {')
         write('uint64_t input_pos = 0, output_pos = 0;')
+        write('s->assert_failed = 0;')
         write('for (uint64_t stepnum = 0; stepnum < stepcount; stepnum++) {')
-        write('sim_run_step(inputs+input_pos, outputs+output_pos);')
+        write('s->assert_failed = sim_run_step(s, inputs+input_pos, outputs+output_pos, '
+              'traces+trace_pos*{});'.format(self._tbufsz))
         write('input_pos += {};'.format(self._ibufsz))
         write('output_pos += {};'.format(self._obufsz))
-        write('}}')
+        write('if (++trace_pos == trace_len) trace_pos = 0;')  # wrap around in ring mode
+        if stop:
+            write(stop)
+        write('}')
+        write('return stepcount;')
+        write('}')
+
+        # entry point for columnar inputs, one array of values per input wire
+        write('EXPORT')
+        write('uint64_t sim_run_columns(state_t *s, uint64_t stepcount, uint64_t *columns[], '
+              'uint64_t outputs[], uint64_t traces[], uint64_t trace_pos, uint64_t trace_len) {')
+        write('uint64_t inputs[{}];'.format(max(self._ibufsz, 1)))
+        write('uint64_t output_pos = 0;')
+        write('s->assert_failed = 0;')
+        write('for (uint64_t stepnum = 0; stepnum < stepcount; stepnum++) {')
+        for x, name in enumerate(self._input_order):
+            start, count = self._inputpos[name]
+            for n in range(count):
+                write('inputs[{pos}] = columns[{x}][stepnum*{count}+{n}];'.format(
+                    pos=start + n, x=x, count=count, n=n))
+        write('s->assert_failed = sim_run_step(s, inputs, outputs+output_pos, '
+              'traces+trace_pos*{});'.format(self._tbufsz))
+        write('output_pos += {};'.format(self._obufsz))
+        write('if (++trace_pos == trace_len) trace_pos = 0;')
+        if stop:
+            write(stop)
+        write('}')
+        write('return stepcount;')
+        write('}')
+
+        if shards == 1:
+            return [('pyrtlsim.c', '\n'.join(header + main) + '\n')]
+        include = '#include "pyrtlsim.h"'
+        files = [('pyrtlsim.c', '\n'.join([include] + main) + '\n'),
+                 ('pyrtlsim.h', '\n'.join(header) + '\n')]
+        for x, code in enumerate(shard_code[1:]):
+            files.append(('pyrtlsim{}.c'.format(x + 1), '\n'.join([include] + code) + '\n'))
+        return files
 
     def __del__(self):
-        """Handle removal of the DLL when the simulator is deleted."""
-        if self._dll is not None:
-            handle = self._dll._handle
-            if platform.system() == 'Windows':
-                _ctypes.FreeLibrary(handle)  # pylint: disable=no-member
-            else:
-                _ctypes.dlclose(handle)  # pylint: disable=no-member
-            self._dll = None
-        if self._dir is not None:
-            shutil.rmtree(self._dir)
-            self._dir = None
+        """Free the memories of the simulation, and its library once no simulation uses it."""
+        if self._state is not None:
+            self._lib.free_mems(self._state)
+            self._state = None
+        self._lib = None
+
+
+def _owned_privately(st):
+    """True if the file with the given stat is the current user's, and only theirs to write."""
+    if not hasattr(os, 'getuid'):
+        return True  # there is no ownership to check, as on Windows
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+class _CompiledLibrary(object):
+    """A loaded simulation library, which any number of CompiledSimulations can share.
+
+    The library keeps no state of its own: each simulation passes the compiled code
+    a state_t struct that it allocated itself (see CompiledSimulation._new_state).
+    """
+
+    def __init__(self, libdir, libpath, fields):
+        self.dir = libdir
+        self.dll = ctypes.CDLL(libpath)
+        c_void_p, c_uint64 = ctypes.c_void_p, ctypes.c_uint64
+        run_args = [c_void_p, c_uint64, c_void_p, c_void_p, c_void_p, c_uint64, c_uint64]
+        # set up once, so that simulations on different threads never modify them
+        for name, restype, argtypes in [
+                ('sim_run_all', c_uint64, run_args),
+                ('sim_run_columns', c_uint64, run_args),
+                ('initialize_mems', None, [c_void_p]),
+                ('free_mems', None, [c_void_p]),
+                ('lookup', ctypes.POINTER(c_uint64), [c_void_p, c_uint64]),
+                ('insert', None, [c_void_p, c_uint64, c_void_p]),
+                ('clear_hash_map', None, [c_void_p]),
+                ('hash_map_count', c_uint64, [c_void_p]),
+                ('hash_map_dump', None, [c_void_p, c_void_p, c_void_p])]:
+            func = getattr(self.dll, name)
+            func.restype, func.argtypes = restype, argtypes
+            setattr(self, name, func)
+        self.state_size = c_uint64.in_dll(self.dll, 'state_size').value
+        self.offsets = dict(zip(fields, (c_uint64 * len(fields)).in_dll(self.dll, 'state_offsets')))
+
+    def __del__(self):
+        """Unload the library and remove its directory."""
+        handle = self.dll._handle
+        if platform.system() == 'Windows':
+            _ctypes.FreeLibrary(handle)  # pylint: disable=no-member
+        else:
+            _ctypes.dlclose(handle)  # pylint: disable=no-member
+        shutil.rmtree(self.dir)
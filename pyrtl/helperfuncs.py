@@ -69,7 +69,10 @@ def rtl_assert(w, exp, block=None):
     :return: the Output wire for the assertion (can be ignored in most cases)
 
     If at any time during execution the wire w is not `true` (i.e. asserted low)
-    then simulation will raise exp.
+    then simulation will raise exp.  The simulators record the cycle in which the
+    assertion failed, counted from 0 since the simulation was created or reset, in
+    the cycle attribute of exp.  FastSimulation and CompiledSimulation check the
+    assertions inside their generated code, so step_multiple stops at that cycle.
     """
     block = working_block(block)
 
@@ -95,10 +98,12 @@ def rtl_assert(w, exp, block=None):
     return assert_wire
 
 
-def check_rtl_assertions(sim):
+def check_rtl_assertions(sim, cycle=None):
     """ Checks the values in sim to see if any registers assertions fail.
 
     :param sim: Simulation in which to check the assertions
+    :param cycle: if given, the cycle being checked, which is stored in the
+        cycle attribute of the exception raised
     :return: None
     """
 
@@ -106,6 +111,8 @@ def check_rtl_assertions(sim):
         try:
             value = sim.inspect(w)
             if not value:
+                if cycle is not None:
+                    exp.cycle = cycle
                 raise exp
         except KeyError:
             pass
@@ -8,6 +8,7 @@ accordingly, or write information from the Block out to the file.
 
 from __future__ import print_function, unicode_literals
 import re
+import itertools
 import collections
 
 from .pyrtlexceptions import PyrtlError, PyrtlInternalError
@@ -748,3 +749,140 @@ def trace_to_html(simtrace, trace_list=None, sortkey=None):
     wave = wave_template % all_signals
     # print(wave)
     return wave
+
+
+def trace_from_vcd(vcd_file, wires=None, block=None, storage='compact', path=None, period=10):
+    """ Read the waveforms of a VCD file into a SimulationTrace.
+
+    :param vcd_file: an open VCD file, or the name of one
+    :param wires: the names of the wires to load (defaults to all of them)
+    :param block: the block of the design the VCD was dumped from.  If given, the
+      names in the VCD are mapped back to the wires of the block, undoing the
+      sanitization done by SimulationTrace.print_vcd (using the real names it
+      records in comments), and any signals that are not wires of the block are
+      skipped.  Otherwise the trace holds stand-in
+      WireVectors (in a block of their own) named after the signals in the VCD,
+      with the outermost scope left off the name (and the implicit clk skipped).
+    :param storage: how the trace stores the values, see SimulationTrace
+      (defaults to 'compact')
+    :param path: the directory to store the trace in, with storage='disk'
+    :param period: the time between cycles.  The value of a wire in cycle n is
+      its value at time n * period, which matches the VCDs written by PyRTL.
+    :return: a SimulationTrace holding the values of each wire on every cycle
+
+    The file is read a line at a time, and only the current value of each signal
+    is held aside from the trace itself, so even very large files can be read
+    using 'compact' or 'disk' storage.  Bits that are x or z are read as 0.
+    """
+    from .core import Block
+    from .simulation import SimulationTrace
+
+    if not hasattr(vcd_file, 'read'):
+        with open(vcd_file) as f:
+            return trace_from_vcd(f, wires, block, storage, path, period)
+
+    lines = iter(vcd_file)
+
+    # read the declarations of the signals, up to $enddefinitions
+    scopes, signals = [], []  # signals are (identifier code, name, bitwidth)
+    real_names = {}  # the wire names of sanitized signals, from print_vcd's comments
+    tokens = []
+    for line in lines:
+        tokens.extend(line.split())
+        if not tokens or tokens[-1] != '$end':
+            continue
+        keyword, args = tokens[0], tokens[1:-1]
+        tokens = []
+        if keyword == '$scope':
+            scopes.append(args[-1])
+        elif keyword == '$upscope':
+            scopes.pop()
+        elif keyword == '$var':
+            signals.append((args[2], '.'.join(scopes[1:] + [args[3]]), int(args[1])))
+        elif keyword == '$comment' and args[:1] == ['pyrtl_name'] and len(args) > 2:
+            real_names[args[1]] = ' '.join(args[2:])
+        elif keyword == '$enddefinitions':
+            break
+    else:
+        raise PyrtlError('no $enddefinitions found in the VCD')
+
+    if block is not None:
+        by_name = block.wirevector_by_name
+        signals = [(code, real_names.get(name, name), bitwidth)
+                   for code, name, bitwidth in signals]
+        signals = [(code, name, by_name[name].bitwidth)
+                   for code, name, _ in signals if name in by_name]
+    else:
+        # the implicit clock (see print_vcd's include_clock) cannot be a wire
+        signals = [s for s in signals if s[1] != 'clk']
+    if wires is not None:
+        wires = set(getattr(w, 'name', w) for w in wires)
+        missing = wires - set(name for _, name, _ in signals)
+        if missing:
+            raise PyrtlError('wires %s are not in the VCD' % sorted(missing))
+        signals = [s for s in signals if s[1] in wires]
+    if not signals:
+        raise PyrtlError('none of the signals of the VCD can be loaded')
+
+    if block is None:
+        block = Block()
+        tracked = [WireVector(bitwidth=bitwidth, name=name, block=block)
+                   for _, name, bitwidth in signals]
+    else:
+        tracked = [block.wirevector_by_name[name] for _, name, _ in signals]
+    trace = SimulationTrace(wires_to_track=tracked, block=block, storage=storage, path=path)
+
+    # several signals can share an identifier code
+    targets = collections.defaultdict(list)
+    for n, (code, _, _) in enumerate(signals):
+        targets[code].append(n)
+    columns = [trace.trace[w.name] for w in tracked]
+    current = [0] * len(signals)  # the value of each signal at the current time
+    filled = [0] * len(signals)  # the number of cycles added to the trace of each signal
+    cycle = 0  # the cycles that start before the current time
+    last_time = last_change = 0
+
+    def change(n, value):
+        """ Change a value, adding the run of cycles that had the old value. """
+        if filled[n] < cycle:
+            columns[n].extend(itertools.repeat(current[n], cycle - filled[n]))
+            filled[n] = cycle
+        current[n] = value
+
+    def parse(text):
+        try:
+            return int(text, 2)
+        except ValueError:
+            return int(re.sub('[xzXZ]', '0', text), 2)
+
+    in_comment = False
+    for line in lines:
+        words = line.split()
+        i = 0
+        while i < len(words):
+            word = words[i]
+            first = word[0]
+            if in_comment:
+                in_comment = word != '$end'
+            elif first == '#':
+                last_time = int(word[1:])
+                cycle = -(-last_time // period)
+            elif first in 'bB':
+                i += 1
+                for n in targets.get(words[i], ()):
+                    change(n, parse(word[1:]))
+                    last_change = last_time
+            elif first in '01xzXZ':
+                for n in targets.get(word[1:], ()):
+                    change(n, parse(first))
+                    last_change = last_time
+            elif first in 'rR':
+                i += 1  # real values are not supported, and are skipped
+            elif word == '$comment':
+                in_comment = True
+            i += 1
+
+    cycle = max(-(-last_time // period), last_change // period + 1)
+    for n in range(len(columns)):
+        change(n, None)
+    return trace
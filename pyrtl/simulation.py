@@ -3,12 +3,26 @@
 from __future__ import print_function, unicode_literals
 
 import sys
+import os
 import re
+import copy
+import json
+import array
+import bisect
+import struct
+import tempfile
+import threading
+import timeit
+import heapq
 import numbers
+import operator
+import itertools
 import collections
+import six
+from six.moves import queue
 
 from .pyrtlexceptions import PyrtlError, PyrtlInternalError
-from .core import working_block, PostSynthBlock, _PythonSanitizer
+from .core import working_block, Block, PostSynthBlock, _PythonSanitizer
 from .wire import Input, Register, Const, Output, WireVector
 from .memory import RomBlock
 from .helperfuncs import check_rtl_assertions, _currently_in_jupyter_notebook
@@ -32,6 +46,17 @@ class Simulation(object):
     * *.value*: a map from every signal in the block to its current simulation value
     * *.regvalue*: a map from register to its value on the next tick
     * *.memvalue*: a map from memid to a dictionary of address: value
+    * *.skipped_nets*: when event driven, the number of net evaluations avoided so far
+    * *.profile*: when profiling, the SimulationProfile of the nets evaluated so far
+
+    Internally every wire is given an integer slot in a flat list of values,
+    and every combinational net is turned into a small function with its
+    argument slots, op, and mask bound ahead of time (see _net_function).
+    *.slot* maps each wire to its slot and *.net_functions* holds the
+    (net, destination slot, function) triple of each net in the order it
+    is evaluated, which is useful when stepping through a simulation by hand.
+    Ops overridden in *simple_func* by a subclass, and a subclass's own
+    _sanitize, are still used by those functions.
     """
 
     simple_func = {  # OPS
@@ -49,10 +74,11 @@ class Simulation(object):
         '=': lambda l, r: int(l == r),
         'x': lambda sel, f, t: f if (sel == 0) else t
     }
+    _builtin_func = dict(simple_func)  # the ops _net_function can specialize
 
     def __init__(
             self, tracer=True, register_value_map=None, memory_value_map=None,
-            default_value=0, block=None):
+            default_value=0, block=None, event_driven=False, profile=False):
         """ Creates a new circuit simulator
 
         :param tracer: an instance of SimulationTrace used to store execution results.
@@ -70,6 +96,14 @@ class Simulation(object):
           use the value stored in the object (default to 0)
         :param block: the hardware block to be traced (which might be of type PostSynthesisBlock).
           defaults to the working block
+        :param event_driven: if True, each step only re-evaluates the nets downstream of
+          the inputs, registers, and memories whose values actually changed since the
+          previous step.  The number of net evaluations avoided is kept in .skipped_nets.
+          Note that in this mode changes made directly to the dictionary returned by
+          inspect_mem are not noticed until the memory is next written by the design.
+        :param profile: if True, count and time every evaluation of each net in the
+          SimulationProfile kept in .profile, to find the nets that make simulating
+          the block slow.  This slows the simulation down considerably.
 
         Warning: Simulation initializes some things when called with __init__,
         so changing items in the block for Simulation will likely break
@@ -83,11 +117,21 @@ class Simulation(object):
         block = working_block(block)
         block.sanity_check()  # check that this is a good hw block
 
-        self.value = {}  # map from signal->value
+        self.block = block
+        self.slot = {w: i for i, w in enumerate(block.wirevector_set)}
+        self._values = [0] * len(self.slot)  # value of every wire, indexed by slot
+        self._input_set = block.wirevector_subset(Input)
+        self.input_order = tuple(sorted(w.name for w in self._input_set))  # for step_fast
+        self._input_slots = [self.slot[block.wirevector_by_name[name]]
+                             for name in self.input_order]
+        self.value = _WireValueMap(self.slot, self._values)  # map from signal->value
         self.regvalue = {}  # map from register->value on next tick
         self.memvalue = {}  # map from {memid :{address: value}}
-        self.block = block
         self.default_value = default_value
+        self.event_driven = event_driven
+        self.skipped_nets = 0
+        self._cycle = 0  # cycles run since the simulation was created or reset
+        self.profile = SimulationProfile(block) if profile else None
         if tracer is True:
             tracer = SimulationTrace()
         self.tracer = tracer
@@ -106,6 +150,9 @@ class Simulation(object):
         if default_value is None:
             default_value = self.default_value
 
+        # set all variables to the default value, and then override the special ones
+        self._values[:] = [default_value] * len(self._values)
+
         # set registers to their values
         reg_set = self.block.wirevector_subset(Register)
         if register_value_map is not None:
@@ -130,7 +177,7 @@ class Simulation(object):
                     raise PyrtlError('error, one or more of the memories in the map is a RomBlock')
                 if isinstance(self.block, PostSynthBlock):
                     mem = self.block.mem_map[mem]  # pylint: disable=maybe-no-member
-                self.memvalue[mem.id] = mem_map
+                self.memvalue[mem.id] = dict(mem_map)  # so the caller's map is not changed
                 max_addr_val, max_bit_val = 2**mem.addrwidth, 2**mem.bitwidth
                 for (addr, val) in mem_map.items():
                     if addr < 0 or addr >= max_addr_val:
@@ -140,15 +187,48 @@ class Simulation(object):
                         raise PyrtlError('error, %s at %s in %s outside of bounds' %
                                          (str(val), str(addr), mem.name))
 
-        # set all other variables to default value
-        for w in self.block.wirevector_set:
-            if w not in self.value:
-                self.value[w] = default_value
-
         self.ordered_nets = tuple((i for i in self.block))
         self.reg_update_nets = tuple((self.block.logic_subset('r')))
         self.mem_update_nets = tuple((self.block.logic_subset('@')))
 
+        # precompile the combinational nets, in the order they need to be evaluated
+        self._comb_nets = tuple(net for net in self.ordered_nets if net.op not in 'r@')
+        self.net_functions = tuple(
+            (net, self.slot[net.dests[0]], self._net_function(net)) for net in self._comb_nets)
+        self._net_index = {net: (dest, func) for net, dest, func in self.net_functions}
+        if self.profile is None:
+            self._evaluation_order = tuple((dest, func) for _, dest, func in self.net_functions)
+        else:
+            self._evaluation_order = tuple(
+                (dest, self.profile._timed(net, func)) for net, dest, func in self.net_functions)
+        self._reg_slots = tuple(
+            (net.dests[0], self.slot[net.args[0]]) for net in self.reg_update_nets)
+        self._mem_write_slots = tuple(
+            (net.op_param[0], tuple(self.slot[arg] for arg in net.args))
+            for net in self.mem_update_nets)
+        if self.event_driven:
+            self._initialize_fanout()
+
+    def _initialize_fanout(self):
+        """ Build the fanout tables used by the event driven mode.
+
+        Each combinational net gets its index in topological order, and every wire
+        slot (and every memory) maps to the sorted indices of the nets that read it.
+        As a net always comes before the nets reading its destination, processing
+        pending indices smallest first evaluates every net at most once per step.
+        """
+        net_index = {net: i for i, net in enumerate(self._comb_nets)}
+        _, wire_sink_dict = self.block.net_connections()
+        self._fanout = [()] * len(self._values)
+        for wire, nets in wire_sink_dict.items():
+            readers = sorted(net_index[net] for net in nets if net in net_index)
+            self._fanout[self.slot[wire]] = tuple(readers)
+        self._mem_readers = collections.defaultdict(list)
+        for net in self._comb_nets:
+            if net.op == 'm':
+                self._mem_readers[net.op_param[0]].append(net_index[net])
+        self._pending = set(range(len(self._comb_nets)))  # everything is new on the first step
+
     def step(self, provided_inputs):
         """ Take the simulation forward one cycle
 
@@ -161,10 +241,12 @@ class Simulation(object):
         sim.step({'a': 1, 'x': 23}) to simulate a cycle with values 1 and 23
         respectively
         """
+        values = self._values
 
         # Check that all Input have a corresponding provided_input
-        input_set = self.block.wirevector_subset(Input)
+        input_set = self._input_set
         supplied_inputs = set()
+        changed_slots = []
         for i in provided_inputs:
             if isinstance(i, WireVector):
                 name = i.name
@@ -186,7 +268,10 @@ class Simulation(object):
                     % (name, sim_wire.bitwidth,
                        provided_inputs[i], len(bin(provided_inputs[i])) - 2))
 
-            self.value[sim_wire] = provided_inputs[i]
+            slot = self.slot[sim_wire]
+            if self.event_driven and values[slot] != provided_inputs[i]:
+                changed_slots.append(slot)
+            values[slot] = provided_inputs[i]
             supplied_inputs.add(sim_wire)
 
         # Check that only inputs are specified, and set the values
@@ -194,14 +279,62 @@ class Simulation(object):
             for i in input_set.difference(supplied_inputs):
                 raise PyrtlError('Input "%s" has no input value specified' % i.name)
 
-        self.value.update(self.regvalue)  # apply register updates from previous step
+        self._finish_step(changed_slots)
 
-        for net in self.ordered_nets:
-            self._execute(net)
+    def step_fast(self, values, validate=False):
+        """ Take the simulation forward one cycle, with the inputs given by position.
+
+        :param values: a sequence with the value of each Input, in the order of the
+          names in .input_order (the names of the inputs, sorted)
+        :param validate: if True, check the values as step does; otherwise they
+          are trusted, so a wrong value silently gives wrong results
+
+        This skips the lookup of each input by name and the checks of step, which
+        dominate the cost of a step of a small design.  Check the values of a new
+        testbench by passing validate=True on the first few calls.
+
+        Example, for a block with the inputs 'a' and 'b' ::
+
+            assert sim.input_order == ('a', 'b')
+            sum = sim.inspector('sum')
+            for a, b in stimulus:
+                sim.step_fast((a, b))
+                results.append(sum())
+        """
+        if validate:
+            _check_positional_inputs(self.block, self.input_order, values)
+        sim_values = self._values
+        changed_slots = []
+        if self.event_driven:
+            for slot, value in zip(self._input_slots, values):
+                if sim_values[slot] != value:
+                    changed_slots.append(slot)
+                sim_values[slot] = value
+        else:
+            for slot, value in zip(self._input_slots, values):
+                sim_values[slot] = value
+        self._finish_step(changed_slots)
+
+    def _finish_step(self, changed_slots):
+        """ Evaluate the cycle once the inputs are set, given the slots that changed. """
+        values = self._values
+
+        # apply register updates from previous step
+        for reg, val in self.regvalue.items():
+            slot = self.slot[reg]
+            if self.event_driven and values[slot] != val:
+                changed_slots.append(slot)
+            values[slot] = val
+
+        if self.event_driven:
+            self._execute_changed(changed_slots)
+        else:
+            for dest, func in self._evaluation_order:
+                values[dest] = func()
 
         # Do all of the mem operations based off the new values changed in _execute()
-        for net in self.mem_update_nets:
-            self._mem_update(net)
+        for memid, arg_slots in self._mem_write_slots:
+            self._mem_update(memid, *arg_slots)
 
         # at the end of the step, record the values to the trace
         # print self.value # Helpful Debug Print
@@ -209,13 +342,13 @@ class Simulation(object):
             self.tracer.add_step(self.value)
 
         # Do all of the reg updates based off of the new values
-        for net in self.reg_update_nets:
-            argval = self.value[net.args[0]]
-            self.regvalue[net.dests[0]] = self._sanitize(argval, net.dests[0])
+        for reg, src in self._reg_slots:
+            self.regvalue[reg] = values[src] & reg.bitmask
 
         # finally, if any of the rtl_assert assertions are failing then we should
         # raise the appropriate exceptions
-        check_rtl_assertions(self)
+        self._cycle += 1
+        check_rtl_assertions(self, self._cycle - 1)
 
     def step_multiple(self, provided_inputs={}, expected_outputs={}, nsteps=None,
                       file=sys.stdout, stop_after_first_error=False):
@@ -342,6 +475,18 @@ class Simulation(object):
         wire = self.block.wirevector_by_name.get(w, w)
         return self.value[wire]
 
+    def inspector(self, w):
+        """ Get a function returning the value of a wirevector in the last cycle.
+
+        :param w: the WireVector, or its name
+        :return: a function of no arguments, equivalent to calling inspect(w)
+
+        The wire is looked up once, here, rather than on every call.
+        """
+        slot = self.slot[self.block.get_wirevector_by_name(getattr(w, 'name', w), strict=True)]
+        values = self._values
+        return lambda: values[slot]
+
     def inspect_mem(self, mem):
         """ Get the values in a map during the current simulation cycle.
 
@@ -353,6 +498,82 @@ class Simulation(object):
         """
         return self.memvalue[mem.id]
 
+    def snapshot(self):
+        """ Capture the register and memory state of the simulation.
+
+        :return: the state as a dictionary of the form
+          {'registers': {name: value}, 'memories': {name: {address: value}}}
+
+        The snapshot holds only names and ints, so it can be pickled, and it can be
+        restored into any of the simulators of the same design.
+        """
+        values = self._values
+        return {
+            'registers': {reg.name: self.regvalue.get(reg, values[self.slot[reg]])
+                          for reg in self.block.wirevector_subset(Register)},
+            'memories': {name: dict(self.memvalue[mem.id])
+                         for name, mem in _stateful_memories(self.block).items()}}
+
+    def restore(self, snapshot):
+        """ Return the registers and memories to a state captured by snapshot().
+
+        :param snapshot: the state to restore.  Registers missing from it are set
+          to the default value, and memories missing from it are emptied.
+
+        The tracer is untouched, so the trace simply continues from the restored state.
+        """
+        registers, memories = _resolve_snapshot(self.block, snapshot, self.default_value)
+        for reg, value in registers.items():
+            self.regvalue[reg] = self._values[self.slot[reg]] = value
+        for mem, contents in memories.items():
+            # updated in place, as the memory read functions are bound to these dicts;
+            # copied first, as contents may be the very dict being cleared
+            contents = dict(contents)
+            self.memvalue[mem.id].clear()
+            self.memvalue[mem.id].update(contents)
+        if self.event_driven:
+            self._pending = set(range(len(self._comb_nets)))
+
+    def reset(self, register_value_map=None, memory_value_map=None):
+        """ Return the simulation to its initial state, without rebuilding it.
+
+        :param register_value_map: the initial value of registers, as in __init__
+        :param memory_value_map: the initial contents of memories, as in __init__
+
+        Every wire, register, and memory not given a value is set to the default
+        value, and the tracer is cleared.  This is much cheaper than creating a new
+        Simulation, as the block is not checked and the nets are not prepared again.
+        """
+        snapshot = _initial_snapshot(self.block, register_value_map, memory_value_map)
+        self._values[:] = [self.default_value] * len(self._values)
+        for w in self.block.wirevector_subset(Const):
+            self.value[w] = w.val
+        self.restore(snapshot)
+        self.skipped_nets = 0
+        self._cycle = 0
+        if self.tracer is not None:
+            self.tracer.clear()
+
+    def fork(self, tracer=True):
+        """ Create an independent simulation starting from the current state of this one.
+
+        :param tracer: the tracer of the new simulation; True (the default) creates a
+          new SimulationTrace of the same wires and storage as the tracer of this
+          simulation (a trace stored on disk goes to a new temporary directory, see
+          its path), and None disables tracing
+        :return: a new Simulation of the same block, with a copy of the register and
+          memory state of this one
+
+        This is handy for running many experiments from one warmed-up state.
+        """
+        if tracer is True:
+            tracer = (SimulationTrace(block=self.block) if self.tracer is None
+                      else self.tracer._fork(self.block))
+        sim = Simulation(tracer=tracer, default_value=self.default_value, block=self.block,
+                         event_driven=self.event_driven, profile=self.profile is not None)
+        sim.restore(self.snapshot())
+        return sim
+
     @staticmethod
     def _sanitize(val, wirevector):
         """Return a modified version of val that would fit in wirevector.
@@ -363,59 +584,590 @@ class Simulation(object):
         """
         return val & wirevector.bitmask
 
-    def _execute(self, net):
-        """Handle the combinational logic update rules for the given net.
+    def _net_function(self, net):
+        """Return a function computing the (sanitized) value of the net's destination.
 
-        This function, along with edge_update, defined the semantics
-        of the primitive ops. Function updates self.value accordingly.
+        This function, along with _mem_update, defines the semantics of the
+        primitive ops.  The returned function takes no arguments: the slots of
+        the net's arguments, the memory (if any), and the mask are bound in
+        advance so that a step only has to call it and store the result.
         """
-        if net.op in 'r@':
-            return  # registers and memory write ports have no logic function
-        elif net.op in self.simple_func:
-            argvals = (self.value[arg] for arg in net.args)
-            result = self.simple_func[net.op](*argvals)
+        v = self._values
+        m = net.dests[0].bitmask
+        args = tuple(self.slot[arg] for arg in net.args)
+
+        custom_sanitize = self._sanitize is not Simulation._sanitize
+        op_func = self.simple_func.get(net.op)
+        if op_func is not None and (
+                custom_sanitize or op_func is not self._builtin_func.get(net.op)):
+            # ops and sanitizing changed by a subclass are applied as they are given
+            sanitize, dest = self._sanitize, net.dests[0]
+            return lambda: sanitize(op_func(*[v[a] for a in args]), dest)
+        if custom_sanitize:
+            # the other ops give values that already fit, but are passed through anyway
+            func = self._specialized_function(net, v, m, args)
+            sanitize, dest = self._sanitize, net.dests[0]
+            return lambda: sanitize(func(), dest)
+        return self._specialized_function(net, v, m, args)
+
+    def _specialized_function(self, net, v, m, args):
+        """ The function computing a net's masked result from the values v. """
+        simple_func = {  # OPS
+            'w': lambda a: lambda: v[a] & m,
+            '~': lambda a: lambda: ~v[a] & m,
+            '&': lambda a, b: lambda: v[a] & v[b] & m,
+            '|': lambda a, b: lambda: (v[a] | v[b]) & m,
+            '^': lambda a, b: lambda: (v[a] ^ v[b]) & m,
+            'n': lambda a, b: lambda: ~(v[a] & v[b]) & m,
+            '+': lambda a, b: lambda: (v[a] + v[b]) & m,
+            '-': lambda a, b: lambda: (v[a] - v[b]) & m,
+            '*': lambda a, b: lambda: (v[a] * v[b]) & m,
+            '<': lambda a, b: lambda: int(v[a] < v[b]),
+            '>': lambda a, b: lambda: int(v[a] > v[b]),
+            '=': lambda a, b: lambda: int(v[a] == v[b]),
+            'x': lambda sel, f, t: lambda: (v[f] if v[sel] == 0 else v[t]) & m,
+        }
+
+        if net.op in simple_func:
+            return simple_func[net.op](*args)
         elif net.op == 'c':
-            result = 0
-            for arg in net.args:
-                result = result << len(arg)
-                result = result | self.value[arg]
+            shifts = tuple((slot, sum(len(x) for x in net.args[i + 1:]))
+                           for i, slot in enumerate(args))
+
+            def concat():
+                result = 0
+                for slot, shift in shifts:
+                    result |= v[slot] << shift
+                return result & m
+            return concat
         elif net.op == 's':
-            result = 0
-            source = self.value[net.args[0]]
-            for b in net.op_param[::-1]:
-                result = (result << 1) | (0x1 & (source >> b))
+            a, = args
+            start = net.op_param[0]
+            if tuple(net.op_param) == tuple(range(start, start + len(net.op_param))):
+                return lambda: (v[a] >> start) & m  # a contiguous slice is just a shift
+            selected = tuple(enumerate(net.op_param))
+
+            def select():
+                source = v[a]
+                result = 0
+                for i, b in selected:
+                    result |= (1 & (source >> b)) << i
+                return result
+            return select
         elif net.op == 'm':
             # memories act async for reads
-            memid = net.op_param[0]
+            a, = args
             mem = net.op_param[1]
-            read_addr = self.value[net.args[0]]
             if isinstance(mem, RomBlock):
-                result = mem._get_read_data(read_addr)
-            else:
-                result = self.memvalue[memid].get(read_addr, self.default_value)
+                return lambda: mem._get_read_data(v[a]) & m
+            memvalue = self.memvalue[net.op_param[0]]
+            default_value = self.default_value
+            return lambda: memvalue.get(v[a], default_value) & m
         else:
             raise PyrtlInternalError('error, unknown op type')
 
-        self.value[net.dests[0]] = self._sanitize(result, net.dests[0])
+    def _execute(self, net):
+        """Handle the combinational logic update rules for the given net.
 
-    def _mem_update(self, net):
-        """Handle the mem update for the simulation of the given net (which is a memory).
+        Useful when stepping through the logic of a cycle by hand; it evaluates
+        the net exactly as step() does and updates self.value accordingly.
+        """
+        if net.op in 'r@':
+            return  # registers and memory write ports have no logic function
+        try:
+            dest, func = self._net_index[net]
+        except KeyError:
+            raise PyrtlError('error, net is not part of the simulated block')
+        self._values[dest] = func()
+
+    def _execute_changed(self, changed_slots):
+        """Handle the combinational logic update for the event driven mode.
+
+        Only the nets reading a slot in changed_slots (plus those marked pending
+        by memory writes) are evaluated, and a net's readers are only scheduled
+        when the value on its destination actually changes.
+        """
+        values, order, fanout = self._values, self._evaluation_order, self._fanout
+        queued = self._pending
+        for slot in changed_slots:
+            queued.update(fanout[slot])
+        heap = list(queued)
+        heapq.heapify(heap)
+
+        evaluated = 0
+        while heap:
+            dest, func = order[heapq.heappop(heap)]
+            result = func()
+            evaluated += 1
+            if values[dest] != result:
+                values[dest] = result
+                for reader in fanout[dest]:
+                    if reader not in queued:
+                        queued.add(reader)
+                        heapq.heappush(heap, reader)
+
+        self.skipped_nets += len(order) - evaluated
+        self._pending = set()
+
+    def _mem_update(self, memid, addr_slot, data_slot, enable_slot):
+        """Handle the mem update for the simulation of a memory write port.
 
         Combinational logic should have no posedge behavior, but registers and
-        memory should.  This function, used after _execute, defines the
-        semantics of the primitive ops.  Function updates self.memvalue accordingly
+        memory should.  This function, used after the combinational logic, defines
+        the semantics of the write port.  Function updates self.memvalue accordingly
         (using prior_value)
         """
-        if net.op != '@':
-            raise PyrtlInternalError
-        memid = net.op_param[0]
-        write_addr = self.value[net.args[0]]
-        write_val = self.value[net.args[1]]
-        write_enable = self.value[net.args[2]]
-        if write_enable:
+        values = self._values
+        if values[enable_slot]:
+            write_addr = values[addr_slot]
+            write_val = values[data_slot]
+            if self.event_driven:
+                if self.memvalue[memid].get(write_addr, self.default_value) != write_val:
+                    self._pending.update(self._mem_readers[memid])
             self.memvalue[memid][write_addr] = write_val
 
 
+def _stateful_memories(block):
+    """ Map from name to each (non-ROM) memory of the block, as used in snapshots. """
+    mems = {}
+    for net in block.logic_subset('m@'):
+        mem = net.op_param[1]
+        if isinstance(mem, RomBlock):
+            continue
+        if mems.get(mem.name, mem) is not mem:
+            raise PyrtlError('cannot snapshot two memories with the same name "%s"' % mem.name)
+        mems[mem.name] = mem
+    return mems
+
+
+def _resolve_snapshot(block, snapshot, default_value):
+    """ Check a snapshot against a block, returning the full state it describes.
+
+    :return: a pair ({Register: value}, {MemBlock: {address: value}}) covering every
+      register and memory of the block, with those missing from the snapshot set to
+      default_value and emptied respectively
+    """
+    reg_values = snapshot.get('registers', {})
+    mem_values = snapshot.get('memories', {})
+    registers = {}
+    for reg in block.wirevector_subset(Register):
+        value = reg_values.get(reg.name, default_value)
+        if value < 0 or value > reg.bitmask:
+            raise PyrtlError('snapshot value %d does not fit in register "%s"'
+                             % (value, reg.name))
+        registers[reg] = value
+    memories = {}
+    for name, mem in _stateful_memories(block).items():
+        contents = mem_values.get(name, {})
+        for addr, value in contents.items():
+            if addr < 0 or addr >> mem.addrwidth or value < 0 or value >> mem.bitwidth:
+                raise PyrtlError('snapshot value %d at address %d does not fit in memory "%s"'
+                                 % (value, addr, name))
+        memories[mem] = contents
+    unknown = (set(reg_values) - {reg.name for reg in registers}
+               | set(mem_values) - {mem.name for mem in memories})
+    if unknown:
+        raise PyrtlError('snapshot has state for unknown registers or memories %s'
+                         % sorted(unknown))
+    return registers, memories
+
+
+def _initial_snapshot(block, register_value_map, memory_value_map):
+    """ Turn the initial value maps taken by the simulators into a snapshot.
+
+    :param register_value_map: a map {Register: value}, or None
+    :param memory_value_map: a map {MemBlock: {address: value}}, or None
+    :return: a snapshot (see Simulation.snapshot) suitable for restore
+    """
+    memories = {}
+    for mem, mem_map in (memory_value_map or {}).items():
+        if isinstance(mem, RomBlock):
+            raise PyrtlError('error, one or more of the memories in the map is a RomBlock')
+        if isinstance(block, PostSynthBlock):
+            mem = block.mem_map[mem]  # pylint: disable=maybe-no-member
+        memories[mem.name] = mem_map
+    return {'registers': {reg.name: value for reg, value in (register_value_map or {}).items()},
+            'memories': memories}
+
+
+_profile_timer = timeit.default_timer
+
+
+def _check_positional_inputs(block, names, values):
+    """ Check that values holds a valid value for each of the inputs named. """
+    if len(values) != len(names):
+        raise PyrtlError('expected a value for each of the %d inputs (%s), but got %d values'
+                         % (len(names), ', '.join(names), len(values)))
+    for name, value in zip(names, values):
+        wire = block.wirevector_by_name[name]
+        if not isinstance(value, numbers.Integral) or not 0 <= value <= wire.bitmask:
+            raise PyrtlError("Wire {} has value {} which cannot be represented"
+                             " using its bitwidth".format(wire, value))
+
+
+def _assertion_names(block):
+    """ The names of the rtl_assert wires of block, in the order they are checked. """
+    return sorted(w.name for w in block.rtl_assert_dict)
+
+
+def _assertion_failure(block, name, cycle):
+    """ The exception registered for the assertion wire name, noting the failing cycle. """
+    exp = block.rtl_assert_dict[block.wirevector_by_name[name]]
+    exp.cycle = cycle
+    return exp
+
+
+def _is_internal_name(name):
+    """ True for the names given to wires that were not named by the user. """
+    return (name.startswith('tmp') or name.startswith('const')
+            # or name.startswith('synth_')
+            or name.endswith("'"))
+
+
+def _name_prefix(name):
+    """ The part of a wire name before the first separator, less any trailing number. """
+    prefix = re.match(r'[^_./\[]*', name).group(0).rstrip('0123456789')
+    return prefix or name
+
+
+class SimulationProfile(object):
+    """ The number of times each net was evaluated during a simulation, and for how long.
+
+    Simulation and FastSimulation keep one of these in their .profile member when
+    created with profile=True.  Each net is attributed to the wire it computes
+    or, for the unnamed wires in between, to the first named wire it feeds.  The
+    times can be totalled for each net, each op, or each wire name prefix (the
+    part of the attributed name before the first "_", ".", "/" or "[", so that
+    all of "alu_add", "alu_mul" and "alu.out" count towards "alu").  This points
+    at the parts of a design that make simulating it slow, such as wide
+    multipliers, long chains of concats and selects, or reads of large ROMs.
+
+    Example ::
+
+        sim = pyrtl.FastSimulation(profile=True)
+        sim.step_multiple({'a': range(1000)})
+        sim.profile.print_report(by='op')
+        with open('profile.json', 'w') as f:
+            sim.profile.dump(f)
+
+    The cost of reading the timer, measured when the profile is created, is taken
+    off of every evaluation, but profiling still makes a simulation several times
+    slower, so the times are best compared with each other rather than with
+    those of an unprofiled simulation.
+    """
+
+    _groupings = ('net', 'op', 'prefix')
+
+    def __init__(self, block):
+        """
+        :param block: the block whose combinational nets are profiled
+        """
+        ordered = tuple(block)
+        self.nets = tuple(net for net in ordered if net.op not in 'r@')
+        self.index = {net: i for i, net in enumerate(self.nets)}
+        # readers come later in topological order, so are attributed first
+        readers = collections.defaultdict(list)
+        for net in ordered:
+            for arg in net.args:
+                readers[arg].append(net)
+        attributed = {}
+        for net in reversed(ordered):
+            if not net.dests:
+                continue  # memory writes compute no wire
+            name = net.dests[0].name
+            if _is_internal_name(name):
+                named = (attributed[r] for r in readers[net.dests[0]]
+                         if r in attributed and not _is_internal_name(attributed[r]))
+                name = next(named, name)
+            attributed[net] = name
+        self.attributed = tuple(attributed[net] for net in self.nets)
+        self.counts = [0] * len(self.nets)  # updated in place by the simulators
+        self.times = [0.0] * len(self.nets)
+        self.overhead = self._timer_overhead()
+
+    @staticmethod
+    def _timer_overhead(samples=1000):
+        gaps = []
+        for _ in range(samples):
+            start = _profile_timer()
+            gaps.append(_profile_timer() - start)
+        return sorted(gaps)[samples // 2]
+
+    def _timed(self, net, func):
+        """ Wrap the function evaluating a net so that it updates the profile. """
+        i = self.index[net]
+        counts, times = self.counts, self.times
+
+        def timed():
+            start = _profile_timer()
+            result = func()
+            times[i] += _profile_timer() - start
+            counts[i] += 1
+            return result
+        return timed
+
+    def clear(self):
+        """ Set every count and time back to zero. """
+        self.counts[:] = [0] * len(self.nets)
+        self.times[:] = [0.0] * len(self.nets)
+
+    @staticmethod
+    def describe(net):
+        """ A short description of a net, giving the sizes that make it costly. """
+        dest = net.dests[0]
+        if net.op == 'c':
+            return 'c of %d wires -> %d' % (len(net.args), dest.bitwidth)
+        if net.op == 's':
+            return 's of %d bits from %d' % (len(net.op_param), net.args[0].bitwidth)
+        if net.op == 'm':
+            mem = net.op_param[1]
+            return 'm from %s "%s" of %d entries' % (
+                'rom' if isinstance(mem, RomBlock) else 'memory', mem.name, 1 << mem.addrwidth)
+        return '%s %s -> %d' % (net.op, 'x'.join(str(arg.bitwidth) for arg in net.args),
+                                dest.bitwidth)
+
+    def records(self, by='net'):
+        """ The profile as a list of dictionaries, the most time consuming first.
+
+        :param by: 'net' for a record per net, or 'op' or 'prefix' for a record
+          totalling the nets of each op or wire name prefix
+        :return: a list of dictionaries with the keys 'name' (the destination wire,
+          op, or prefix), 'nets', 'count', and 'time' (in seconds), plus 'op',
+          'description', and 'wire' (the named wire it is attributed to) for the
+          records of nets
+        """
+        if by not in self._groupings:
+            raise PyrtlError('cannot group a profile by "%s", only by %s'
+                             % (by, ', '.join(self._groupings)))
+        records = {}
+        for i, net in enumerate(self.nets):
+            key = {'net': i, 'op': net.op, 'prefix': _name_prefix(self.attributed[i])}[by]
+            if key not in records:
+                records[key] = {'name': net.dests[0].name if by == 'net' else key,
+                                'nets': 0, 'count': 0, 'time': 0.0}
+                if by == 'net':
+                    records[key].update(op=net.op, description=self.describe(net),
+                                        wire=self.attributed[i])
+            record = records[key]
+            record['nets'] += 1
+            record['count'] += self.counts[i]
+            record['time'] += max(0.0, self.times[i] - self.counts[i] * self.overhead)
+        return sorted(records.values(), key=lambda r: (-r['time'], r['name']))
+
+    def print_report(self, by='net', limit=20, file=sys.stdout):
+        """ Print the most time consuming nets, ops, or wire name prefixes.
+
+        :param by: 'net', 'op', or 'prefix', as for records
+        :param limit: the number of lines to print, or None for all of them
+        :param file: where to print the report
+        """
+        records = self.records(by)
+        total = sum(r['time'] for r in records) or 1.0
+        print('%10s %6s %10s  %s' % ('time (ms)', '%', 'count', by), file=file)
+        for r in records[:limit]:
+            name = r['name']
+            if by == 'net':
+                name = '%s = %s' % (name, r['description'])
+                if r['wire'] != r['name']:
+                    name += ' (for %s)' % r['wire']
+            elif r['nets'] > 1:
+                name = '%s (%d nets)' % (name, r['nets'])
+            print('%10.3f %6.1f %10d  %s' % (1e3 * r['time'], 100 * r['time'] / total,
+                                             r['count'], name), file=file)
+
+    def dump(self, file=sys.stdout):
+        """ Write out the profile as JSON, for reading by other tools.
+
+        The JSON object holds the timer overhead taken off of each evaluation, in
+        seconds, and the records (see records) grouped by 'net', 'op', and 'prefix'.
+        """
+        profile = {by: self.records(by) for by in self._groupings}
+        profile['overhead'] = self.overhead
+        json.dump(profile, file, indent=1, sort_keys=True)
+
+
+def _activity_wires(block, wires):
+    """ The wires whose toggles are counted, given the activity argument of a simulator. """
+    if wires is True:
+        return [w for w in block.wirevector_set if not isinstance(w, Const)]
+    tracked = []
+    for w in wires:
+        wire = block.get_wirevector_by_name(getattr(w, 'name', w), strict=True)
+        if isinstance(wire, Const):
+            raise PyrtlError('the constant "%s" never toggles' % wire.name)
+        tracked.append(wire)
+    return tracked
+
+
+class ToggleActivity(object):
+    """ How often each bit of a set of wires toggled during a simulation.
+
+    FastSimulation and CompiledSimulation keep one of these in their .activity
+    member when created with activity=True (to count every wire) or with a list
+    of wires.  The counting is done by the generated code, without a trace, and
+    costs time in proportion to the number of bits that toggle, so it can be left
+    running for very long workloads.  For every bit it holds the number of
+    toggles and the number of cycles spent at 1, which can be written out as a
+    SAIF file for power analysis tools with write_saif, or turned into a rough
+    estimate of the switching power with pyrtl.analysis.switching_power_estimation.
+
+    Example ::
+
+        sim = pyrtl.CompiledSimulation(tracer=None, activity=True)
+        sim.step_multiple({'a': workload})
+        sim.activity.toggle_rate('sum')  # the average number of toggles per cycle
+        with open('activity.saif', 'w') as f:
+            sim.activity.write_saif(f)
+
+    The first cycle counted sets the starting value of each bit, so only changes
+    after it count as toggles.  The counts carry on across a reset of the
+    simulation (a change of state then counts as toggles); use clear to start
+    counting again.
+    """
+
+    def __init__(self, wires, prev=None, limbs=False, counts=None, high=None, cycle=None):
+        """
+        :param wires: the wires to count the toggles of
+        :param prev: the latest value of each wire; the rest of the arguments are
+          for the compiled simulation, which keeps the counts in arrays of its own
+        :param limbs: if True, prev holds each value as 64-bit words
+        :param counts: the toggles of each bit
+        :param high: the time spent at 1 by each bit, in the form kept by _toggled
+        :param cycle: a sequence holding the number of cycles counted so far
+        """
+        self.wires = tuple(sorted(wires, key=lambda w: w.name))
+        self.block = self.wires[0]._block if self.wires else None
+        self._index = {w.name: i for i, w in enumerate(self.wires)}
+        self._base = []  # position of each wire's first bit in counts and high
+        self._offset = []  # position of each wire's first word in prev, with limbs
+        bits = words = 0
+        for w in self.wires:
+            self._base.append(bits)
+            self._offset.append(words)
+            bits += w.bitwidth
+            words += (w.bitwidth + 63) // 64
+        self._limbs = limbs
+        self._prev = prev if prev is not None else [0] * len(self.wires)
+        self._counts = counts if counts is not None else [0] * bits
+        # each toggle to 1 subtracts the cycle and each toggle to 0 adds it,
+        # so the bits at 1 at the end only need the current cycle added
+        self._high = high if high is not None else [0] * bits
+        self._cycle = cycle if cycle is not None else [0]
+
+    def _toggled(self, i, changed, value):
+        """ Count the toggles of the bits in changed, for wire i now holding value. """
+        cycle = self._cycle[0]
+        counts, high = self._counts, self._high
+        bit = self._base[i]
+        while changed:
+            if changed & 1:
+                if cycle:
+                    counts[bit] += 1
+                high[bit] += -cycle if value & 1 else cycle
+            changed >>= 1
+            value >>= 1
+            bit += 1
+
+    @property
+    def cycles(self):
+        """ The number of cycles counted. """
+        return self._cycle[0]
+
+    def clear(self):
+        """ Start counting again from the next cycle. """
+        self._counts[:] = [0] * len(self._counts)
+        self._high[:] = [0] * len(self._high)
+        self._cycle[0] = 0
+
+    def _wire_index(self, wire):
+        name = getattr(wire, 'name', wire)
+        if name not in self._index:
+            raise PyrtlError('the toggles of "%s" are not being counted' % name)
+        return self._index[name]
+
+    def _value(self, i):
+        if not self._limbs:
+            return self._prev[i]
+        value = 0
+        start = self._offset[i]
+        for n in reversed(range((self.wires[i].bitwidth + 63) // 64)):
+            value = (value << 64) | self._prev[start + n]
+        return value
+
+    def bit_toggles(self, wire):
+        """ The number of toggles of each bit of a wire, least significant bit first. """
+        i = self._wire_index(wire)
+        return list(self._counts[self._base[i]:self._base[i] + self.wires[i].bitwidth])
+
+    def bit_time_high(self, wire):
+        """ The number of cycles each bit of a wire spent at 1, least significant bit first. """
+        i = self._wire_index(wire)
+        value, cycles = self._value(i), self.cycles
+        high = self._high[self._base[i]:self._base[i] + self.wires[i].bitwidth]
+        return [h + cycles if (value >> b) & 1 else h for b, h in enumerate(high)]
+
+    def toggles(self, wire):
+        """ The total number of toggles of the bits of a wire. """
+        return sum(self.bit_toggles(wire))
+
+    def toggle_rate(self, wire):
+        """ The average number of bits of a wire that toggle each cycle. """
+        return self.toggles(wire) / float(self.cycles) if self.cycles else 0.0
+
+    def write_saif(self, file=sys.stdout, timescale='1 ns', period=10, design='toplevel'):
+        """ Write the activity out as a SAIF (switching activity interchange format) file.
+
+        :param file: the file to write to
+        :param timescale: the unit of time, such as '1 ns' or '10 ps'
+        :param period: the length of a cycle in that unit
+        :param design: the name of the instance holding the nets, which is
+          'toplevel' in the Verilog written by output_to_verilog
+
+        The nets are named as in the Verilog written by output_to_verilog, with a
+        net for every bit of a multi-bit wire.
+        """
+        names = _VerilogSanitizer('_ver_out_tmp_')
+        for w in self.block.wirevector_set:  # named in the same order as output_to_verilog
+            names.make_valid_string(w.name)
+        duration = self.cycles * period
+        lines = ['(SAIFILE', '(SAIFVERSION "2.0")', '(DIRECTION "backward")',
+                 '(DESIGN )', '(VENDOR "PyRTL")', '(PROGRAM_NAME "PyRTL")', '(DIVIDER / )',
+                 '(TIMESCALE %s)' % timescale, '(DURATION %d)' % duration,
+                 '(INSTANCE %s' % design, '  (NET']
+        for w in self.wires:
+            name = names[w.name]
+            for b, (toggles, high) in enumerate(zip(self.bit_toggles(w), self.bit_time_high(w))):
+                net = name if w.bitwidth == 1 else '%s\\[%d\\]' % (name, b)
+                lines.append('    (%s' % net)
+                lines.append('      (T0 %d) (T1 %d) (TX 0)' % (
+                    (self.cycles - high) * period, high * period))
+                lines.append('      (TC %d) (IG 0)' % toggles)
+                lines.append('    )')
+        lines.extend(['  )', ')', ')'])
+        print('\n'.join(lines), file=file)
+
+
+class _WireValueMap(collections.Mapping):
+    """Dictionary-like view from WireVectors to the values held in their slots."""
+
+    __slots__ = ('_slot', '_values')
+
+    def __init__(self, slot, values):
+        self._slot = slot
+        self._values = values
+
+    def __getitem__(self, wire):
+        return self._values[self._slot[wire]]
+
+    def __setitem__(self, wire, value):
+        self._values[self._slot[wire]] = value
+
+    def __iter__(self):
+        return iter(self._slot)
+
+    def __len__(self):
+        return len(self._slot)
+
 # ----------------------------------------------------------------
 #    ___       __  ___     __
 #   |__   /\  /__`  |     /__` |  |\/|
@@ -439,7 +1191,8 @@ class FastSimulation(object):
 
     def __init__(
             self, register_value_map=None, memory_value_map=None,
-            default_value=0, tracer=True, block=None, code_file=None):
+            default_value=0, tracer=True, block=None, code_file=None, profile=False,
+            activity=False):
         """ Instantiates a Fast Simulation instance.
 
         The interface for FastSimulation and Simulation should be almost identical.
@@ -447,6 +1200,12 @@ class FastSimulation(object):
 
         :param code_file: The file in which to store a copy of the generated
         python code. Defaults to no code being stored.
+        :param profile: if True, the generated code counts and times every net in
+          the SimulationProfile kept in .profile (see Simulation.__init__).  Forks
+          of a profiled simulation add to the same profile.
+        :param activity: True to count the toggles of every wire, or a list of the
+          wires (or their names) to count, in the ToggleActivity kept in .activity.
+          Defaults to no counting.  A fork counts the same wires from scratch.
 
         Look at Simulation.__init__ for descriptions for the other parameters
 
@@ -464,7 +1223,12 @@ class FastSimulation(object):
             tracer = SimulationTrace()
         self.tracer = tracer
         self.sim_func = None
+        self._multi_funcs = {}  # map from observed wire names to a multi-cycle function
         self.code_file = code_file
+        self.profile = SimulationProfile(block) if profile else None
+        self.activity = ToggleActivity(_activity_wires(block, activity)) if activity else None
+        self._cycle = 0  # cycles run since the simulation was created or reset
+        self.input_order = tuple(sorted(w.name for w in block.wirevector_subset(Input)))
         self.mems = {}
         self.regs = {}
         self.internal_names = _PythonSanitizer('_fastsim_tmp_')
@@ -494,17 +1258,14 @@ class FastSimulation(object):
             with open(self.code_file, 'w') as file:
                 file.write(s)
 
-        context = {}
-        logic_creator = compile(s, '<string>', 'exec')
-        exec(logic_creator, context)
-        self.sim_func = context['sim_func']
+        self.sim_func = self._exec_code(s, 'sim_func')
 
     def _initialize_mems(self, memory_value_map):
         if memory_value_map is not None:
             for (mem, mem_map) in memory_value_map.items():
                 if isinstance(mem, RomBlock):
                     raise PyrtlError('error, one or more of the memories in the map is a RomBlock')
-                self.mems[self._mem_varname(mem)] = mem_map
+                self.mems[self._mem_varname(mem)] = dict(mem_map)  # leave the caller's map
 
         for net in self.block.logic_subset('m@'):
             mem = net.op_param[1]
@@ -528,13 +1289,29 @@ class FastSimulation(object):
                 raise PyrtlError("Wire {} has value {} which cannot be represented"
                                  " using its bitwidth".format(wire, value))
 
+        self._step({self._to_name(wire): value for wire, value in provided_inputs.items()})
+
+    def step_fast(self, values, validate=False):
+        """ Run the simulation for a cycle, with the inputs given by position.
+
+        :param values: a sequence with the value of each Input, in the order of the
+          names in .input_order (the names of the inputs, sorted)
+        :param validate: if True, check the values; otherwise they are trusted
+
+        See Simulation.step_fast.
+        """
+        if validate:
+            _check_positional_inputs(self.block, self.input_order, values)
+        self._step(dict(zip(self.input_order, values)))
+
+    def _step(self, ins):
+        """ Run a cycle given the dictionary of input values, which is reused. """
         # building the simulation data
-        ins = {self._to_name(wire): value for wire, value in provided_inputs.items()}
         ins.update(self.regs)
         ins.update(self.mems)
 
         # propagate through logic
-        self.regs, self.outs, mem_writes = self.sim_func(ins)
+        self.regs, self.outs, mem_writes, failed = self.sim_func(ins)
 
         for mem, addr, value in mem_writes:
             self.mems[mem][addr] = value
@@ -545,8 +1322,10 @@ class FastSimulation(object):
         if self.tracer is not None:
             self.tracer.add_fast_step(self)
 
-        # check the rtl assertions
-        check_rtl_assertions(self)
+        # the rtl assertions are checked by the generated code
+        self._cycle += 1
+        if failed is not None:
+            raise _assertion_failure(self.block, failed, self._cycle - 1)
 
     def step_multiple(self, provided_inputs={}, expected_outputs={}, nsteps=None,
                       file=sys.stdout, stop_after_first_error=False):
@@ -627,18 +1406,30 @@ class FastSimulation(object):
                 "any expected outputs must have a supplied value "
                 "each step of simulation")
 
-        failed = []
-        for i in range(nsteps):
-            self.step({w: int(v[i]) for w, v in provided_inputs.items()})
+        if stop_after_first_error:
+            # the early stop is checked between individual steps
+            failed = []
+            for i in range(nsteps):
+                self.step({w: int(v[i]) for w, v in provided_inputs.items()})
 
-            for expvar in expected_outputs.keys():
-                expected = int(expected_outputs[expvar][i])
-                actual = self.inspect(expvar)
-                if expected != actual:
-                    failed.append((i, expvar, expected, actual))
+                for expvar in expected_outputs.keys():
+                    expected = int(expected_outputs[expvar][i])
+                    actual = self.inspect(expvar)
+                    if expected != actual:
+                        failed.append((i, expvar, expected, actual))
 
-            if failed and stop_after_first_error:
-                break
+                if failed and stop_after_first_error:
+                    break
+        else:
+            expected_names = [self._to_name(w) for w in expected_outputs]
+            observed = self._run_multiple(provided_inputs, nsteps, expected_names)
+            failed = []
+            for expvar in expected_outputs.keys():
+                actual_values = observed[self._to_name(expvar)]
+                for i in range(nsteps):
+                    expected = int(expected_outputs[expvar][i])
+                    if expected != actual_values[i]:
+                        failed.append((i, expvar, expected, actual_values[i]))
 
         if failed:
             if stop_after_first_error:
@@ -658,6 +1449,60 @@ class FastSimulation(object):
                 file.write("{0:>5} {1:>10} {2:>8} {3:>8}\n".format(step, name, expected, actual))
             file.flush()
 
+    def _run_multiple(self, provided_inputs, nsteps, observe=()):
+        """ Run nsteps cycles inside a single call of the generated code.
+
+        :param provided_inputs: a dictionary mapping wirevectors (or their names)
+          to sequences of at least nsteps values
+        :param nsteps: the number of cycles to run
+        :param observe: names of extra wires whose values should be collected
+        :return: a dictionary mapping each traced or observed wire name to its values
+
+        Registers live in local variables of the generated function for the whole
+        batch, so the per-step dictionary building of step() is only paid once.  The
+        rtl assertions are checked by the generated code too, which stops at the first
+        cycle in which one fails.
+        """
+        columns = {}
+        for wire, values in provided_inputs.items():
+            name = self._to_name(wire)
+            sim_wire = self.block.get_wirevector_by_name(name)
+            if not isinstance(sim_wire, Input):
+                raise PyrtlError(
+                    'step provided a value for input for "%s" which is '
+                    'not a known input ' % name)
+            column = [int(v) for v in values[:nsteps]]
+            if column and (max(column) > sim_wire.bitmask or min(column) < 0):
+                bad = next(v for v in column if v > sim_wire.bitmask or v < 0)
+                raise PyrtlError("Wire {} has value {} which cannot be represented"
+                                 " using its bitwidth".format(sim_wire, bad))
+            columns[name] = column
+        for wire in self.block.wirevector_subset(Input):
+            if wire.name not in columns:
+                raise PyrtlError('Input "%s" has no input value specified' % wire.name)
+
+        traced = list(self.tracer.trace) if self.tracer is not None else []
+        observed = {name: self.tracer.trace[name] for name in traced}
+        for name in observe:
+            if name not in observed:
+                observed[name] = []
+        names = tuple(sorted(observed))
+
+        if names not in self._multi_funcs:
+            self._multi_funcs[names] = self._exec_code(
+                self._compiled_multiple(names), 'sim_func_multiple')
+        sim_func_multiple = self._multi_funcs[names]
+
+        self.regs, self.context, failed = sim_func_multiple(
+            nsteps, columns, self.regs, self.mems,
+            {name: observed[name].append for name in names})
+        if failed is not None:
+            cycle, name = failed
+            self._cycle += cycle + 1
+            raise _assertion_failure(self.block, name, self._cycle - 1)
+        self._cycle += nsteps
+        return observed
+
     def inspect(self, w):
         """ Get the value of a wirevector in the last simulation cycle.
 
@@ -677,6 +1522,15 @@ class FastSimulation(object):
         #                      "and measure the probe value to measure this wire's value"
         #                     .format(w))
 
+    def inspector(self, w):
+        """ Get a function returning the value of a wirevector in the last cycle.
+
+        :param w: the WireVector, or its name
+        :return: a function of no arguments, equivalent to calling inspect(w)
+        """
+        name = self.block.get_wirevector_by_name(self._to_name(w), strict=True).name
+        return lambda: self.context[name]
+
     def inspect_mem(self, mem):
         """ Get the values in a map during the current simulation cycle.
 
@@ -690,6 +1544,61 @@ class FastSimulation(object):
             raise PyrtlError("ROM blocks are not stored in the simulation object")
         return self.mems[self._mem_varname(mem)]
 
+    def snapshot(self):
+        """ Capture the register and memory state of the simulation.
+
+        See Simulation.snapshot for the format of the returned dictionary.
+        """
+        return {
+            'registers': dict(self.regs),
+            'memories': {name: dict(self.mems[self._mem_varname(mem)])
+                         for name, mem in _stateful_memories(self.block).items()}}
+
+    def restore(self, snapshot):
+        """ Return the registers and memories to a state captured by snapshot().
+
+        See Simulation.restore for details.
+        """
+        registers, memories = _resolve_snapshot(self.block, snapshot, self.default_value)
+        self.regs = {reg.name: value for reg, value in registers.items()}
+        for mem, contents in memories.items():
+            contents = dict(contents)  # as contents may be the very dict being cleared
+            self.mems[self._mem_varname(mem)].clear()
+            self.mems[self._mem_varname(mem)].update(contents)
+
+    def reset(self, register_value_map=None, memory_value_map=None):
+        """ Return the simulation to its initial state, without generating code again.
+
+        See Simulation.reset for the arguments.
+        """
+        self.restore(_initial_snapshot(self.block, register_value_map, memory_value_map))
+        self._cycle = 0
+        if hasattr(self, 'context'):
+            del self.context  # nothing to inspect until the next step
+        if self.tracer is not None:
+            self.tracer.clear()
+
+    def fork(self, tracer=True):
+        """ Create an independent simulation starting from the current state of this one.
+
+        The new simulation shares the generated code with this one, so nothing is
+        recompiled.  See Simulation.fork for the arguments.
+        """
+        if tracer is True:
+            tracer = (SimulationTrace(block=self.block) if self.tracer is None
+                      else self.tracer._fork(self.block))
+        sim = copy.copy(self)
+        sim.tracer = tracer
+        sim.mems = {name: mem if isinstance(mem, RomBlock) else {}
+                    for name, mem in self.mems.items()}
+        sim.restore(self.snapshot())
+        if self.activity is not None:
+            # the generated code counts into the activity it was created with
+            sim.activity = ToggleActivity(self.activity.wires)
+            sim._multi_funcs = {}
+            sim.sim_func = sim._exec_code(sim._compiled(), 'sim_func')
+        return sim
+
     def _to_name(self, name):
         """ Converts Wires to strings, keeps strings as is """
         if isinstance(name, WireVector):
@@ -758,6 +1667,164 @@ class FastSimulation(object):
         # just executing it in the global exec scope.
         prog = [self._prog_start]
 
+        def mem_ref(mem):
+            return 'd["%s"]' % self._mem_varname(mem)
+
+        for net in self.block:
+            if net.op == '@':
+                mem = self._mem_varname(net.op_param[1])
+                write_addr, write_val, write_enable = (self._arg_varname(a) for a in net.args)
+                prog.append('    if {}:'.format(write_enable))
+                prog.append('        mem_ws.append(("{}", {}, {}))'
+                            .format(mem, write_addr, write_val))
+                continue  # memwrites are special
+
+            # prog.append('    #  ' + str(net))
+            result = self._dest_varname(net.dests[0])
+            prog.extend(self._profiled(net, '    ', '%s = %s' % (
+                result, self._net_expr(net, self._arg_varname, mem_ref))))
+
+        prog.extend(self._counted(
+            lambda w: 'outs[%s]' % repr(w.name) if isinstance(w, Output)
+            else self._arg_varname(w), '    '))
+
+        # add traced wires to dict
+        if self.tracer is not None:
+            for wire_name in self.tracer.trace:
+                wire = self.block.wirevector_by_name[wire_name]
+                if not isinstance(wire, (Input, Const, Register, Output)):
+                    v_wire_name = self._varname(wire)
+                    prog.append('    outs["%s"] = %s' % (wire_name, v_wire_name))
+
+        # the name of the first failing rtl assertion is returned
+        for name in _assertion_names(self.block):
+            prog.append('    if not outs[%s]:' % repr(name))
+            prog.append('        return regs, outs, mem_ws, %s' % repr(name))
+        prog.append("    return regs, outs, mem_ws, None")
+        return '\n'.join(prog)
+
+    def _compiled_multiple(self, observed_names):
+        """Return a string of the self.block compiled to a function running many cycles.
+
+        The generated sim_func_multiple(nsteps, inputs, regs, mems, appenders) keeps
+        every wire (including registers and memories) in a local variable, reads the
+        cycle's value of each Input from its column in inputs, and calls the appender
+        of each wire in observed_names once per cycle.  It returns the register values
+        for the next cycle, the context of the last cycle, and either None or the cycle
+        and name of the first rtl assertion to fail, which ends the run.
+        """
+        # Dev Notes:
+        # Internal variables of the generated code are prefixed with '_fs_', so that
+        # they do not collide with the (sanitized) wire names
+        regs = sorted(self.block.wirevector_subset(Register), key=lambda r: r.name)
+        inputs = sorted(self.block.wirevector_subset(Input), key=lambda w: w.name)
+        mems = sorted({net.op_param[1] for net in self.block.logic_subset('m@')},
+                      key=lambda m: m.id)
+        next_name = {r: '_fs_next%d' % i for i, r in enumerate(regs)}
+
+        def arg_varname(wire):
+            if isinstance(wire, Const):
+                return str(wire.val)
+            return self._varname(wire)
+
+        def mem_ref(mem):
+            return '_fs_' + self._mem_varname(mem)
+
+        prog = ['def sim_func_multiple(_fs_nsteps, _fs_inputs, _fs_regs, _fs_mems, _fs_append):']
+        for r in regs:
+            prog.append('    %s = _fs_regs[%s]' % (next_name[r], repr(r.name)))
+        for i, w in enumerate(inputs):
+            prog.append('    _fs_in%d = _fs_inputs[%s]' % (i, repr(w.name)))
+        for mem in mems:
+            prog.append('    %s = _fs_mems["%s"]' % (mem_ref(mem), self._mem_varname(mem)))
+        for i, name in enumerate(observed_names):
+            prog.append('    _fs_append%d = _fs_append[%s]' % (i, repr(name)))
+
+        prog.append('    for _fs_cycle in range(_fs_nsteps):')
+        for r in regs:
+            prog.append('        %s = %s' % (self._varname(r), next_name[r]))
+        for i, w in enumerate(inputs):
+            prog.append('        %s = _fs_in%d[_fs_cycle]' % (self._varname(w), i))
+        for net in self.block:
+            if net.op == '@':
+                continue  # memory writes happen after all of the reads of the cycle
+            dest = net.dests[0]
+            result = next_name[dest] if net.op == 'r' else self._varname(dest)
+            prog.extend(self._profiled(net, '        ', '%s = %s' % (
+                result, self._net_expr(net, arg_varname, mem_ref))))
+        for i, name in enumerate(observed_names):
+            wire = self.block.wirevector_by_name[name]
+            prog.append('        _fs_append%d(%s)' % (i, arg_varname(wire)))
+        prog.extend(self._counted(arg_varname, '        '))
+        for net in self.block.logic_subset('@'):
+            write_addr, write_val, write_enable = (arg_varname(a) for a in net.args)
+            prog.append('        if %s:' % write_enable)
+            prog.append('            %s[%s] = %s' % (
+                mem_ref(net.op_param[1]), write_addr, write_val))
+
+        context = self.block.wirevector_subset((Input, Register, Output))
+        context.update(self.block.wirevector_by_name[name] for name in observed_names)
+        state = '{%s}, {%s}' % (
+            ', '.join('%s: %s' % (repr(r.name), next_name[r]) for r in regs),
+            ', '.join('%s: %s' % (repr(w.name), arg_varname(w)) for w in context))
+        for name in _assertion_names(self.block):
+            wire = self.block.wirevector_by_name[name]
+            prog.append('        if not %s:' % arg_varname(wire))
+            prog.append('            return %s, (_fs_cycle, %s)' % (state, repr(name)))
+        prog.append('    return %s, None' % state)
+        return '\n'.join(prog)
+
+    def _exec_code(self, code, name):
+        """ Execute generated code, returning the function called name that it defines. """
+        context = self._exec_globals()
+        exec(compile(code, '<string>', 'exec'), context)
+        return context[name]
+
+    def _exec_globals(self):
+        """ The globals that the generated code is run with. """
+        context = {}
+        if self.profile is not None:
+            context.update({'_fs_timer': _profile_timer, '_fs_counts': self.profile.counts,
+                            '_fs_times': self.profile.times})
+        if self.activity is not None:
+            context.update({'_fs_act_prev': self.activity._prev,
+                            '_fs_act_toggled': self.activity._toggled,
+                            '_fs_act_cycle': self.activity._cycle})
+        return context
+
+    def _counted(self, value_of, indent):
+        """ The lines of generated code counting the toggles of the cycle, if enabled.
+
+        :param value_of: function mapping a wire to the code reading its value
+        """
+        if self.activity is None:
+            return []
+        prog = []
+        for i, wire in enumerate(self.activity.wires):
+            prog.append(indent + '_fs_act = %s' % value_of(wire))
+            prog.append(indent + '_fs_act_changed = _fs_act ^ _fs_act_prev[%d]' % i)
+            prog.append(indent + 'if _fs_act_changed:')
+            prog.append(indent + '    _fs_act_prev[%d] = _fs_act' % i)
+            prog.append(indent + '    _fs_act_toggled(%d, _fs_act_changed, _fs_act)' % i)
+        prog.append(indent + '_fs_act_cycle[0] += 1')
+        return prog
+
+    def _profiled(self, net, indent, line):
+        """ The lines of generated code evaluating a net, timing it when profiling. """
+        if self.profile is None or net not in self.profile.index:
+            return [indent + line]
+        i = self.profile.index[net]
+        return [indent + '_fs_start = _fs_timer()',
+                indent + line,
+                indent + '_fs_times[%d] += _fs_timer() - _fs_start' % i,
+                indent + '_fs_counts[%d] += 1' % i]
+
+    def _net_expr(self, net, arg_varname, mem_ref):
+        """Return a Python expression computing the (masked) value of net's destination.
+
+        :param arg_varname: function mapping an argument wire to the code reading it
+        :param mem_ref: function mapping a memory to the code referencing its contents
+        """
         simple_func = {  # OPS
             'w': lambda x: x,
             'r': lambda x: x,
@@ -781,7 +1848,7 @@ class FastSimulation(object):
             else:
                 return '(%s %s %d)' % (value, direction, shift_amt)
 
-        def make_split():
+        def make_split(source, split_start_bit, split_length, split_res_start_bit):
             if split_start_bit == 0:
                 bit = '(%d & %s)' % ((1 << split_length) - 1, source)
             elif len(net.args[0]) - split_start_bit == split_length:
@@ -790,70 +1857,383 @@ class FastSimulation(object):
                 bit = '(%d & (%s >> %d))' % ((1 << split_length) - 1, source, split_start_bit)
             return shift(bit, '<<', split_res_start_bit)
 
+        if net.op in simple_func:
+            argvals = (arg_varname(arg) for arg in net.args)
+            expr = simple_func[net.op](*argvals)
+        elif net.op == 'c':
+            expr = ''
+            for i in range(len(net.args)):
+                if expr != '':
+                    expr += ' | '
+                shiftby = sum(len(j) for j in net.args[i + 1:])
+                expr += shift(arg_varname(net.args[i]), '<<', shiftby)
+        elif net.op == 's':
+            source = arg_varname(net.args[0])
+            expr = ''
+            split_length = 0
+            split_start_bit = -2
+            split_res_start_bit = -1
+
+            for i, b in enumerate(net.op_param):
+                if b != split_start_bit + split_length:
+                    if split_start_bit >= 0:
+                        # create a wire
+                        expr += make_split(source, split_start_bit, split_length,
+                                           split_res_start_bit) + '|'
+                    split_length = 1
+                    split_start_bit = b
+                    split_res_start_bit = i
+                else:
+                    split_length += 1
+            expr += make_split(source, split_start_bit, split_length, split_res_start_bit)
+        elif net.op == 'm':
+            read_addr = arg_varname(net.args[0])
+            mem = net.op_param[1]
+            if isinstance(net.op_param[1], RomBlock):
+                expr = '%s._get_read_data(%s)' % (mem_ref(mem), read_addr)
+            else:  # memories act async for reads
+                expr = '%s.get(%s, %s)' % (mem_ref(mem), read_addr, self.default_value)
+        else:
+            raise PyrtlError('FastSimulation cannot handle primitive "%s"' % net.op)
+
+        if len(net.dests[0]) == self._no_mask_bitwidth[net.op](net):
+            return expr
+        else:
+            return '%s & %s' % (str(net.dests[0].bitmask), expr)
+
+
+class LaneParallelSimulation(FastSimulation):
+    """A class for simulating many independent lanes of stimulus at once.
+
+    Every bit of every wire is held as a Python int with bit k holding the
+    value on lane k, so a single generated "&", "|", "^" or "~" evaluates
+    that gate for all of the lanes at once.  This only works for bitwise
+    logic, and so the block must be made only of the ops w, ~, &, |, ^, n,
+    x, c, s, and r -- which is exactly what pyrtl.synthesize produces for
+    designs without memories.  Inputs, Outputs, and the trace are in terms
+    of ordinary values: one value per lane.
+
+    Example ::
+
+        pyrtl.synthesize()
+        sim = pyrtl.LaneParallelSimulation(lanes=3)
+        sim.step({'a': [1, 2, 3], 'b': 4})  # b is 4 on every lane
+        sim.inspect('sum')  # the list of the values of 'sum' on each lane
+        sim.tracers[2].print_trace()  # the trace of lane 2
+    """
+
+    def __init__(
+            self, lanes=64, register_value_map=None, default_value=0,
+            tracer=True, block=None, code_file=None):
+        """ Instantiates a lane parallel simulation.
+
+        :param lanes: the number of independent lanes to simulate at once
+        :param register_value_map: Defines the initial value for the registers
+          specified, either as a single value for every lane or as a list with
+          one value per lane.  Format: {Register: value or [value, ...]}.
+        :param default_value: the value that all unspecified registers initialize to
+        :param tracer: If True (the default), a SimulationTrace is created for each
+          lane and stored in the member variable .tracers.  A list of one
+          SimulationTrace per lane can also be passed, or None to disable tracing.
+        :param block: the hardware block to be simulated (defaults to the working block)
+        :param code_file: The file in which to store a copy of the generated
+          python code. Defaults to no code being stored.
+        """
+        if lanes < 1:
+            raise PyrtlError('a lane parallel simulation needs at least one lane')
+        block = working_block(block)
+        self.lanes = lanes
+        self._lane_mask = (1 << lanes) - 1
+        if tracer is True:
+            tracer = [SimulationTrace(block=block) for _ in range(lanes)]
+        elif tracer is not None:
+            tracer = list(tracer)
+            if len(tracer) != lanes:
+                raise PyrtlError('need exactly one SimulationTrace for each lane')
+        self.tracers = tracer
+        super(LaneParallelSimulation, self).__init__(
+            register_value_map=register_value_map, default_value=default_value,
+            tracer=None, block=block, code_file=code_file)
+
+    def _initialize(self, register_value_map=None, memory_value_map=None, default_value=None):
+        if default_value is None:
+            default_value = self.default_value
+        if register_value_map is None:
+            register_value_map = {}
+
+        for net in self.block.logic:
+            if net.op not in self._lane_func and net.op not in 'csr':
+                raise PyrtlError(
+                    'LaneParallelSimulation cannot handle primitive "%s", only bitwise '
+                    'logic can be simulated in parallel (try pyrtl.synthesize first)' % net.op)
+
+        for r in self.block.wirevector_subset(Register):
+            self.regs[r.name] = self._pack(register_value_map.get(r, default_value), r)
+
+        s = self._compiled()
+        if self.code_file is not None:
+            with open(self.code_file, 'w') as file:
+                file.write(s)
+
+        self.sim_func = self._exec_code(s, 'sim_func')
+
+    def step(self, provided_inputs):
+        """ Run the simulation for a cycle on every lane
+
+        :param provided_inputs: a dictionary mapping WireVectors (or their names)
+          to either a list with the value on each lane, or a single value to be
+          used on every lane
+          eg: {wire: [3, 4, 5], "wire_name": 17}
+        """
+        ins = {}
+        for wire, values in provided_inputs.items():
+            wire = self.block.get_wirevector_by_name(wire) if isinstance(wire, str) else wire
+            ins[wire.name] = self._pack(values, wire)
+        for name in self.input_order:
+            if name not in ins:
+                raise PyrtlError('Input "%s" has no input value specified' % name)
+        ins.update(self.regs)
+
+        # propagate through logic
+        self.regs, self.outs = self.sim_func(ins)
+
+        self.context = self.outs.copy()
+        self.context.update(ins)  # also gets old register values
+        if self.tracers is not None:
+            for name in self.tracers[0].trace:
+                for tracer, value in zip(self.tracers, self._unpack(self.context[name])):
+                    tracer.trace[name].append(value)
+
+        # check the rtl assertions, which have to hold on every lane
+        self._cycle += 1
+        for w in self.block.rtl_assert_dict:
+            if self.context[w.name][0] != self._lane_mask:
+                raise _assertion_failure(self.block, w.name, self._cycle - 1)
+
+    def step_multiple(self, provided_inputs={}, expected_outputs={}, nsteps=None,
+                      file=sys.stdout, stop_after_first_error=False):
+        """ Take the simulation forward N cycles on every lane.
+
+        The arguments are the same as for FastSimulation.step_multiple, except that
+        each of the N values of an input or expected output is itself either a list
+        of the values on each lane or a single value shared by every lane.  Errors
+        are reported with the list of the values on each lane.
+        """
+        if not nsteps and len(provided_inputs) == 0:
+            raise PyrtlError('need to supply either input values or a number of steps to simulate')
+        if nsteps is None:
+            nsteps = max(len(v) for v in provided_inputs.values())
+        if nsteps < 1:
+            raise PyrtlError("must simulate at least one step")
+        if any(len(v) < nsteps for v in provided_inputs.values()):
+            raise PyrtlError(
+                "must supply a value for each provided wire "
+                "for each step of simulation")
+        if any(len(v) < nsteps for v in expected_outputs.values()):
+            raise PyrtlError(
+                "any expected outputs must have a supplied value "
+                "each step of simulation")
+
+        failed = []
+        for i in range(nsteps):
+            self.step({w: v[i] for w, v in provided_inputs.items()})
+            for expvar in expected_outputs.keys():
+                expected = expected_outputs[expvar][i]
+                if isinstance(expected, numbers.Integral):
+                    expected = [expected] * self.lanes
+                actual = self.inspect(expvar)
+                if list(expected) != actual:
+                    failed.append((i, expvar, expected, actual))
+            if failed and stop_after_first_error:
+                break
+
+        if failed:
+            file.write("Unexpected output on one or more steps:\n")
+            for (step, name, expected, actual) in failed:
+                file.write("step {} {}: expected {} actual {}\n"
+                           .format(step, self._to_name(name), expected, actual))
+            file.flush()
+
+    def inspect(self, w):
+        """ Get the value of a wirevector on each lane in the last simulation cycle.
+
+        :param w: the name of the WireVector to inspect
+        :return: a list of the value of w on each lane
+        """
+        try:
+            return self._unpack(self.context[self._to_name(w)])
+        except AttributeError:
+            raise PyrtlError("No context available. Please run a simulation step in "
+                             "order to populate values for wires")
+
+    def step_fast(self, values, validate=False):
+        """ Run the simulation for a cycle on every lane, with the inputs given by position.
+
+        The values are in the order of .input_order, each given as in step, and
+        are always checked as in step.
+        """
+        self.step(dict(zip(self.input_order, values)))
+
+    def inspector(self, w):
+        """ Get a function returning the list of the values of w on each lane. """
+        name = self.block.get_wirevector_by_name(self._to_name(w), strict=True).name
+        return lambda: self.inspect(name)
+
+    def inspect_mem(self, mem):
+        raise PyrtlError('LaneParallelSimulation does not support memories')
+
+    def snapshot(self):
+        """ Capture the register state of every lane.
+
+        :return: a dictionary {'registers': {name: [value on each lane]}, 'memories': {}}
+        """
+        return {'registers': {name: self._unpack(words) for name, words in self.regs.items()},
+                'memories': {}}
+
+    def restore(self, snapshot):
+        """ Return the registers of every lane to a state captured by snapshot().
+
+        Register values can be given as a list with one value per lane, or as a single
+        value for every lane.  Registers missing from the snapshot are set to the default
+        value.
+        """
+        registers = snapshot.get('registers', {})
+        if snapshot.get('memories'):
+            raise PyrtlError('LaneParallelSimulation does not support memories')
+        regs = {}
+        for reg in self.block.wirevector_subset(Register):
+            regs[reg.name] = self._pack(registers.get(reg.name, self.default_value), reg)
+        unknown = set(registers) - set(regs)
+        if unknown:
+            raise PyrtlError('snapshot has values for unknown registers %s' % sorted(unknown))
+        self.regs = regs
+
+    def reset(self, register_value_map=None, memory_value_map=None):
+        """ Return every lane to its initial state, without generating code again.
+
+        The register values are given as in __init__; as memories are not supported,
+        memory_value_map must be empty.
+        """
+        self.restore(_initial_snapshot(self.block, register_value_map, memory_value_map))
+        self._cycle = 0
+        if hasattr(self, 'context'):
+            del self.context  # nothing to inspect until the next step
+        for tracer in self.tracers or ():
+            tracer.clear()
+
+    def fork(self, tracer=True):
+        """ Create an independent copy of the simulation of every lane in its current state.
+
+        :param tracer: True (the default) creates new SimulationTraces, a list of one
+          SimulationTrace per lane can also be passed, or None to disable tracing
+        """
+        if tracer is True:
+            tracer = [SimulationTrace(block=self.block) for _ in range(self.lanes)]
+        elif tracer is not None:
+            tracer = list(tracer)
+            if len(tracer) != self.lanes:
+                raise PyrtlError('need exactly one SimulationTrace for each lane')
+        sim = copy.copy(self)
+        sim.tracers = tracer
+        sim.regs = dict(self.regs)
+        return sim
+
+    def _pack(self, values, wire):
+        """ Transpose per-lane values into a list of lane words, one per bit of wire. """
+        if isinstance(values, numbers.Integral):
+            values = [values] * self.lanes
+        if len(values) != self.lanes:
+            raise PyrtlError('Wire {} needs one value for each of the {} lanes'
+                             .format(wire, self.lanes))
+        words = [0] * wire.bitwidth
+        for lane, value in enumerate(values):
+            if value > wire.bitmask or value < 0:
+                raise PyrtlError("Wire {} has value {} which cannot be represented"
+                                 " using its bitwidth".format(wire, value))
+            lane_bit = 1 << lane
+            while value:
+                low = value & -value
+                words[low.bit_length() - 1] |= lane_bit
+                value ^= low
+        return words
+
+    def _unpack(self, words):
+        """ Transpose a list of lane words back into the value on each lane. """
+        values = [0] * self.lanes
+        for bit, word in enumerate(words):
+            bit_value = 1 << bit
+            while word:
+                low = word & -word
+                values[low.bit_length() - 1] |= bit_value
+                word ^= low
+        return values
+
+    _lane_func = {  # OPS, each with the all lanes mask "m" as the first argument
+        'w': lambda m, x: x,
+        '~': lambda m, x: '(%s^%s)' % (m, x),
+        '&': lambda m, l, r: '(%s&%s)' % (l, r),
+        '|': lambda m, l, r: '(%s|%s)' % (l, r),
+        '^': lambda m, l, r: '(%s^%s)' % (l, r),
+        'n': lambda m, l, r: '(%s^(%s&%s))' % (m, l, r),
+        'x': lambda m, sel, f, t: '((%s&%s)|((%s^%s)&%s))' % (sel, t, m, sel, f),
+    }
+
+    def _compiled(self):
+        """Return a string of the self.block compiled to a lane parallel function.
+
+        At code generation time each wire is a list of Python expressions, one
+        for each of its bits; selects and concats just rearrange those lists and
+        so cost nothing at simulation time.
+        """
+        mask = str(self._lane_mask)
+        prog = ['def sim_func(d):', '    regs = {}', '    outs = {}']
+        bits = {}
+        tmp_names = ('_lane%d' % i for i in itertools.count())
+
+        for w in self.block.wirevector_subset((Input, Register)):
+            bits[w] = []
+            for i in range(w.bitwidth):
+                name = next(tmp_names)
+                prog.append('    %s = d[%s][%d]' % (name, repr(w.name), i))
+                bits[w].append(name)
+        for w in self.block.wirevector_subset(Const):
+            bits[w] = [mask if (w.val >> i) & 1 else '0' for i in range(w.bitwidth)]
+
+        def fit(arg_bits, wire):
+            return (arg_bits + ['0'] * wire.bitwidth)[:wire.bitwidth]
+
         for net in self.block:
-            if net.op in simple_func:
-                argvals = (self._arg_varname(arg) for arg in net.args)
-                expr = simple_func[net.op](*argvals)
-            elif net.op == 'c':
-                expr = ''
-                for i in range(len(net.args)):
-                    if expr != '':
-                        expr += ' | '
-                    shiftby = sum(len(j) for j in net.args[i + 1:])
-                    expr += shift(self._arg_varname(net.args[i]), '<<', shiftby)
+            dest = net.dests[0]
+            if net.op == 'r':
+                prog.append('    regs[%s] = [%s]' % (
+                    repr(dest.name), ', '.join(fit(bits[net.args[0]], dest))))
+                continue
             elif net.op == 's':
-                source = self._arg_varname(net.args[0])
-                expr = ''
-                split_length = 0
-                split_start_bit = -2
-                split_res_start_bit = -1
-
-                for i, b in enumerate(net.op_param):
-                    if b != split_start_bit + split_length:
-                        if split_start_bit >= 0:
-                            # create a wire
-                            expr += make_split() + '|'
-                        split_length = 1
-                        split_start_bit = b
-                        split_res_start_bit = i
-                    else:
-                        split_length += 1
-                expr += make_split()
-            elif net.op == 'm':
-                read_addr = self._arg_varname(net.args[0])
-                mem = net.op_param[1]
-                if isinstance(net.op_param[1], RomBlock):
-                    expr = 'd["%s"]._get_read_data(%s)' % (self._mem_varname(mem), read_addr)
-                else:  # memories act async for reads
-                    expr = 'd["%s"].get(%s, %s)' % (self._mem_varname(mem),
-                                                    read_addr, self.default_value)
-            elif net.op == '@':
-                mem = self._mem_varname(net.op_param[1])
-                write_addr, write_val, write_enable = (self._arg_varname(a) for a in net.args)
-                prog.append('    if {}:'.format(write_enable))
-                prog.append('        mem_ws.append(("{}", {}, {}))'
-                            .format(mem, write_addr, write_val))
-                continue  # memwrites are special
-            else:
-                raise PyrtlError('FastSimulation cannot handle primitive "%s"' % net.op)
-
-            # prog.append('    #  ' + str(net))
-            result = self._dest_varname(net.dests[0])
-            if len(net.dests[0]) == self._no_mask_bitwidth[net.op](net):
-                prog.append("    %s = %s" % (result, expr))
+                bits[dest] = [bits[net.args[0]][b] for b in net.op_param]
+            elif net.op == 'c':
+                bits[dest] = [b for arg in reversed(net.args) for b in bits[arg]]
+            elif net.op == 'w':
+                bits[dest] = fit(bits[net.args[0]], dest)
             else:
-                mask = str(net.dests[0].bitmask)
-                prog.append('    %s = %s & %s' % (result, mask, expr))
+                arg_bits = [fit(bits[arg], dest) for arg in net.args]
+                if net.op == 'x':  # the select is a single bit for all of the dest bits
+                    arg_bits[0] = [bits[net.args[0]][0]] * dest.bitwidth
+                bits[dest] = []
+                for bit_args in zip(*arg_bits):
+                    name = next(tmp_names)
+                    prog.append('    %s = %s' % (name, self._lane_func[net.op](mask, *bit_args)))
+                    bits[dest].append(name)
+            if isinstance(dest, Output):
+                prog.append('    outs[%s] = [%s]' % (repr(dest.name), ', '.join(bits[dest])))
 
         # add traced wires to dict
-        if self.tracer is not None:
-            for wire_name in self.tracer.trace:
+        if self.tracers is not None:
+            for wire_name in self.tracers[0].trace:
                 wire = self.block.wirevector_by_name[wire_name]
-                if not isinstance(wire, (Input, Const, Register, Output)):
-                    v_wire_name = self._varname(wire)
-                    prog.append('    outs["%s"] = %s' % (wire_name, v_wire_name))
+                if not isinstance(wire, (Input, Register, Output)):
+                    prog.append('    outs[%s] = [%s]' % (repr(wire_name), ', '.join(bits[wire])))
 
-        prog.append("    return regs, outs, mem_ws")
+        prog.append('    return regs, outs')
         return '\n'.join(prog)
 
 
@@ -951,11 +2331,350 @@ def _trace_sort_key(w):
     return [tryint(c) for c in re.split('([0-9]+)', w)]
 
 
+def _vcd_declarations(wires_to_track, names):
+    """ Declare the wires of a trace for a VCD file.
+
+    :param wires_to_track: the wires of the trace, in the order they are tracked
+    :param names: the names of the wires to declare, in the order to declare them
+    :return: a pair (sanitizer mapping names to VCD names, [declaration lines])
+
+    Names that are not valid Verilog identifiers are replaced by _vcd_tmp_N, and a
+    comment giving the real name follows their declaration, which is what
+    trace_from_vcd uses to map the signal back to its wire.
+    """
+    sanitizer = _VerilogSanitizer('_vcd_tmp_')
+    for wire in wires_to_track:
+        sanitizer.make_valid_string(wire.name)
+    bitwidths = {wire.name: wire.bitwidth for wire in wires_to_track}
+    lines = []
+    for name in names:
+        varname = sanitizer[name]
+        lines.append('$var wire %d %s %s $end\n' % (bitwidths[name], varname, varname))
+        if varname != name:
+            lines.append('$comment pyrtl_name %s %s $end\n' % (varname, name))
+    return sanitizer, lines
+
+
+try:
+    array.array('Q')
+    _TRACE_WORD = 'Q'
+except ValueError:  # no unsigned long long arrays before Python 3.3
+    _TRACE_WORD = 'L'
+_TRACE_WORD_BITS = 8 * array.array(_TRACE_WORD).itemsize
+
+
+class _TraceSequence(collections.Sequence):
+    """ Comparison and printing shared by the list-like stores of a wire's values. """
+
+    __slots__ = ()
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class CompactTrace(_TraceSequence):
+    """ The values of one wire in a trace, stored compactly.
+
+    This behaves like the list of values used by default (it can be indexed,
+    sliced, iterated, appended to, and compared with lists) but, rather than a
+    Python int per cycle, only the cycles on which the value changes are kept,
+    as a pair of arrays holding the cycle and the new value.  When a wire turns
+    out to change on most cycles, every value is kept in one array instead.
+    The values of wires wider than a machine word are kept in lists rather
+    than typed arrays.
+    """
+
+    __slots__ = ('_bitwidth', '_len', '_times', '_values', '_dense')
+
+    def __init__(self, bitwidth, values=()):
+        self._bitwidth = bitwidth
+        self._clear()
+        self.extend(values)
+
+    def _column(self):
+        return array.array(_TRACE_WORD) if self._bitwidth <= _TRACE_WORD_BITS else []
+
+    def _clear(self):
+        self._len = 0
+        self._times = array.array(_TRACE_WORD)  # cycles on which the value changed
+        self._values = self._column()  # the value from each of those cycles on
+        self._dense = None  # every value, once the changes are too frequent
+
+    def _make_dense(self):
+        dense = self._column()
+        dense.extend(self)
+        self._dense = dense
+        self._times = self._values = None
+
+    def append(self, value):
+        n = self._len
+        self._len = n + 1
+        if self._dense is not None:
+            self._dense.append(value)
+        elif not n or value != self._values[-1]:
+            self._times.append(n)
+            self._values.append(value)
+            # a change costs two words, so switch once most cycles are changes
+            if 2 * len(self._times) > n + 64:
+                self._make_dense()
+
+    def extend(self, values):
+        values = iter(values)
+        if self._dense is not None:
+            before = len(self._dense)
+            self._dense.extend(values)
+            self._len += len(self._dense) - before
+            return
+        # append inlined, as long runs of values are often added at once
+        times, stored = self._times, self._values
+        n = self._len
+        last = stored[-1] if n else None
+        for value in values:
+            if value != last:
+                times.append(n)
+                stored.append(value)
+                last = value
+                if 2 * len(times) > n + 64:
+                    self._len = n + 1
+                    self._make_dense()
+                    self.extend(values)  # the rest go straight into the dense array
+                    return
+            n += 1
+        self._len = n
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if self._dense is not None:
+                return list(self._dense[index])
+            return [self[i] for i in range(*index.indices(self._len))]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('trace index out of range')
+        if self._dense is not None:
+            return self._dense[index]
+        return self._values[bisect.bisect_right(self._times, index) - 1]
+
+    def __iter__(self):
+        if self._dense is not None:
+            return iter(self._dense)
+        ends = itertools.chain(itertools.islice(self._times, 1, None), (self._len,))
+        return itertools.chain.from_iterable(
+            itertools.repeat(value, end - start)
+            for value, start, end in zip(self._values, self._times, ends))
+
+    def __setitem__(self, index, value):
+        values = list(self)
+        values[index] = value
+        self._clear()
+        self.extend(values)
+
+    def __delitem__(self, index):
+        values = list(self)
+        del values[index]
+        self._clear()
+        self.extend(values)
+
+
+class DiskTrace(_TraceSequence):
+    """ The values of one wire in a trace, stored in a file.
+
+    This behaves like the list of values used by default, but new values are
+    only buffered in memory until enough of them are ready to be appended to the
+    file, and reading pages the file back in a chunk at a time.  Each value is
+    stored as the number of little-endian 64-bit words its bitwidth needs, so
+    the length of a trace is bounded by the disk rather than by memory.  No
+    file is held open between writes or reads, so there is no limit on the
+    number of wires traced.
+    """
+
+    buffer_size = 1 << 14  # values held in memory before being written out
+    chunk_size = 1 << 12  # values read from the file at a time
+
+    def __init__(self, filename, bitwidth, create=True):
+        """
+        :param filename: the file holding the values
+        :param bitwidth: the bitwidth of the wire
+        :param create: if True, start a new empty file; otherwise use the values
+          already in the file
+        """
+        self.filename = filename
+        self._words = (bitwidth + 63) // 64 or 1
+        self._itemsize = 8 * self._words
+        if create:
+            open(filename, 'wb').close()
+        self._stored = os.path.getsize(filename) // self._itemsize  # values in the file
+        self._buffer = []  # values not yet written to the file
+        self._chunk, self._chunk_values = None, None  # the latest chunk read back in
+
+    def flush(self):
+        """ Append the buffered values to the file. """
+        if not self._buffer:
+            return
+        with open(self.filename, 'ab') as f:
+            f.write(self._pack(self._buffer))
+        self._stored += len(self._buffer)
+        self._buffer = []
+        self._chunk = None  # the last chunk may have grown
+
+    def _read_chunk(self, chunk):
+        if chunk != self._chunk:
+            start = chunk * self.chunk_size
+            count = min(self.chunk_size, self._stored - start)
+            with open(self.filename, 'rb') as f:
+                f.seek(start * self._itemsize)
+                data = struct.unpack('<%dQ' % (count * self._words), f.read(count * self._itemsize))
+            words = self._words
+            if words == 1:
+                values = list(data)
+            else:
+                values = [sum(data[n + i] << (64 * i) for i in range(words))
+                          for n in range(0, len(data), words)]
+            self._chunk, self._chunk_values = chunk, values
+        return self._chunk_values
+
+    def append(self, value):
+        self._buffer.append(value)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def extend(self, values):
+        values = iter(values)
+        while True:
+            # a buffer's worth at a time, so a long run of values is never all in memory
+            chunk = list(itertools.islice(values, self.buffer_size))
+            if not chunk:
+                break
+            self._buffer.extend(chunk)
+            if len(self._buffer) >= self.buffer_size:
+                self.flush()
+
+    def __len__(self):
+        return self._stored + len(self._buffer)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('trace index out of range')
+        if index >= self._stored:
+            return self._buffer[index - self._stored]
+        return self._read_chunk(index // self.chunk_size)[index % self.chunk_size]
+
+    def __iter__(self):
+        stored = self._stored
+        for chunk in range((stored + self.chunk_size - 1) // self.chunk_size):
+            for value in self._read_chunk(chunk):
+                yield value
+        for value in self[stored:]:
+            yield value
+
+    def _rewrite(self, values):
+        open(self.filename, 'wb').close()
+        self._stored, self._buffer, self._chunk = 0, [], None
+        self.extend(values)
+
+    def _pack(self, values):
+        words = self._words
+        if words == 1:
+            data = values
+        else:
+            mask = (1 << 64) - 1
+            data = [(v >> (64 * i)) & mask for v in values for i in range(words)]
+        return struct.pack('<%dQ' % len(data), *data)
+
+    def _truncate(self, length):
+        """ Drop the values from index length on, without reading the file. """
+        if length >= self._stored:
+            del self._buffer[length - self._stored:]
+            return
+        with open(self.filename, 'r+b') as f:
+            f.truncate(length * self._itemsize)
+        self._stored, self._buffer, self._chunk = length, [], None
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            values = list(self)
+            values[index] = value
+            self._rewrite(values)
+            return
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('trace index out of range')
+        if index >= self._stored:
+            self._buffer[index - self._stored] = value
+            return
+        with open(self.filename, 'r+b') as f:  # overwritten in place
+            f.seek(index * self._itemsize)
+            f.write(self._pack([value]))
+        self._chunk = None
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1 and stop >= len(self):
+                # a suffix, such as everything when a simulation is reset
+                self._truncate(min(start, len(self)))
+                return
+        values = list(self)
+        del values[index]
+        self._rewrite(values)
+
+
+_DISK_TRACE_MANIFEST = 'trace.json'
+
+
+def _write_disk_trace_manifest(path, wvs):
+    """ Describe the wires of a trace stored on disk, for SimulationTrace.open. """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    wires = [{'name': wv.name, 'bitwidth': wv.bitwidth,
+              'kind': type(wv).__name__ if isinstance(wv, (Input, Output, Register))
+              else 'WireVector'}
+             for wv in wvs]
+    with open(os.path.join(path, _DISK_TRACE_MANIFEST), 'w') as f:
+        json.dump({'format': 'pyrtl-trace', 'version': 1, 'wires': wires}, f, indent=1)
+
+
 class TraceStorage(collections.Mapping):
     __slots__ = ('__data',)
 
-    def __init__(self, wvs):
-        self.__data = {wv.name: [] for wv in wvs}
+    def __init__(self, wvs, storage='list', path=None, create=True):
+        if storage == 'list':
+            self.__data = {wv.name: [] for wv in wvs}
+        elif storage == 'compact':
+            self.__data = {wv.name: CompactTrace(wv.bitwidth) for wv in wvs}
+        elif storage == 'disk':
+            if path is None:
+                raise PyrtlError('a trace stored on disk needs a path to store it in')
+            wvs = sorted(wvs, key=lambda wv: wv.name)
+            if create:
+                _write_disk_trace_manifest(path, wvs)
+            self.__data = {wv.name: DiskTrace(os.path.join(path, '%d.trace' % n),
+                                              wv.bitwidth, create)
+                           for n, wv in enumerate(wvs)}
+        elif callable(storage):
+            self.__data = {wv.name: storage(wv) for wv in wvs}
+        else:
+            raise PyrtlError('unknown trace storage "%s", expected "list", "compact", '
+                             'or "disk"' % storage)
 
     def __len__(self):
         return len(self.__data)
@@ -980,22 +2699,26 @@ class TraceStorage(collections.Mapping):
 class SimulationTrace(object):
     """ Storage and presentation of simulation waveforms. """
 
-    def __init__(self, wires_to_track=None, block=None):
+    def __init__(self, wires_to_track=None, block=None, storage='list', path=None):
         """
         Creates a new Simulation Trace
 
         :param wires_to_track: The wires that the tracer should track
         :param block:
+        :param storage: how the values of each wire are stored: 'list' (the default)
+          keeps a list of ints, while 'compact' keeps a CompactTrace, which only
+          stores the cycles on which the value changes and uses typed arrays.  Use
+          'compact' for long traces, as it uses far less memory.  For traces too
+          long for memory, 'disk' keeps a DiskTrace file for each wire in the
+          directory given by path, which can be reopened with SimulationTrace.open.
+        :param path: the directory to store the trace in, with storage='disk'.
+          Any trace already stored there is replaced.
         """
         self.block = working_block(block)
 
-        def is_internal_name(name):
-            return (name.startswith('tmp') or name.startswith('const')
-                    # or name.startswith('synth_')
-                    or name.endswith("'"))
-
         if wires_to_track is None:
-            wires_to_track = [w for w in self.block.wirevector_set if not is_internal_name(w.name)]
+            wires_to_track = [w for w in self.block.wirevector_set
+                              if not _is_internal_name(w.name)]
         elif wires_to_track == 'all':
             wires_to_track = self.block.wirevector_set
 
@@ -1003,9 +2726,57 @@ class SimulationTrace(object):
             raise PyrtlError("There needs to be at least one named wire "
                              "for simulation to be useful")
         self.wires_to_track = wires_to_track
-        self.trace = TraceStorage(wires_to_track)
+        self.storage = storage
+        self.path = path
+        self.trace = TraceStorage(wires_to_track, storage, path)
         self._wires = {wv.name: wv for wv in wires_to_track}
 
+    @classmethod
+    def open(cls, path):
+        """ Reopen a trace stored on disk, without simulating it again.
+
+        :param path: the directory given when the trace was created with storage='disk'
+        :return: a SimulationTrace of the stored values, which can be printed,
+          rendered, or extended just like the original
+
+        The wires of the reopened trace are stand-ins, with the names, bitwidths, and
+        kinds (Input, Output, Register, or WireVector) of the traced wires, held in a
+        new block of their own.
+        """
+        try:
+            with open(os.path.join(path, _DISK_TRACE_MANIFEST)) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            raise PyrtlError('no trace is stored on disk at "%s"' % path)
+        block = Block()
+        kinds = {'Input': Input, 'Output': Output, 'Register': Register,
+                 'WireVector': WireVector}
+        wires = [kinds[w['kind']](bitwidth=w['bitwidth'], name=w['name'], block=block)
+                 for w in manifest['wires']]
+        trace = cls.__new__(cls)
+        trace.block = block
+        trace.wires_to_track = wires
+        trace.storage = 'disk'
+        trace.path = path
+        trace.trace = TraceStorage(wires, 'disk', path, create=False)
+        trace._wires = {wv.name: wv for wv in wires}
+        return trace
+
+    def flush(self):
+        """ Write out any values of a trace stored on disk still buffered in memory.
+
+        Do this before the trace is reopened elsewhere with SimulationTrace.open.
+        """
+        for values in self.trace.values():
+            if isinstance(values, DiskTrace):
+                values.flush()
+
+    def _fork(self, block):
+        """ A new empty tracer of the same wires, stored the same way, for a fork. """
+        path = tempfile.mkdtemp(prefix='pyrtl-trace-') if self.storage == 'disk' else None
+        return SimulationTrace(wires_to_track=self.wires_to_track, block=block,
+                               storage=self.storage, path=path)
+
     def __len__(self):
         """ Return the current length of the trace in cycles. """
         if len(self.trace) == 0:
@@ -1014,6 +2785,11 @@ class SimulationTrace(object):
         wire, value_list = next(x for x in self.trace.items())
         return len(value_list)
 
+    def clear(self):
+        """ Remove every step from the trace, keeping the wires being tracked. """
+        for name in self.trace:
+            del self.trace[name][:]
+
     def add_step(self, value_map):
         """ Add the values in value_map to the end of the trace. """
         if len(self.trace) == 0:
@@ -1080,9 +2856,8 @@ class SimulationTrace(object):
         # dump header info
         # file_timestamp = time.strftime("%a, %d %b %Y %H:%M:%S (UTC/GMT)", time.gmtime())
         # print >>file, " ".join(["$date", file_timestamp, "$end"])
-        self.internal_names = _VerilogSanitizer('_vcd_tmp_')
-        for wire in self.wires_to_track:
-            self.internal_names.make_valid_string(wire.name)
+        names = sorted(self.trace, key=_trace_sort_key)
+        self.internal_names, declarations = _vcd_declarations(self.wires_to_track, names)
 
         def _varname(wireName):
             """ Converts WireVector names to internal names """
@@ -1098,9 +2873,7 @@ class SimulationTrace(object):
         # dump variables
         if include_clock:
             print(' '.join(['$var', 'wire', '1', 'clk', 'clk', '$end']), file=file)
-        for wn in sorted(self.trace, key=_trace_sort_key):
-            print(' '.join(['$var', 'wire', str(self._wires[wn].bitwidth),
-                            _varname(wn), _varname(wn), '$end']), file=file)
+        file.write(''.join(declarations))
         print(' '.join(['$upscope', '$end']), file=file)
         print(' '.join(['$enddefinitions', '$end']), file=file)
         print(' '.join(['$dumpvars']), file=file)
@@ -1192,10 +2965,7 @@ class SimulationTrace(object):
             trace_list = [getattr(x, 'name', x) for x in trace_list]
 
         if not trace_list:
-            raise PyrtlError(
-                "Empty trace list. This may have occurred because "
-                "untraceable wires were removed prior to simulation, "
-                "if a CompiledSimulation was used.")
+            raise PyrtlError("Empty trace list.")
 
         # print the 'ruler' which is just a list of 'ticks'
         # mapped by the pretty map
@@ -1216,3 +2986,445 @@ class SimulationTrace(object):
             print(formatted_trace_line(w, self.trace[w]), file=file)
         if extra_line:
             print(file=file)
+
+
+class TraceDivergence(collections.namedtuple('TraceDivergence', 'first count expected actual')):
+    """ How one wire differs between two traces.
+
+    The fields are the first cycle on which the values differ, the number of cycles
+    on which they differ, and the expected and actual values on that first cycle.
+    """
+    __slots__ = ()
+
+
+_DIFF_CHUNK = 1 << 12  # values compared at a time
+
+
+def _trace_chunks(values, length):
+    """ The first length values of a trace column, as lists of _DIFF_CHUNK values. """
+    if isinstance(values, list):
+        for start in range(0, length, _DIFF_CHUNK):
+            yield values[start:min(start + _DIFF_CHUNK, length)]
+    else:
+        it = iter(values)
+        for start in range(0, length, _DIFF_CHUNK):
+            yield list(itertools.islice(it, min(_DIFF_CHUNK, length - start)))
+
+
+def _compare_columns(expected, actual, length):
+    """ The first cycle on which two columns differ (or None) and how many cycles do. """
+    first, count = None, 0
+    start = 0
+    for exp, act in six.moves.zip(_trace_chunks(expected, length), _trace_chunks(actual, length)):
+        if exp != act:
+            # only chunks that differ are looked at value by value, and even then in C
+            if first is None:
+                first = next(itertools.compress(itertools.count(start),
+                                                six.moves.map(operator.ne, exp, act)))
+            count += sum(six.moves.map(operator.ne, exp, act))
+        start += len(exp)
+    return first, count
+
+
+def _compare_changes(expected, actual, length):
+    """ Like _compare_columns, but for two CompactTraces that only store their changes.
+
+    The values can only start or stop differing on a cycle where one of them
+    changes, so this takes time proportional to the number of changes.
+    """
+    first, count = None, 0
+    etimes, evalues = expected._times, expected._values
+    atimes, avalues = actual._times, actual._values
+    e = a = 0
+    cycle = 0
+    while cycle < length:
+        eend = etimes[e + 1] if e + 1 < len(etimes) else length
+        aend = atimes[a + 1] if a + 1 < len(atimes) else length
+        end = min(eend, aend, length)
+        if evalues[e] != avalues[a]:
+            if first is None:
+                first = cycle
+            count += end - cycle
+        if end == eend:
+            e += 1
+        if end == aend:
+            a += 1
+        cycle = end
+    return first, count
+
+
+class TraceDiff(object):
+    """ The differences between two traces, as found by compare_traces.
+
+    The wires present in both traces are listed in matching (if their values
+    agree) or are keys of divergences (if they do not), which maps each wire name
+    to a TraceDivergence.  Wires only traced in one of the two are listed in
+    only_expected and only_actual, and lengths holds the number of cycles in each
+    trace.  Only the cycles present in both traces are compared.
+    """
+
+    def __init__(self, lengths, divergences, matching, only_expected, only_actual):
+        self.lengths = lengths
+        self.divergences = divergences
+        self.matching = matching
+        self.only_expected = only_expected
+        self.only_actual = only_actual
+
+    @property
+    def equal(self):
+        """ True if the traces have the same wires, length, and values. """
+        return (not self.divergences and not self.only_expected and not self.only_actual
+                and self.lengths[0] == self.lengths[1])
+
+    @property
+    def first_cycle(self):
+        """ The first cycle on which any wire diverges, or None if none do. """
+        if not self.divergences:
+            return None
+        return min(d.first for d in self.divergences.values())
+
+    def first_divergence(self):
+        """ The names of the wires that diverge on first_cycle, the earliest to do so. """
+        first = self.first_cycle
+        return sorted((name for name, d in self.divergences.items() if d.first == first),
+                      key=_trace_sort_key)
+
+    def print_report(self, file=sys.stdout):
+        """ Print the differences, with the earliest diverging wires first. """
+        print(self, file=file)
+
+    def __str__(self):
+        if self.equal:
+            return 'traces match (%d wires, %d cycles)' % (len(self.matching), self.lengths[0])
+        compared = len(self.divergences) + len(self.matching)
+        lines = []
+        if self.divergences:
+            lines.append('%d of %d wires diverge, first on cycle %d'
+                         % (len(self.divergences), compared, self.first_cycle))
+        else:
+            lines.append('all %d wires compared match' % compared)
+        order = sorted(self.divergences,
+                       key=lambda name: (self.divergences[name].first, _trace_sort_key(name)))
+        for name in order:
+            d = self.divergences[name]
+            lines.append('  %s: cycle %d expected %d but was %d (%d cycles differ)'
+                         % (name, d.first, d.expected, d.actual, d.count))
+        if self.lengths[0] != self.lengths[1]:
+            lines.append('lengths differ: expected %d cycles but was %d' % self.lengths)
+        if self.only_expected:
+            lines.append('only in expected: ' + ', '.join(self.only_expected))
+        if self.only_actual:
+            lines.append('only in actual: ' + ', '.join(self.only_actual))
+        return '\n'.join(lines)
+
+
+def compare_traces(expected, actual, wires=None):
+    """ Find where the values of two traces diverge.
+
+    :param expected: a SimulationTrace, or a dictionary mapping wire names to their
+      values (as from a reference model)
+    :param actual: the trace to check against it, of the same kinds
+    :param wires: the names of the wires to compare (defaults to every wire traced
+      by both)
+    :return: a TraceDiff, holding the first cycle on which each wire diverges and
+      on how many cycles it does
+
+    The wires are matched by name, so a trace taken before synthesis or
+    optimization can be compared with one taken after.  Values are compared a
+    large chunk at a time, and traces using compact storage are compared change
+    by change, so this is fast even for very long traces.
+
+    Example ::
+
+        diff = pyrtl.compare_traces(sim_before.tracer, sim_after.tracer)
+        if not diff.equal:
+            diff.print_report()
+    """
+    expected_values = getattr(expected, 'trace', expected)
+    actual_values = getattr(actual, 'trace', actual)
+    expected_names = set(expected_values)
+    actual_names = set(actual_values)
+    if wires is None:
+        names = expected_names & actual_names
+        only_expected = sorted(expected_names - actual_names, key=_trace_sort_key)
+        only_actual = sorted(actual_names - expected_names, key=_trace_sort_key)
+    else:
+        names = [getattr(w, 'name', w) for w in wires]
+        for name in names:
+            if name not in expected_names or name not in actual_names:
+                raise PyrtlError('wire "%s" is not traced by both traces' % name)
+        only_expected, only_actual = [], []
+
+    divergences, matching = {}, []
+    lengths = [0, 0]
+    for name in sorted(names, key=_trace_sort_key):
+        exp, act = expected_values[name], actual_values[name]
+        lengths = [max(lengths[0], len(exp)), max(lengths[1], len(act))]
+        length = min(len(exp), len(act))
+        if (isinstance(exp, CompactTrace) and isinstance(act, CompactTrace)
+                and exp._dense is None and act._dense is None):
+            first, count = _compare_changes(exp, act, length)
+        else:
+            first, count = _compare_columns(exp, act, length)
+        if first is None:
+            matching.append(name)
+        else:
+            divergences[name] = TraceDivergence(first, count, exp[first], act[first])
+    return TraceDiff(tuple(lengths), divergences, matching, only_expected, only_actual)
+
+
+class _VcdColumn(object):
+    """ Where a simulator leaves the values of one wire traced by a VcdWriter.
+
+    The values are only held until the VcdWriter takes the cycles for which every
+    traced wire has a value to be written out.  Only the number of values and the
+    latest one can still be looked at.
+    """
+
+    __slots__ = ('_writer', '_pending', '_taken', '_last')
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._pending = []  # values not yet taken by the writer
+        self._taken = 0
+        self._last = None  # the latest value taken
+
+    def append(self, value):
+        self._pending.append(value)
+        writer = self._writer
+        writer._pending_values += 1
+        if writer._pending_values >= writer._next_take:
+            writer._take_complete_cycles()
+
+    def extend(self, values):
+        before = len(self._pending)
+        self._pending.extend(values)
+        writer = self._writer
+        writer._pending_values += len(self._pending) - before
+        if writer._pending_values >= writer._next_take:
+            writer._take_complete_cycles()
+
+    def __len__(self):
+        return self._taken + len(self._pending)
+
+    def __getitem__(self, index):
+        if len(self) and index in (-1, len(self) - 1):
+            return self._pending[-1] if self._pending else self._last
+        raise PyrtlError('only the latest value traced by a VcdWriter can be read back')
+
+    def __iter__(self):
+        raise PyrtlError('the values traced by a VcdWriter are written out, not kept')
+
+    def __setitem__(self, index, value=None):
+        raise PyrtlError('the values traced by a VcdWriter cannot be changed '
+                         '(a CompiledSimulation trace_ring_size cannot be used with it)')
+
+    __delitem__ = __setitem__
+
+
+class VcdWriter(SimulationTrace):
+    """ A tracer which streams the traced wires to a VCD file as the simulation runs.
+
+    Pass it as the tracer of any of the simulators.  Rather than keeping the values
+    of each wire, every cycle is written out as soon as it is complete, and only
+    the wires whose values changed are written for each cycle, so the file is
+    much smaller than the one written by print_vcd and nothing builds up in memory.
+    The header, wire names, and timescale are the same as those of print_vcd.
+
+    The output is collected in a buffer which is written to the file in large
+    pieces.  With background=True, the formatting and writing is done on a thread
+    of its own, so that the simulation does not wait on it.  Call close (or use the
+    writer in a with statement) once the simulation is done, to write out the end
+    of the file.  Clearing the writer (as resetting the simulation does) starts
+    the VCD over, which needs a file that can be seeked back to its start.
+
+    Example ::
+
+        with pyrtl.VcdWriter('waves.vcd') as vcd:
+            sim = pyrtl.FastSimulation(tracer=vcd)
+            sim.step_multiple(inputs)
+
+    As the values are not kept, the methods of SimulationTrace that print or render
+    the trace cannot be used.
+    """
+
+    _batch_cycles = 1024  # cycles collected before they are taken to be written
+
+    def __init__(self, file, wires_to_track=None, block=None, include_clock=False,
+                 background=False, buffer_size=1 << 16):
+        """
+        :param file: the file (or name of the file) to write the VCD to
+        :param wires_to_track: the wires to trace, as for SimulationTrace
+        :param block: the block being simulated (defaults to the working block)
+        :param include_clock: if True, the implicit clk is written as well
+        :param background: if True, format and write the VCD on a separate thread
+        :param buffer_size: how many characters of output are collected before
+          writing them to the file
+        """
+        self._columns = {}
+        self._pending_values = 0  # values left by the simulator, but not yet taken
+        self._next_take = 0
+        super(VcdWriter, self).__init__(wires_to_track, block, storage=self._new_column)
+        self._names = sorted(self.trace, key=_trace_sort_key)
+        self._order = [self._columns[name] for name in self._names]
+        # cycles are taken to be written in batches, to keep the cost per value low
+        self._batch_values = self._next_take = self._batch_cycles * len(self._order)
+
+        sanitizer, declarations = _vcd_declarations(self.wires_to_track, self._names)
+        self._varnames = [sanitizer[name] for name in self._names]
+        self._last_written = [None] * len(self._names)
+        self._time = 0
+        self._include_clock = include_clock
+        self._buffer_size = buffer_size
+        self._out, self._out_size = [], 0
+
+        if isinstance(file, six.string_types):
+            self._file, self._owns_file = open(file, 'w'), True
+        else:
+            self._file, self._owns_file = file, False
+        try:
+            self._start = self._file.tell()  # where clear goes back to
+        except (AttributeError, IOError, OSError, ValueError):
+            self._start = None  # not seekable, such as a pipe
+
+        header = ['$timescale 1ns $end\n', '$scope module logic $end\n']
+        if include_clock:
+            header.append('$var wire 1 clk clk $end\n')
+        header.extend(declarations)
+        header.append('$upscope $end\n$enddefinitions $end\n')
+        self._header = header
+        self._buffer(header)
+
+        self._error = None
+        self._queue = None
+        if background:
+            self._start_thread()
+
+    def _start_thread(self):
+        self._queue = queue.Queue(maxsize=16)
+        self._thread = threading.Thread(target=self._drain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stop_thread(self):
+        """ Wait for the cycles handed to the thread to be written, and end it. """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _new_column(self, wire):
+        column = self._columns[wire.name] = _VcdColumn(self)
+        return column
+
+    def _take_complete_cycles(self):
+        """ Hand the cycles for which every wire has a value on to be written. """
+        n = min(len(column._pending) for column in self._order)
+        columns = []
+        for column in self._order:
+            if n:
+                columns.append(column._pending[:n])
+                column._last = column._pending[n - 1]
+                column._taken += n
+                del column._pending[:n]
+        self._pending_values = sum(len(column._pending) for column in self._order)
+        self._next_take = self._pending_values + self._batch_values
+        if not n:
+            return
+        if self._queue is None:
+            self._write_cycles(columns)
+        else:
+            if self._error is not None:
+                raise self._error
+            self._queue.put(columns)
+
+    def _drain(self):
+        while True:
+            columns = self._queue.get()
+            if columns is None:
+                break
+            if self._error is not None:
+                continue  # keep draining, so the simulation is never blocked
+            try:
+                self._write_cycles(columns)
+            except Exception as e:  # reported back on the simulation thread
+                self._error = e
+
+    def _buffer(self, strings):
+        self._out.extend(strings)
+        self._out_size += sum(len(x) for x in strings)
+        if self._out_size >= self._buffer_size:
+            self._file.write(''.join(self._out))
+            self._out, self._out_size = [], 0
+
+    def _write_cycles(self, columns):
+        """ Write out the changes in a run of cycles, given the values of each wire. """
+        nsteps = len(columns[0])
+        changes = [[] for _ in range(nsteps)]
+        for n, values in enumerate(columns):
+            varname, last = self._varnames[n], self._last_written[n]
+            for step, value in enumerate(values):
+                if value != last:
+                    changes[step].append('b{:b} {}\n'.format(value, varname))
+                    last = value
+            self._last_written[n] = last
+
+        out = []
+        for step in range(nsteps):
+            time = 10 * self._time
+            if self._time == 0:
+                out.append('$dumpvars\n')
+                out.extend(changes[step])
+                out.append('$end\n#0\n')
+            elif changes[step] or self._include_clock:
+                out.append('#%d\n' % time)
+                out.extend(changes[step])
+            if self._include_clock:
+                out.append('b1 clk\n\n#%d\nb0 clk\n\n' % (time + 5))
+            self._time += 1
+        self._buffer(out)
+
+    def clear(self):
+        """ Start the VCD over, truncating the file back to where the writer started it. """
+        if self._file is None:
+            raise PyrtlError('a VcdWriter cannot be cleared once it is closed')
+        if self._start is None:
+            raise PyrtlError('a VcdWriter can only be cleared when writing to a seekable file')
+        if self._queue is not None:
+            self._stop_thread()
+        for column in self._order:
+            column._pending, column._taken, column._last = [], 0, None
+        self._pending_values = 0
+        self._next_take = self._batch_values
+        self._last_written = [None] * len(self._names)
+        self._time = 0
+        self._file.seek(self._start)
+        self._file.truncate()
+        self._out, self._out_size = [], 0
+        self._buffer(self._header)
+        if self._queue is not None:
+            self._start_thread()
+
+    def _fork(self, block):
+        raise PyrtlError('a VcdWriter cannot be copied for a fork, pass the tracer to use')
+
+    def close(self):
+        """ Write out the end of the VCD, and close the file if it was opened by name. """
+        if self._file is None:
+            return
+        self._take_complete_cycles()
+        if self._queue is not None:
+            self._stop_thread()
+        self._buffer(['#%d\n' % (10 * self._time)])
+        self._file.write(''.join(self._out))
+        self._out, self._out_size = [], 0
+        self._file.flush()
+        if self._owns_file:
+            self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,249 @@
+"""Simulation that starts at once and moves to compiled code once it is ready."""
+
+from __future__ import print_function, unicode_literals
+
+import sys
+import threading
+
+from .core import working_block
+from .wire import Input, Output, WireVector
+from .pyrtlexceptions import PyrtlError
+from .simulation import FastSimulation, SimulationTrace, _trace_sort_key
+from .compilesim import CompiledSimulation
+
+
+__all__ = ['TieredSimulation']
+
+
+class TieredSimulation(object):
+    """Simulate with FastSimulation while a CompiledSimulation is built in the background.
+
+    CompiledSimulation is much faster than FastSimulation once running, but gcc takes
+    a while to compile it, so which of the two finishes first depends on how long the
+    simulation runs.  TieredSimulation starts stepping straight away in a FastSimulation
+    while a thread builds the CompiledSimulation of the same block.  Once that is ready,
+    the registers and memories are copied into it and the simulation carries on there.
+    Short runs so start quickly, and long runs get the speed of the compiled code,
+    without having to pick a simulator up front.
+
+    While the compiled code is not ready, step_multiple runs the cycles asked for in
+    chunks, so that the switch can happen part way through a long run.  Both simulators
+    write to the same tracer, so the trace carries on across the switch.  If building
+    the CompiledSimulation fails (for example, because gcc is not installed), the
+    simulation simply stays in FastSimulation, and the exception is kept in
+    .compile_error.  So that the results do not depend on when gcc finishes, only
+    the wires that the compiled code can report are inspected in either simulator:
+    those in the tracer, or the Outputs when there is no tracer.
+
+    Example ::
+
+        sim = pyrtl.TieredSimulation()
+        sim.step_multiple({'a': stimulus})  # switches part way through a long run
+        sim.tier  # 'compiled' once the switch has happened, else 'fast'
+    """
+
+    _chunk = 1000  # cycles run in FastSimulation between checks for the compiled code
+
+    def __init__(self, tracer=True, register_value_map=None, memory_value_map=None,
+                 default_value=0, block=None, **compiled_args):
+        """ Start a FastSimulation, and the compilation of a CompiledSimulation.
+
+        :param tracer: the SimulationTrace shared by both simulators, as for Simulation
+        :param register_value_map: the initial value of registers, as for Simulation
+        :param memory_value_map: the initial contents of memories, as for Simulation
+        :param default_value: the value of registers not in register_value_map
+        :param block: the block to simulate (defaults to the working block)
+        :param compiled_args: other arguments for CompiledSimulation, such as cache_dir.
+          trace_ring_size and activity are not supported, as their state cannot be
+          carried over from the FastSimulation.
+        """
+        for arg in ('trace_ring_size', 'activity'):
+            if compiled_args.get(arg):
+                raise PyrtlError('TieredSimulation does not support %s' % arg)
+        self.block = working_block(block)
+        if register_value_map is None:
+            register_value_map = {}
+        if memory_value_map is None:
+            memory_value_map = {}
+        if tracer is True:
+            tracer = SimulationTrace(block=self.block)
+        self.tracer = tracer
+        self.compile_error = None  # the exception raised building the CompiledSimulation
+        self._fast = FastSimulation(
+            register_value_map=register_value_map, memory_value_map=memory_value_map,
+            default_value=default_value, tracer=tracer, block=self.block)
+        self._sim = self._fast  # the simulator currently stepping
+        self._compiled = None  # set by the thread once the CompiledSimulation is ready
+        self._thread = threading.Thread(target=self._compile, args=(
+            register_value_map, memory_value_map, default_value, compiled_args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _compile(self, register_value_map, memory_value_map, default_value, compiled_args):
+        """ Build the CompiledSimulation; run in the background thread. """
+        try:
+            self._compiled = CompiledSimulation(
+                tracer=self.tracer, register_value_map=register_value_map,
+                memory_value_map=memory_value_map, default_value=default_value,
+                block=self.block, **compiled_args)
+        except Exception as e:  # the simulation carries on in FastSimulation
+            self.compile_error = e
+
+    @property
+    def tier(self):
+        """ The simulator currently in use, either 'fast' or 'compiled'. """
+        return 'compiled' if self._sim is self._compiled else 'fast'
+
+    def wait_for_compiled(self, timeout=None):
+        """ Wait until the CompiledSimulation is ready, and switch to it.
+
+        :param timeout: the longest time to wait, in seconds (defaults to no limit)
+        :return: True if the simulation is now using the compiled code
+        """
+        self._thread.join(timeout)
+        self._switch_if_ready()
+        return self._sim is self._compiled
+
+    def _switch_if_ready(self):
+        """ Move the state of the simulation into the compiled code, once it is ready. """
+        if self._sim is self._fast and self._compiled is not None:
+            self._compiled.restore(self._fast.snapshot())
+            self._compiled._cycle = self._fast._cycle
+            if self._fast._cycle:
+                # so that inspect sees the last cycle run before the switch
+                names = self.tracer.trace if self.tracer is not None else self._compiled._outputpos
+                self._compiled._last_values = {name: self._fast.inspect(name) for name in names}
+            self._sim = self._compiled
+            self._fast = None
+
+    def step(self, provided_inputs):
+        """ Run the simulation for a cycle; see Simulation.step. """
+        self._switch_if_ready()
+        self._sim.step(provided_inputs)
+
+    def step_multiple(self, provided_inputs={}, expected_outputs={}, nsteps=None,
+                      file=sys.stdout, stop_after_first_error=False):
+        """ Take the simulation forward N cycles, where N is the number of values
+         for each provided input.
+
+        The arguments are the same as for Simulation.step_multiple, except that
+        the expected outputs must be Inputs, Outputs, or wires in the tracer, as
+        those are the wires that the compiled code can report the values of.
+        """
+
+        if not nsteps and len(provided_inputs) == 0:
+            raise PyrtlError('need to supply either input values or a number of steps to simulate')
+
+        if len(provided_inputs) > 0:
+            longest = sorted(list(provided_inputs.items()),
+                             key=lambda t: len(t[1]),
+                             reverse=True)[0]
+            msteps = len(longest[1])
+            if nsteps:
+                if (nsteps > msteps):
+                    raise PyrtlError('nsteps is specified but is greater than the '
+                                     'number of values supplied for each input')
+            else:
+                nsteps = msteps
+
+        if nsteps < 1:
+            raise PyrtlError("must simulate at least one step")
+
+        if list(filter(lambda l: len(l) < nsteps, provided_inputs.values())):
+            raise PyrtlError(
+                "must supply a value for each provided wire "
+                "for each step of simulation")
+
+        if list(filter(lambda l: len(l) < nsteps, expected_outputs.values())):
+            raise PyrtlError(
+                "any expected outputs must have a supplied value "
+                "each step of simulation")
+
+        supplied = {w.name if isinstance(w, WireVector) else w for w in provided_inputs}
+        for wire in self.block.wirevector_subset(Input):
+            if wire.name not in supplied:
+                raise PyrtlError('Input "%s" has no input value specified' % wire.name)
+        names = {expvar: expvar.name if isinstance(expvar, WireVector) else expvar
+                 for expvar in expected_outputs}
+        for name in names.values():
+            wire = self.block.get_wirevector_by_name(name, strict=True)
+            if not isinstance(wire, (Input, Output)) and not self._traced(name):
+                raise PyrtlError('TieredSimulation can only check the values of Inputs, '
+                                 'Outputs, and WireVectors in its tracer')
+
+        # the values are checked from what _run_multiple reports in either tier, as
+        # inspect cannot see Inputs or untraced Outputs in the compiled code
+        observed = {name: [] for name in names.values()}
+        failed = []
+        start = 0
+        while start < nsteps and not (failed and stop_after_first_error):
+            self._switch_if_ready()
+            count = nsteps - start
+            if stop_after_first_error:
+                count = 1  # the early stop is checked between individual steps
+            elif self._sim is not self._compiled:
+                count = min(count, self._chunk)
+            chunk = {w: v[start:start + count] for w, v in provided_inputs.items()}
+            values = self._sim._run_multiple(chunk, count, observed)
+            for name in observed:  # traced wires come back with their whole trace
+                observed[name].extend(values[name][-count:])
+            for expvar in expected_outputs.keys():
+                actual_values = observed[names[expvar]]
+                for i in range(start, start + count):
+                    expected = int(expected_outputs[expvar][i])
+                    if expected != actual_values[i]:
+                        failed.append((i, expvar, expected, actual_values[i]))
+            start += count
+
+        if failed:
+            if stop_after_first_error:
+                s = "(stopped after step with first error):"
+            else:
+                s = "on one or more steps:"
+            file.write("Unexpected output " + s + "\n")
+            file.write("{0:>5} {1:>10} {2:>8} {3:>8}\n"
+                       .format("step", "name", "expected", "actual"))
+
+            def _sort_tuple(t):
+                # Sort by step and then wire name
+                return (t[0], _trace_sort_key(t[1]))
+
+            failed_sorted = sorted(failed, key=_sort_tuple)
+            for (step, name, expected, actual) in failed_sorted:
+                file.write("{0:>5} {1:>10} {2:>8} {3:>8}\n".format(step, name, expected, actual))
+            file.flush()
+
+    def inspect(self, w):
+        """ Get the value of a wirevector in the last simulation cycle.
+
+        The wire must be in the tracer, or be an Output if there is no tracer.
+        """
+        name = w.name if isinstance(w, WireVector) else w
+        if self.tracer is not None:
+            inspectable = self._traced(name)
+        else:
+            inspectable = isinstance(self.block.wirevector_by_name.get(name), Output)
+        if not inspectable:
+            raise PyrtlError('TieredSimulation can only inspect WireVectors in its tracer, '
+                             'or its Outputs when there is no tracer')
+        return self._sim.inspect(w)
+
+    def _traced(self, name):
+        """ True if the wire called name is in the tracer. """
+        return self.tracer is not None and name in self.tracer._wires
+
+    def inspect_mem(self, mem):
+        """ Get the contents of a memory in the current simulation cycle. """
+        return self._sim.inspect_mem(mem)
+
+    def snapshot(self):
+        """ Capture the register and memory state; see Simulation.snapshot. """
+        return self._sim.snapshot()
+
+    def restore(self, snapshot):
+        """ Return the registers and memories to a state captured by snapshot(). """
+        self._sim.restore(snapshot)
+
+    def reset(self, register_value_map=None, memory_value_map=None):
+        """ Return the simulation to its initial state; see Simulation.reset. """
+        self._sim.reset(register_value_map, memory_value_map)
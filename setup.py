@@ -12,7 +12,8 @@ setup(
     install_requires =  ['six'],
     tests_require =  ['tox','nose'],
     extras_require =  {
-        'blif parsing': ['pyparsing']
+        'blif parsing': ['pyparsing'],
+        'batch simulation': ['numpy']
         },
     classifiers = [
         'Development Status :: 4 - Beta',
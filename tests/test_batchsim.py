@@ -0,0 +1,114 @@
+import unittest
+import random
+
+import pyrtl
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'BatchSimulation testing requires numpy')
+class TestBatchSimulation(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def check_against_simulation(self, inputs, nvectors=50):
+        """ Compare every Output against pyrtl.Simulation, one vector per step. """
+        vals = {w.name: [random.randrange(2**w.bitwidth) for _ in range(nvectors)]
+                for w in inputs}
+        outs = pyrtl.BatchSimulation().evaluate(vals)
+
+        sim_trace = pyrtl.SimulationTrace()
+        sim = pyrtl.Simulation(tracer=sim_trace)
+        for i in range(nvectors):
+            sim.step({name: v[i] for name, v in vals.items()})
+        for wire in pyrtl.working_block().wirevector_subset(pyrtl.Output):
+            self.assertEqual([int(x) for x in outs[wire.name]], sim_trace.trace[wire.name])
+
+    def test_basic_ops(self):
+        a, b = pyrtl.Input(8, 'a'), pyrtl.Input(5, 'b')
+        s = pyrtl.Input(1, 's')
+        for name, expr in [('and', a & b), ('or', a | b), ('xor', a ^ b), ('nand', a.nand(b)),
+                           ('inv', ~a), ('add', a + b), ('sub', a - b), ('mul', a * b),
+                           ('lt', a < b), ('gt', a > b), ('eq', a == b),
+                           ('mux', pyrtl.select(s, a, b)), ('cat', pyrtl.concat(a, b, s)),
+                           ('slice', a[1:6]), ('bits', pyrtl.concat(a[7], a[0], b[3]))]:
+            out = pyrtl.Output(name=name)
+            out <<= expr
+        self.check_against_simulation([a, b, s])
+
+    def test_wide_wires(self):
+        a, b = pyrtl.Input(64, 'a'), pyrtl.Input(100, 'b')
+        for name, expr in [('add', a + b), ('sub', a - b), ('mul', a * a), ('inv', ~b),
+                           ('narrow', b[60:70] + a[:3]), ('cat', pyrtl.concat(a, a)),
+                           ('eq', a == b[:64]), ('mux', pyrtl.select(b[99], a, b))]:
+            out = pyrtl.Output(name=name)
+            out <<= expr
+        self.check_against_simulation([a, b])
+
+    def test_rom_read(self):
+        addr = pyrtl.Input(3, 'addr')
+        rom = pyrtl.RomBlock(8, 3, [7, 20, 30, 1, 2, 0, 255, 4])
+        out = pyrtl.Output(name='out')
+        out <<= rom[addr] + 1
+        self.check_against_simulation([addr])
+
+    def test_exhaustive(self):
+        a, b = pyrtl.Input(3, 'a'), pyrtl.Input(4, 'b')
+        out = pyrtl.Output(name='out')
+        out <<= a * b
+        ins, outs = pyrtl.BatchSimulation().exhaustive()
+        self.assertEqual(len(ins['a']), 2**7)
+        self.assertEqual({(int(x), int(y)) for x, y in zip(ins['a'], ins['b'])},
+                         {(x, y) for x in range(8) for y in range(16)})
+        self.assertTrue(numpy.array_equal(outs['out'], ins['a'] * ins['b']))
+
+    def test_exhaustive_without_inputs(self):
+        out = pyrtl.Output(4, 'out')
+        out <<= pyrtl.Const(5, 4) + pyrtl.Const(6, 4)
+        ins, outs = pyrtl.BatchSimulation().exhaustive()
+        self.assertEqual(ins, {})
+        self.assertEqual([int(v) for v in outs['out']], [11])
+
+    def test_exhaustive_too_many_bits(self):
+        a = pyrtl.Input(30, 'a')
+        out = pyrtl.Output(name='out')
+        out <<= a
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.BatchSimulation().exhaustive()
+
+    def test_intermediate_wires(self):
+        a = pyrtl.Input(4, 'a')
+        tmp = pyrtl.WireVector(name='tmp')
+        tmp <<= a + 1
+        out = pyrtl.Output(name='out')
+        out <<= tmp * 2
+        res = pyrtl.BatchSimulation().evaluate({'a': [1, 2, 15]}, wires=['tmp', 'out'])
+        self.assertEqual(list(res['tmp']), [2, 3, 16])
+        self.assertEqual(list(res['out']), [4, 6, 32])
+
+    def test_rejects_registers(self):
+        r = pyrtl.Register(4, 'r')
+        r.next <<= r + 1
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.BatchSimulation()
+
+    def test_input_errors(self):
+        a, b = pyrtl.Input(4, 'a'), pyrtl.Input(4, 'b')
+        out = pyrtl.Output(name='out')
+        out <<= a + b
+        sim = pyrtl.BatchSimulation()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.evaluate({'a': [1, 2]})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.evaluate({'a': [1, 2], 'b': [1]})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.evaluate({'a': [1, 16], 'b': [1, 2]})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.evaluate({'a': [1, 2], 'b': [1, 2], 'out': [0, 0]})
+
+
+if __name__ == "__main__":
+    unittest.main()
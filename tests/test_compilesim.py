@@ -1,4 +1,8 @@
 import unittest
+import os
+import random
+import shutil
+import tempfile
 import six
 
 import pyrtl
@@ -15,6 +19,22 @@ except OSError:
     raise unittest.SkipTest('CompiledSimulation testing requires gcc')
 
 
+def setUpModule():
+    # keep the libraries compiled by the tests out of the user's compile cache
+    global _cache_dir, _user_cache
+    _cache_dir = tempfile.mkdtemp()
+    _user_cache = os.environ.get('PYRTL_COMPILE_CACHE')
+    os.environ['PYRTL_COMPILE_CACHE'] = _cache_dir
+
+
+def tearDownModule():
+    if _user_cache is None:
+        del os.environ['PYRTL_COMPILE_CACHE']
+    else:
+        os.environ['PYRTL_COMPILE_CACHE'] = _user_cache
+    shutil.rmtree(_cache_dir, ignore_errors=True)
+
+
 class TraceWithBasicOpsBase(unittest.TestCase):
     def setUp(self):
         pyrtl.reset_working_block()
@@ -824,6 +844,46 @@ class MemBlockLargeBase(unittest.TestCase):
         self.assertEqual(output.getvalue(), correct_outp)
 
 
+class DenseMemBlockBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.raddr = pyrtl.Input(6, 'raddr')
+        self.waddr = pyrtl.Input(6, 'waddr')
+        self.wdata = pyrtl.Input(68, 'wdata')
+        self.we = pyrtl.Input(1, 'we')
+        self.mem = pyrtl.MemBlock(bitwidth=68, addrwidth=6, name='mem')
+        o = pyrtl.Output(68, 'o')
+        o <<= self.mem[self.raddr]
+        self.mem[self.waddr] <<= pyrtl.MemBlock.EnabledWrite(self.wdata, self.we)
+
+    def run_sim(self, **kwargs):
+        random.seed(7)
+        sim = self.sim(memory_value_map={self.mem: {5: 2**67 + 3, 63: 9}}, **kwargs)
+        for _ in range(100):
+            sim.step({'raddr': random.randrange(64), 'waddr': random.randrange(64),
+                      'wdata': random.randrange(2**68), 'we': random.randrange(2)})
+        return sim
+
+    def test_dense_matches_hashmap(self):
+        dense = self.run_sim()
+        hashed = self.run_sim(dense_mem_addrwidth=0)
+        self.assertIn(self.mem, dense._dense_mems)
+        self.assertNotIn(self.mem, hashed._dense_mems)
+        self.assertEqual(dense.tracer.trace['o'], hashed.tracer.trace['o'])
+        self.assertEqual(dict(dense.inspect_mem(self.mem)), dict(hashed.inspect_mem(self.mem)))
+
+    def test_initial_values(self):
+        sim = self.sim(memory_value_map={self.mem: {5: 2**67 + 3, 63: 9}})
+        mem = sim.inspect_mem(self.mem)
+        self.assertEqual(mem[5], 2**67 + 3)
+        self.assertEqual(mem[63], 9)
+        self.assertEqual(mem[0], 0)
+
+    def test_initial_value_out_of_range(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(memory_value_map={self.mem: {64: 1}})
+
+
 class RegisterDefaultsBase(unittest.TestCase):
     def setUp(self):
         pyrtl.reset_working_block()
@@ -1005,20 +1065,6 @@ class TraceErrorBase(unittest.TestCase):
         with self.assertRaises(pyrtl.PyrtlError):
             self.sim_trace = pyrtl.SimulationTrace()
 
-    def test_empty_trace_after_untraceable_removed(self):
-        r = pyrtl.Register(2, 'r')
-        r.next <<= r + 1
-        sim = self.sim()
-        sim.step_multiple(provided_inputs={}, nsteps=10)
-        with self.assertRaises(pyrtl.PyrtlError) as ex:
-            sim.tracer.render_trace()
-        self.assertEquals(
-            str(ex.exception),
-            "Empty trace list. This may have occurred because "
-            "untraceable wires were removed prior to simulation, "
-            "if a CompiledSimulation was used."
-        )
-
     def test_invalid_base(self):
         self.in1 = pyrtl.Input(8, "in1")
         self.out = pyrtl.Output(8, "out")
@@ -1031,6 +1077,625 @@ class TraceErrorBase(unittest.TestCase):
             self.sim_trace.print_trace(base=4)
 
 
+class TraceInternalWiresBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.a = pyrtl.Input(8, 'a')
+        self.r = pyrtl.Register(70, 'r')
+        self.w = pyrtl.WireVector(70, 'w')
+        self.w <<= self.r + self.a
+        self.r.next <<= self.w
+        self.o = pyrtl.Output(8, 'o')
+        self.o <<= self.w[:8]
+        self.inputs = [{'a': v} for v in [200, 255, 3, 77, 100, 5, 250]]
+
+    def expected(self, name):
+        sim_trace = pyrtl.SimulationTrace()
+        sim = pyrtl.Simulation(tracer=sim_trace)
+        for inp in self.inputs:
+            sim.step(inp)
+        return sim_trace.trace[name]
+
+    def test_internal_wires_traced(self):
+        sim = self.sim()
+        sim.run(self.inputs[:3])
+        sim.run(self.inputs[3:])
+        for name in ['a', 'r', 'w', 'o']:
+            self.assertEqual(sim.tracer.trace[name], self.expected(name))
+        self.assertEqual(sim.inspect('w'), self.expected('w')[-1])
+
+    def test_ring_buffer(self):
+        sim = self.sim(trace_ring_size=3)
+        for inp in self.inputs:  # wraps around the ring several times
+            sim.step(inp)
+        for name in ['a', 'r', 'w', 'o']:
+            self.assertEqual(sim.tracer.trace[name], self.expected(name)[-3:])
+
+    def test_ring_buffer_single_run(self):
+        sim = self.sim(trace_ring_size=4)
+        sim.run(self.inputs[:2])
+        self.assertEqual(sim.tracer.trace['w'], self.expected('w')[:2])
+        sim.run(self.inputs[2:])
+        self.assertEqual(sim.tracer.trace['w'], self.expected('w')[-4:])
+
+    def test_compact_storage(self):
+        for ring_size in (None, 3):
+            sim = self.sim(tracer=pyrtl.SimulationTrace(storage='compact'),
+                           trace_ring_size=ring_size)
+            sim.run(self.inputs[:2])
+            sim.run(self.inputs[2:])
+            for name in ['a', 'r', 'w', 'o']:
+                self.assertEqual(sim.tracer.trace[name],
+                                 self.expected(name)[-(ring_size or len(self.inputs)):])
+
+    def test_vcd_writer(self):
+        sim_trace = pyrtl.SimulationTrace()
+        sim = pyrtl.Simulation(tracer=sim_trace)
+        for inp in self.inputs:
+            sim.step(inp)
+        expected = six.StringIO()
+        sim_trace.print_vcd(expected)
+
+        output = six.StringIO()
+        with pyrtl.VcdWriter(output) as vcd:
+            sim = self.sim(tracer=vcd)
+            sim.run(self.inputs[:3])
+            sim.run(self.inputs[3:])
+            self.assertEqual(sim.inspect('w'), self.expected('w')[-1])
+        # only the changes are written, and without the blank line after each cycle
+        changes = [line for line in output.getvalue().splitlines() if line]
+        for line in changes:
+            self.assertIn(line, expected.getvalue().splitlines())
+        self.assertLess(len(changes), len(expected.getvalue().splitlines()))
+
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(tracer=pyrtl.VcdWriter(six.StringIO()), trace_ring_size=2).run(self.inputs)
+
+    def test_bad_ring_size(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(trace_ring_size=0)
+
+
+class RunColumnsBase(unittest.TestCase):
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('run_columns requires numpy')
+        self.np = numpy
+        pyrtl.reset_working_block()
+        a, b = pyrtl.Input(8, 'a'), pyrtl.Input(100, 'b')
+        r = pyrtl.Register(100, 'r')
+        r.next <<= r ^ b
+        s = pyrtl.WireVector(9, 's')
+        s <<= a + r[:8]
+        o, wide = pyrtl.Output(9, 'o'), pyrtl.Output(100, 'wide')
+        o <<= s
+        wide <<= r
+        random.seed(3)
+        self.avals = [random.randrange(256) for _ in range(50)]
+        self.bvals = [random.randrange(2**100) for _ in range(50)]
+
+    def reference(self):
+        sim = self.sim()
+        sim.run([{'a': x, 'b': y} for x, y in zip(self.avals, self.bvals)])
+        return sim.tracer.trace
+
+    def wide_column(self, vals):
+        return self.np.array([[v & (2**64 - 1), v >> 64] for v in vals], dtype=self.np.uint64)
+
+    def test_matches_run(self):
+        expected = self.reference()
+        sim = self.sim()
+        res = sim.run_columns({'a': self.np.array(self.avals, dtype=self.np.uint64),
+                               'b': self.wide_column(self.bvals)})
+        self.assertEqual(res['o'].tolist(), expected['o'])
+        self.assertEqual(res['s'].tolist(), expected['s'])
+        self.assertEqual(res['wide'].shape, (50, 2))
+        self.assertEqual(sim._column_ints(res['wide']), expected['wide'])
+        self.assertEqual(sim.inspect('o'), expected['o'][-1])
+        self.assertEqual(sim.inspect('wide'), expected['wide'][-1])
+
+    def test_buffers_and_int_lists(self):
+        import array
+        expected = self.reference()
+        sim = self.sim()
+        res = sim.run_columns({'a': array.array('B', self.avals), 'b': self.bvals})
+        self.assertEqual(res['o'].tolist(), expected['o'])
+
+    def test_trace(self):
+        expected = self.reference()
+        sim = self.sim()
+        cols = {'a': self.np.array(self.avals), 'b': self.bvals}
+        sim.run_columns(cols, nsteps=20, trace=True)
+        sim.run([{'a': x, 'b': y} for x, y in zip(self.avals[20:], self.bvals[20:])])
+        for name in ['a', 'b', 'r', 's', 'o', 'wide']:
+            self.assertEqual(sim.tracer.trace[name], expected[name])
+
+    def test_bad_values(self):
+        sim = self.sim()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_columns({'a': self.np.array([256])})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_columns({'a': self.np.array([-1])})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_columns({'b': [2**100]})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.run_columns({'o': [1]})
+
+
+class StreamBase(unittest.TestCase):
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('streaming requires numpy')
+        self.np = numpy
+        pyrtl.reset_working_block()
+
+    def build_accumulator(self):
+        a = pyrtl.Input(8, 'a')
+        r = pyrtl.Register(16, 'r')
+        r.next <<= r + a
+        o = pyrtl.Output(16, 'o')
+        o <<= r
+        return self.np.arange(1000, dtype=self.np.uint64) % 256
+
+    def test_chunks_match_single_run(self):
+        avals = self.build_accumulator()
+        expected = self.sim().run_columns({'a': avals})['o'].tolist()
+
+        def chunks():
+            for start in range(0, 1000, 300):  # the last chunk is shorter
+                yield {'a': avals[start:start + 300]}
+
+        seen, pointers = [], set()
+
+        def sink(cycle, outputs):
+            self.assertEqual(cycle, len(seen))
+            seen.extend(outputs['o'].tolist())
+            pointers.add(outputs['o'].__array_interface__['data'][0])
+
+        sim = self.sim()
+        self.assertEqual(sim.run_stream(chunks(), sink), 1000)
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(pointers), 1)  # one output buffer reused for every chunk
+        self.assertEqual(len(sim.tracer.trace['o']), 0)
+        self.assertEqual(sim.inspect('o'), expected[-1])
+
+    def test_stream_generator_with_trace(self):
+        avals = self.build_accumulator()
+        expected = self.sim().run_columns({'a': avals})['o'].tolist()
+        sim = self.sim()
+        cycles = [cycle for cycle, _ in sim.stream(
+            ({'a': avals[i:i + 100]} for i in range(0, 1000, 100)), trace=True)]
+        self.assertEqual(cycles, list(range(0, 1000, 100)))
+        self.assertEqual(sim.tracer.trace['o'], expected)
+
+    def test_no_inputs(self):
+        r = pyrtl.Register(8, 'r')
+        r.next <<= r + 1
+        o = pyrtl.Output(8, 'o')
+        o <<= r
+        last = []
+        sim = self.sim()
+        total = sim.run_stream(iter([100, 100, 56]), lambda c, out: last.append(int(out['o'][-1])))
+        self.assertEqual(total, 256)
+        self.assertEqual(last, [99, 199, 255])
+
+
+class SnapshotBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.a = pyrtl.Input(8, 'a')
+        self.r = pyrtl.Register(8, 'r')
+        self.wide = pyrtl.Register(70, 'wide')
+        self.mem = pyrtl.MemBlock(8, 4, 'mem', asynchronous=True)
+        self.r.next <<= self.r + self.a
+        self.wide.next <<= pyrtl.concat(self.wide[:62], self.r)
+        self.mem[self.a[:4]] <<= self.r
+        self.o = pyrtl.Output(8, 'o')
+        self.o <<= self.mem[self.r[:4]] ^ self.r
+
+    def run_steps(self, sim, avals):
+        for a in avals:
+            sim.step({'a': a})
+        return [sim.inspect('o')]
+
+    def test_snapshot_restore(self):
+        sim = self.sim()
+        self.run_steps(sim, [3, 5, 7, 11])
+        snap = sim.snapshot()
+        self.assertEqual(set(snap), {'registers', 'memories'})
+        self.assertEqual(snap['registers']['r'], 26)
+        mem = sim.inspect_mem(self.mem)
+        for addr in range(16):
+            self.assertEqual(snap['memories']['mem'].get(addr, 0), mem.get(addr, 0))
+        first = self.run_steps(sim, [1, 2, 3, 4, 5])
+        sim.restore(snap)
+        self.assertEqual(sim.snapshot(), snap)
+        self.assertEqual(self.run_steps(sim, [1, 2, 3, 4, 5]), first)
+
+    def test_snapshot_is_picklable(self):
+        import pickle
+        sim = self.sim()
+        self.run_steps(sim, [3, 5, 7])
+        snap = sim.snapshot()
+        self.assertEqual(pickle.loads(pickle.dumps(snap)), snap)
+
+    def test_fork_is_independent(self):
+        sim = self.sim()
+        self.run_steps(sim, [3, 5, 7, 11])
+        fork = sim.fork()
+        expected = self.run_steps(sim, [9, 9, 1])
+        self.assertEqual(self.run_steps(fork, [9, 9, 1]), expected)
+        self.run_steps(fork, [100, 100])
+        self.assertNotEqual(fork.snapshot(), sim.snapshot())
+        self.assertEqual(fork.tracer.trace['o'][:3], sim.tracer.trace['o'][4:7])
+
+    def test_restore_missing_state_to_defaults(self):
+        sim = self.sim(default_value=0)
+        self.run_steps(sim, [3, 5, 7])
+        sim.restore({'registers': {'r': 9}})
+        self.assertEqual(sim.snapshot(), {'registers': {'r': 9, 'wide': 0},
+                                          'memories': {'mem': {}}})
+
+    def test_reset(self):
+        tracer = pyrtl.SimulationTrace()
+        sim = self.sim(tracer=tracer, register_value_map={self.r: 5},
+                       memory_value_map={self.mem: {5: 1, 6: 2}})
+        expected = self.run_steps(sim, [1, 6, 9, 2])
+        expected_trace = {name: list(vals) for name, vals in tracer.trace.items()}
+        sim.reset(register_value_map={self.r: 5}, memory_value_map={self.mem: {5: 1, 6: 2}})
+        self.assertIs(sim.tracer, tracer)
+        self.assertEqual(len(tracer), 0)
+        self.assertEqual(self.run_steps(sim, [1, 6, 9, 2]), expected)
+        self.assertEqual(dict(tracer.trace), expected_trace)
+        sim.reset()
+        self.assertEqual(sim.snapshot(), {'registers': {'r': 0, 'wide': 0},
+                                          'memories': {'mem': {}}})
+
+    def test_restore_errors(self):
+        sim = self.sim()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.restore({'registers': {'nope': 1}})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.restore({'registers': {'r': 256}})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.restore({'memories': {'mem': {16: 1}}})
+
+    def test_restore_from_fast_simulation(self):
+        fast = pyrtl.FastSimulation()
+        self.run_steps(fast, [3, 5, 7, 11, 200])
+        sim = self.sim()
+        snap = fast.snapshot()
+        sim.restore(snap)
+        self.assertEqual(sim.snapshot()['registers'], snap['registers'])
+        # the compiled memories do not keep entries that were written with zero
+        self.assertEqual(sim.snapshot()['memories']['mem'],
+                         {k: v for k, v in snap['memories']['mem'].items() if v})
+        self.assertEqual(self.run_steps(sim, [1, 2, 3]), self.run_steps(fast, [1, 2, 3]))
+        self.assertEqual(sim.snapshot()['registers'], fast.snapshot()['registers'])
+
+
+class ToggleActivityBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(70, 'a')
+        r = pyrtl.Register(70, 'r')
+        r.next <<= r + a
+        o = pyrtl.Output(70, 'o')
+        o <<= r ^ a
+        self.avals = [random.getrandbits(70) for _ in range(40)]
+
+    def test_matches_fastsim(self):
+        sim = self.sim(activity=True)
+        sim.step_multiple({'a': self.avals})
+        fastsim = pyrtl.FastSimulation(activity=True)
+        fastsim.step_multiple({'a': self.avals})
+        self.assertEqual(sim.activity.cycles, 40)
+        self.assertEqual([w.name for w in sim.activity.wires],
+                         [w.name for w in fastsim.activity.wires])
+        for w in sim.activity.wires:
+            self.assertEqual(sim.activity.bit_toggles(w), fastsim.activity.bit_toggles(w))
+            self.assertEqual(sim.activity.bit_time_high(w), fastsim.activity.bit_time_high(w))
+
+    def test_without_tracer(self):
+        sim = self.sim(tracer=None, activity=['r'])
+        sim.step_multiple({'a': self.avals[:2]})
+        self.assertEqual(sim.activity.toggles('r'), bin(self.avals[0]).count('1'))
+        sim.activity.clear()
+        self.assertEqual(sim.activity.cycles, 0)
+        self.assertEqual(sim.activity.toggles('r'), 0)
+
+    def test_without_tracer_unpacks_only_last_step(self):
+        sim = self.sim(tracer=None, activity=True)
+        unpack, unpacked = sim._unpack, []
+
+        def counting_unpack(buf, sz, pos, records):
+            unpacked.append(len(records))
+            return unpack(buf, sz, pos, records)
+        sim._unpack = counting_unpack
+        sim.step_multiple({'a': self.avals})
+        self.assertEqual(unpacked, [1])
+        fastsim = pyrtl.FastSimulation()
+        fastsim.step_multiple({'a': self.avals})
+        self.assertEqual(sim.inspect('o'), fastsim.inspect('o'))
+
+    def test_fork_counts_from_scratch(self):
+        sim = self.sim(activity=True)
+        sim.step_multiple({'a': self.avals[:3]})
+        fork = sim.fork()
+        fork.step({'a': 1})
+        self.assertEqual(fork.activity.cycles, 1)
+        self.assertEqual(sim.activity.cycles, 3)
+
+
+class RtlAssertBase(unittest.TestCase):
+    class RTLSampleException(Exception):
+        pass
+
+    def setUp(self):
+        pyrtl.reset_working_block()
+        i = pyrtl.Input(4, 'i')
+        r = pyrtl.Register(4, 'r')
+        r.next <<= r + 1
+        o = pyrtl.Output(4, 'o')
+        o <<= r
+        pyrtl.rtl_assert(i != 3, self.RTLSampleException('i is 3'))
+
+    def test_step_multiple_stops_at_failure(self):
+        sim = self.sim()
+        sim.step_multiple({'i': [0, 1]})
+        with self.assertRaises(self.RTLSampleException) as error:
+            sim.step_multiple({'i': [0, 3, 0, 0]})
+        self.assertEqual(error.exception.cycle, 3)
+        self.assertEqual(sim.tracer.trace['o'], [0, 1, 2, 3])
+        self.assertEqual(sim.inspect('o'), 3)
+
+    def test_run_stops_at_failure(self):
+        sim = self.sim()
+        with self.assertRaises(self.RTLSampleException) as error:
+            sim.run([{'i': 0}, {'i': 0}, {'i': 3}, {'i': 0}])
+        self.assertEqual(error.exception.cycle, 2)
+        self.assertEqual(sim.tracer.trace['o'], [0, 1, 2])
+        sim.step({'i': 0})
+        self.assertEqual(sim.inspect('o'), 3)
+
+    def test_run_columns_stops_at_failure(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('run_columns requires numpy')
+        sim = self.sim()
+        with self.assertRaises(self.RTLSampleException) as error:
+            sim.run_columns({'i': numpy.array([0, 0, 0, 3, 0], dtype=numpy.uint64)})
+        self.assertEqual(error.exception.cycle, 3)
+        self.assertEqual(sim.inspect('o'), 3)
+
+
+class ShardedCodeBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        wide = pyrtl.Register(100, 'wide')
+        acc = pyrtl.Register(8, 'acc')
+        rom = pyrtl.RomBlock(8, 4, [random.randrange(256) for _ in range(16)], name='rom')
+        mem = pyrtl.MemBlock(100, 20, 'mem')  # big enough to be a hashmap
+        x = a
+        for n in range(20):
+            x = (x * 3 + n)[:8] ^ acc
+        acc.next <<= x + rom[a[:4]]
+        wide.next <<= pyrtl.concat(wide[8:], x) + mem[a]
+        mem[a] <<= wide
+        o = pyrtl.Output(100, 'o')
+        o <<= wide ^ acc
+        self.avals = [random.randrange(256) for _ in range(30)]
+
+    def run_sim(self, sim):
+        sim.step_multiple({'a': self.avals})
+        return sim.tracer.trace
+
+    def test_sharded_matches_fastsim(self):
+        class SmallFunctions(self.sim):
+            _nets_per_function = 4
+
+        sim = SmallFunctions(cache_dir=False, shards=3)
+        self.assertEqual(sorted(f for f in os.listdir(sim._lib.dir) if f.endswith('.c')),
+                         ['pyrtlsim.c', 'pyrtlsim1.c', 'pyrtlsim2.c'])
+        self.assertEqual(self.run_sim(sim), self.run_sim(pyrtl.FastSimulation()))
+
+    def test_shards_limited_by_functions(self):
+        sim = self.sim(cache_dir=False, shards=8)
+        self.assertEqual([f for f in os.listdir(sim._lib.dir) if f.endswith('.c')],
+                         ['pyrtlsim.c'])
+        self.assertEqual(self.run_sim(sim), self.run_sim(pyrtl.FastSimulation()))
+
+    def test_invalid_shards(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(shards=0)
+
+
+class WideArithmeticBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def check_against_fastsim(self, widths, **kwargs):
+        ins = {}
+        for x, (w0, w1) in enumerate(widths):
+            a, b = pyrtl.Input(w0, 'a%d' % x), pyrtl.Input(w1, 'b%d' % x)
+            ins.update({a.name: w0, b.name: w1})
+            for op, name in [(a + b, 'add'), (a - b, 'sub'), (a * b, 'mul'),
+                             (a < b, 'lt'), (a > b, 'gt'), (a == b, 'eq')]:
+                out = pyrtl.Output(name='%s%d' % (name, x))
+                out <<= op
+                half = pyrtl.Output(name='%s%d_half' % (name, x))
+                half <<= op[:max(1, len(op) // 2)]  # truncating the result
+        vals = {name: [random.choice([0, 2**w - 1, random.randrange(2**w)]) for _ in range(20)]
+                for name, w in ins.items()}
+        sim = self.sim(**kwargs)
+        sim.step_multiple(vals)
+        fastsim = pyrtl.FastSimulation()
+        fastsim.step_multiple(vals)
+        self.assertEqual(sim.tracer.trace, fastsim.tracer.trace)
+
+    def test_up_to_128_bits(self):
+        self.check_against_fastsim([(1, 1), (64, 64), (63, 65), (100, 20), (128, 128)])
+
+    def test_wider(self):
+        self.check_against_fastsim([(129, 64), (200, 150), (64, 190)])
+
+    def test_optimized(self):
+        self.check_against_fastsim([(64, 64), (100, 28), (200, 150)],
+                                   opt_level=2, cache_dir=False)
+
+    def test_invalid_opt_level(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(opt_level=4)
+
+
+class SharedLibraryBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.cache_dir = tempfile.mkdtemp()
+        a = pyrtl.Input(8, 'a')
+        r = pyrtl.Register(8, 'r')
+        mem = pyrtl.MemBlock(8, 20, 'mem')  # a hashmap
+        r.next <<= (r + a)[:8]
+        mem[a] <<= r
+        o = pyrtl.Output(8, 'o')
+        o <<= mem[a] ^ r
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_simulations_share_library(self):
+        first = self.sim(cache_dir=self.cache_dir)
+        second = self.sim(cache_dir=self.cache_dir)
+        fork = first.fork()
+        self.assertIs(first._lib, second._lib)
+        self.assertIs(first._lib, fork._lib)
+        first.step_multiple({'a': [1, 2, 3]})
+        second.step_multiple({'a': [3, 2, 1]})
+        fork.step_multiple({'a': [1, 2, 3]})
+        self.assertEqual(first.snapshot(), fork.snapshot())
+        self.assertNotEqual(first.snapshot(), second.snapshot())
+        del first, fork
+        second.step({'a': 2})
+        self.assertEqual(second.inspect('o'), 3 ^ 6)  # mem[2] was written with 3
+
+    def test_run_batch(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('run_batch requires numpy')
+        sim = self.sim(cache_dir=self.cache_dir)
+        sim.step({'a': 5})
+        stimuli = [{'a': numpy.array([random.randrange(256) for _ in range(50)],
+                                     dtype=numpy.uint64)} for _ in range(8)]
+        results = sim.run_batch(stimuli, threads=3)
+        for inputs, result in zip(stimuli, results):
+            fork = sim.fork()
+            fork.step_multiple({'a': inputs['a'].tolist()})
+            self.assertEqual(result['o'].tolist(), fork.tracer.trace['o'])
+        self.assertEqual(sim.snapshot()['registers'], {'r': 5})
+
+
+class CompileCacheBase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def build(self):
+        # restart the temporary wire names too, as a new process would
+        pyrtl.reset_working_block()
+        pyrtl.wire._reset_wire_indexers()
+        pyrtl.memory._reset_memory_indexer()
+        a = pyrtl.Input(8, 'a')
+        r = pyrtl.Register(8, 'r')
+        mem = pyrtl.MemBlock(8, 4, 'mem')
+        r.next <<= r + a
+        mem[a[:4]] <<= r
+        o = pyrtl.Output(8, 'o')
+        o <<= mem[a[:4]] ^ r
+
+    def run_sim(self, **kwargs):
+        sim = self.sim(**kwargs)
+        sim.step_multiple({'a': [1, 2, 3, 4, 5, 6]})
+        return sim, sim.tracer.trace['o']
+
+    def test_second_construction_hits_cache(self):
+        self.build()
+        first, first_trace = self.run_sim(cache_dir=self.cache_dir)
+        self.assertFalse(first.cache_hit)
+        self.build()  # a fresh but identical design
+        second, second_trace = self.run_sim(cache_dir=self.cache_dir)
+        self.assertTrue(second.cache_hit)
+        self.assertEqual(first_trace, second_trace)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_simulators_sharing_a_cache_entry_are_independent(self):
+        self.build()
+        first = self.sim(cache_dir=self.cache_dir)
+        second = self.sim(cache_dir=self.cache_dir)
+        self.assertTrue(second.cache_hit)
+        first.step_multiple({'a': [1, 2, 3]})
+        second.step_multiple({'a': [1]})
+        self.assertEqual(second.tracer.trace['o'], first.tracer.trace['o'][:1])
+
+    def test_changed_design_misses_cache(self):
+        self.build()
+        self.run_sim(cache_dir=self.cache_dir)
+        o2 = pyrtl.Output(8, 'o2')
+        o2 <<= pyrtl.working_block().get_wirevector_by_name('a') + 1
+        sim, _ = self.run_sim(cache_dir=self.cache_dir)
+        self.assertFalse(sim.cache_hit)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_cache_disabled(self):
+        self.build()
+        self.run_sim(cache_dir=False)
+        sim, _ = self.run_sim(cache_dir=False)
+        self.assertFalse(sim.cache_hit)
+
+    def test_eviction(self):
+        self.build()
+        self.run_sim(cache_dir=self.cache_dir, cache_size_limit=0)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_other_cpu_misses_cache(self):
+        self.build()
+        self.run_sim(cache_dir=self.cache_dir)
+        target = pyrtl.CompiledSimulation._gcc_target
+        pyrtl.CompiledSimulation._gcc_target = 'another cpu'
+        try:
+            sim, _ = self.run_sim(cache_dir=self.cache_dir)
+        finally:
+            pyrtl.CompiledSimulation._gcc_target = target
+        self.assertFalse(sim.cache_hit)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    @unittest.skipIf(not hasattr(os, 'getuid'), 'file ownership is only checked on POSIX')
+    def test_writable_by_others_is_not_used(self):
+        import gc
+        import warnings
+        self.build()
+        self.run_sim(cache_dir=self.cache_dir)
+        gc.collect()  # so the library is not shared from this process instead
+        entry, = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+        os.chmod(entry, 0o666)
+        sim, _ = self.run_sim(cache_dir=self.cache_dir)
+        self.assertFalse(sim.cache_hit)
+        os.chmod(self.cache_dir, 0o777)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            sim, _ = self.run_sim(cache_dir=self.cache_dir)
+        self.assertFalse(sim.cache_hit)
+        self.assertEqual(len(caught), 1)
+
+
 def make_unittests():
     """
     Generates separate unittests for each of the simulators
@@ -73,6 +73,40 @@ class TestAreaEstimate(unittest.TestCase):
         self.assertEquals(estimate.area_estimation(), (0.00734386752, 0.001879779717361501))
 
 
+class TestSwitchingPowerEstimate(unittest.TestCase):
+
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        r = pyrtl.Register(8, 'r')
+        r.next <<= r + a
+        o = pyrtl.Output(8, 'o')
+        o <<= r & a
+
+    def activity(self, avals):
+        sim = pyrtl.FastSimulation(tracer=None, activity=True)
+        sim.step_multiple({'a': avals})
+        return sim.activity
+
+    def test_power_grows_with_activity(self):
+        quiet, quiet_clock = estimate.switching_power_estimation(self.activity([0] * 20))
+        busy, busy_clock = estimate.switching_power_estimation(self.activity([0, 255] * 10))
+        self.assertEqual(quiet, 0)
+        self.assertGreater(busy, 0)
+        self.assertEqual(quiet_clock, busy_clock)
+        self.assertGreater(busy_clock, 0)
+
+    def test_power_scaling(self):
+        activity = self.activity([0, 255, 7] * 10)
+        power, clock = estimate.switching_power_estimation(activity)
+        faster, _ = estimate.switching_power_estimation(activity, frequency_in_mhz=200)
+        self.assertAlmostEqual(faster, 2 * power)
+        higher, _ = estimate.switching_power_estimation(activity, voltage=2.4)
+        self.assertAlmostEqual(higher, 4 * power)
+        smaller, _ = estimate.switching_power_estimation(activity, tech_in_nm=65)
+        self.assertLess(smaller, power)
+
+
 class TestTimingEstimate(unittest.TestCase):
 
     def setUp(self):
@@ -677,6 +677,37 @@ class TestRtlAssert(unittest.TestCase):
         with self.assertRaises(self.RTLSampleException):
             sim.step({i: 0})
 
+    def check_step_multiple_stops_at_failure(self, sim_class):
+        i = pyrtl.Input(4, 'i')
+        r = pyrtl.Register(4, 'r')
+        r.next <<= r + 1
+        o = pyrtl.Output(4, 'o')
+        o <<= r
+        pyrtl.rtl_assert(i != 3, self.RTLSampleException('i is 3'))
+        pyrtl.rtl_assert(r < 5, self.RTLSampleException('r too big'))
+
+        sim = sim_class()
+        with self.assertRaises(self.RTLSampleException) as error:
+            sim.step_multiple({i: [0, 1, 3, 0, 0]})
+        self.assertEqual(str(error.exception), 'i is 3')
+        self.assertEqual(error.exception.cycle, 2)
+        self.assertEqual(sim.tracer.trace['o'], [0, 1, 2])
+        self.assertEqual(sim.inspect(o), 2)
+
+        with self.assertRaises(self.RTLSampleException) as error:
+            sim.step_multiple({i: [0] * 5})
+        self.assertEqual(str(error.exception), 'r too big')
+        self.assertEqual(error.exception.cycle, 5)
+        sim.reset()
+        sim.step_multiple({i: [0] * 5})
+        self.assertEqual(sim.tracer.trace['o'], [0, 1, 2, 3, 4])
+
+    def test_assert_simulation_step_multiple(self):
+        self.check_step_multiple_stops_at_failure(pyrtl.Simulation)
+
+    def test_assert_fastsimulation_step_multiple(self):
+        self.check_step_multiple_stops_at_failure(pyrtl.FastSimulation)
+
 
 class TestLoopDetection(unittest.TestCase):
     def setUp(self):
@@ -442,6 +442,97 @@ class TestOutputIPynb(unittest.TestCase):
         htmlstring = inputoutput.trace_to_html(sim_trace)  # tests if it compiles or not
 
 
+class TestTraceFromVcd(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        r = pyrtl.Register(8, 'r')
+        r.next <<= r + a
+        odd = pyrtl.WireVector(70, 'odd/name')
+        odd <<= pyrtl.concat(r, a, r)
+        o = pyrtl.Output(1, 'wire')  # a Verilog keyword, so it is renamed in the VCD
+        o <<= a[0]
+        self.sim_trace = pyrtl.SimulationTrace()
+        sim = pyrtl.Simulation(tracer=self.sim_trace)
+        sim.step_multiple({'a': [0, 1, 0, 0, 2, 0, 3, 3]})
+
+    def vcd(self, **kwargs):
+        buffer = six.StringIO()
+        self.sim_trace.print_vcd(buffer, **kwargs)
+        buffer.seek(0)
+        return buffer
+
+    def test_round_trip(self):
+        for storage in ('list', 'compact'):
+            trace = pyrtl.trace_from_vcd(self.vcd(include_clock=True),
+                                         block=pyrtl.working_block(), storage=storage)
+            self.assertEqual(sorted(trace.trace), sorted(self.sim_trace.trace))
+            for name in trace.trace:
+                self.assertEqual(trace.trace[name], self.sim_trace.trace[name])
+
+    def test_round_trip_sanitized_names_of_subset(self):
+        pyrtl.reset_working_block()
+        a, b = pyrtl.Input(4, 'in/a'), pyrtl.Input(4, 'in/b')
+        total, x = pyrtl.Output(5, 'out/sum'), pyrtl.Output(4, 'out/x')
+        hidden = pyrtl.WireVector(4, 'hid/den')
+        total <<= a + b
+        hidden <<= a ^ b
+        x <<= hidden
+        inputs = {'in/a': [1, 2, 3, 4], 'in/b': [9, 8, 7, 15]}
+        sim_trace = pyrtl.SimulationTrace(wires_to_track=[a, b, total])
+        pyrtl.Simulation(tracer=sim_trace).step_multiple(inputs)
+        printed, streamed = six.StringIO(), six.StringIO()
+        sim_trace.print_vcd(printed)
+        with pyrtl.VcdWriter(streamed, wires_to_track=[a, b, total]) as vcd:
+            pyrtl.Simulation(tracer=vcd).step_multiple(inputs)
+        for buffer in (printed, streamed):
+            buffer.seek(0)
+            trace = pyrtl.trace_from_vcd(buffer, block=pyrtl.working_block())
+            self.assertEqual(sorted(trace.trace), ['in/a', 'in/b', 'out/sum'])
+            for name in trace.trace:
+                self.assertEqual(trace.trace[name], sim_trace.trace[name])
+
+    def test_streamed_vcd(self):
+        buffer = six.StringIO()
+        with pyrtl.VcdWriter(buffer) as vcd:
+            pyrtl.Simulation(tracer=vcd).step_multiple({'a': [0, 1, 0, 0, 2, 0, 3, 3]})
+        buffer.seek(0)
+        trace = pyrtl.trace_from_vcd(buffer, block=pyrtl.working_block(), wires=['r', 'wire'])
+        self.assertEqual(sorted(trace.trace), ['r', 'wire'])
+        self.assertEqual(trace.trace['r'], self.sim_trace.trace['r'])
+        self.assertEqual(trace.trace['wire'], self.sim_trace.trace['wire'])
+
+    def test_without_block(self):
+        trace = pyrtl.trace_from_vcd(self.vcd())
+        self.assertEqual(trace.trace['a'], [0, 1, 0, 0, 2, 0, 3, 3])
+        # which wire is numbered first depends on the order they are tracked in
+        renamed = {trace._wires[name].bitwidth: name for name in trace.trace
+                   if name.startswith('_vcd_tmp_')}
+        self.assertEqual(sorted(renamed), [1, 70])
+        self.assertEqual(trace.trace[renamed[1]], self.sim_trace.trace['wire'])
+        self.assertNotIn('clk', list(pyrtl.trace_from_vcd(self.vcd(include_clock=True)).trace))
+
+    def test_external_vcd(self):
+        vcd = six.StringIO(
+            '$date today $end\n$timescale 1ps $end\n'
+            '$scope module tb $end\n$scope module dut $end\n'
+            '$var wire 1 ! clk $end\n$var reg 4 " count [3:0] $end\n'
+            '$upscope $end\n$upscope $end\n$enddefinitions $end\n'
+            '#0\n$dumpvars\n0!\nbx "\n$end\n'
+            '#5\n1!\n#10\n0! b1 "\n$comment a comment\n that spans lines $end\n'
+            '#15\n1!\n#20\n0!\nb1z10 "\n#30\n')
+        trace = pyrtl.trace_from_vcd(vcd, period=10)
+        self.assertEqual(trace.trace['dut.clk'], [0, 0, 0])
+        self.assertEqual(trace.trace['dut.count'], [0, 1, 10])
+        self.assertEqual(trace._wires['dut.count'].bitwidth, 4)
+
+    def test_errors(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.trace_from_vcd(self.vcd(), wires=['nope'])
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.trace_from_vcd(six.StringIO('$var wire 1 ! a $end\n'))
+
+
 firrtl_output_concat_test = """\
 circuit Example :
   module Example :
@@ -1,4 +1,8 @@
 import unittest
+import json
+import os
+import shutil
+import tempfile
 import six
 
 import pyrtl
@@ -558,6 +562,53 @@ class SimStepMultipleBase(unittest.TestCase):
         self.assertEqual(output.getvalue(), correct_output)
 
 
+class StepMultipleMatchesStepBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.addr = pyrtl.Input(3, 'addr')
+        self.data = pyrtl.Input(4, 'data')
+        self.we = pyrtl.Input(1, 'we')
+        acc = pyrtl.Register(6, 'acc')
+        delayed = pyrtl.Register(6, 'delayed')
+        mem = pyrtl.MemBlock(4, 3, 'mem')
+        mem[self.addr] <<= pyrtl.MemBlock.EnabledWrite(self.data, self.we)
+        read = pyrtl.WireVector(4, 'read')
+        read <<= mem[self.addr]
+        acc.next <<= acc + read
+        delayed.next <<= acc
+        out = pyrtl.Output(7, 'out')
+        out <<= acc + delayed
+        self.inputs = {
+            'addr': [0, 1, 0, 2, 1, 0, 3, 3, 2, 1],
+            'data': [3, 5, 7, 2, 9, 1, 4, 4, 8, 15],
+            'we': [1, 1, 0, 1, 0, 1, 1, 0, 0, 1],
+        }
+
+    def test_step_multiple_matches_single_steps(self):
+        step_trace = pyrtl.SimulationTrace()
+        sim = self.sim(tracer=step_trace)
+        for i in range(10):
+            sim.step({w: v[i] for w, v in self.inputs.items()})
+
+        multiple_trace = pyrtl.SimulationTrace()
+        sim_multiple = self.sim(tracer=multiple_trace)
+        sim_multiple.step_multiple(self.inputs, {'out': step_trace.trace['out']})
+        self.assertEqual(dict(step_trace.trace), dict(multiple_trace.trace))
+        self.assertEqual(sim_multiple.inspect('out'), sim.inspect('out'))
+        self.assertEqual(sim_multiple.inspect('acc'), sim.inspect('acc'))
+
+        # and the simulation can carry on from where the batch finished
+        sim.step({'addr': 0, 'data': 0, 'we': 0})
+        sim_multiple.step({'addr': 0, 'data': 0, 'we': 0})
+        self.assertEqual(dict(step_trace.trace), dict(multiple_trace.trace))
+
+    def test_step_multiple_input_out_of_bitwidth(self):
+        sim = self.sim()
+        self.inputs['data'][4] = 16
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.step_multiple(self.inputs)
+
+
 class TestStepBundleBase(unittest.TestCase):
     def setUp(self):
         pyrtl.reset_working_block()
@@ -1225,9 +1276,759 @@ class TraceErrorBase(unittest.TestCase):
             self.sim_trace.print_trace(base=4)
 
 
+class CompactTraceBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        count = pyrtl.Register(8, 'count')
+        count.next <<= count + 1
+        slow = pyrtl.Register(4, 'slow')
+        slow.next <<= pyrtl.select(count[:3] == 7, slow + 1, slow)
+        wide = pyrtl.Output(100, 'wide')
+        wide <<= pyrtl.concat(slow, a, pyrtl.Const(0, 88))
+        self.avals = [3] * 36 + [5] * 64
+
+    def run_with(self, storage):
+        tracer = pyrtl.SimulationTrace(storage=storage)
+        sim = self.sim(tracer=tracer)
+        for a in self.avals:
+            sim.step({'a': a})
+        return tracer
+
+    def test_same_as_list_storage(self):
+        lists, compact = self.run_with('list'), self.run_with('compact')
+        for name in lists.trace:
+            self.assertIsInstance(compact.trace[name], pyrtl.simulation.CompactTrace)
+            self.assertEqual(compact.trace[name], lists.trace[name])
+            self.assertEqual(list(compact.trace[name]), lists.trace[name])
+            self.assertEqual(compact.trace[name][-7:], lists.trace[name][-7:])
+            self.assertEqual(compact.trace[name][12], lists.trace[name][12])
+
+        for method, kwargs in [('print_trace', {}), ('print_trace', {'compact': True}),
+                               ('print_vcd', {}), ('render_trace', {})]:
+            expected, actual = six.StringIO(), six.StringIO()
+            getattr(lists, method)(file=expected, **kwargs)
+            getattr(compact, method)(file=actual, **kwargs)
+            self.assertEqual(actual.getvalue(), expected.getvalue())
+
+    def test_only_changes_are_stored(self):
+        trace = self.run_with('compact').trace
+        self.assertEqual(len(trace['a']._times), 2)
+        self.assertEqual(len(trace['slow']._times), 13)
+        self.assertEqual(len(trace['wide']._times), 14)
+        self.assertIsNotNone(trace['count']._dense)  # changes every cycle
+
+    def test_editing(self):
+        trace = pyrtl.simulation.CompactTrace(8, [1, 1, 2, 2, 2, 3])
+        trace[1] = 5
+        del trace[:2]
+        self.assertEqual(trace, [2, 2, 2, 3])
+        trace.append(3)
+        self.assertEqual(len(trace), 5)
+        self.assertNotEqual(trace, [2, 2, 2, 3])
+        del trace[:]
+        self.assertEqual(trace, [])
+        with self.assertRaises(IndexError):
+            trace[0]
+
+    def test_unknown_storage(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.SimulationTrace(storage='tape')
+
+
+class DiskTraceBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        count = pyrtl.Register(8, 'count')
+        count.next <<= count + a
+        wide = pyrtl.Output(130, 'wide')
+        wide <<= pyrtl.concat(count, pyrtl.Const(1, 121), a[0])
+        self.avals = [(7 * n) % 256 for n in range(60)]
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def run_with(self, storage, path=None):
+        tracer = pyrtl.SimulationTrace(storage=storage, path=path)
+        for values in tracer.trace.values():
+            if isinstance(values, pyrtl.simulation.DiskTrace):
+                values.buffer_size, values.chunk_size = 7, 5  # exercise the paging
+        sim = self.sim(tracer=tracer)
+        for a in self.avals:
+            sim.step({'a': a})
+        return tracer
+
+    def test_same_as_list_storage(self):
+        lists, disk = self.run_with('list'), self.run_with('disk', self.path)
+        for name in lists.trace:
+            self.assertIsInstance(disk.trace[name], pyrtl.simulation.DiskTrace)
+            self.assertEqual(disk.trace[name], lists.trace[name])
+            self.assertEqual(disk.trace[name][-9:], lists.trace[name][-9:])
+            self.assertEqual(disk.trace[name][23], lists.trace[name][23])
+        for method in ('print_trace', 'print_vcd'):
+            expected, actual = six.StringIO(), six.StringIO()
+            getattr(lists, method)(file=expected)
+            getattr(disk, method)(file=actual)
+            self.assertEqual(actual.getvalue(), expected.getvalue())
+        self.assertEqual(pyrtl.trace_to_html(disk), pyrtl.trace_to_html(lists))
+
+    def test_reopen(self):
+        tracer = self.run_with('disk', self.path)
+        tracer.flush()
+        reopened = pyrtl.SimulationTrace.open(self.path)
+        self.assertEqual(sorted(reopened.trace), sorted(tracer.trace))
+        for name in tracer.trace:
+            self.assertEqual(reopened.trace[name], list(tracer.trace[name]))
+        self.assertIsInstance(reopened._wires['a'], pyrtl.Input)
+        self.assertEqual(reopened._wires['wide'].bitwidth, 130)
+        expected, actual = six.StringIO(), six.StringIO()
+        tracer.print_vcd(expected)
+        reopened.print_vcd(actual)
+        self.assertEqual(actual.getvalue(), expected.getvalue())
+
+    def test_fork_and_clear(self):
+        sim = self.sim(tracer=pyrtl.SimulationTrace(storage='disk', path=self.path))
+        sim.step({'a': 1})
+        fork = sim.fork()
+        self.assertNotEqual(fork.tracer.path, self.path)
+        fork.step({'a': 2})
+        self.assertEqual(len(fork.tracer), 1)
+        shutil.rmtree(fork.tracer.path)
+        sim.tracer.clear()
+        self.assertEqual(len(sim.tracer), 0)
+
+    def test_reset_does_not_read_the_trace(self):
+        tracer = self.run_with('disk', self.path)
+        tracer.flush()
+        disk = tracer.trace['wide']
+
+        def no_reading(chunk):
+            raise AssertionError('the trace was read back')
+        disk._read_chunk = no_reading
+        sim = self.sim(tracer=tracer)
+        sim.step({'a': 1})
+        sim.reset()
+        self.assertEqual(len(tracer), 0)
+        self.assertEqual(os.path.getsize(disk.filename), 0)
+        sim.step_multiple({'a': self.avals[:20]})
+        del disk.__dict__['_read_chunk']
+        self.assertEqual(self.run_with('list').trace['wide'][:20], list(disk))
+
+    def test_in_place_changes(self):
+        disk = pyrtl.simulation.DiskTrace(os.path.join(self.path, 'values'), 70)
+        disk.buffer_size, disk.chunk_size = 4, 3
+        values = [n << 60 for n in range(10)]
+        disk.extend(values)
+        disk[2] = values[2] = 5
+        disk[-1] = values[-1] = 6
+        self.assertEqual(list(disk), values)
+        del disk[7:]
+        self.assertEqual(list(disk), values[:7])
+        del disk[:2]
+        self.assertEqual(list(disk), values[2:7])
+
+    def test_errors(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.SimulationTrace(storage='disk')
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.SimulationTrace.open(self.path)
+
+
+class CompareTracesBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(4, 'a')
+        r = pyrtl.Register(4, 'r')
+        r.next <<= r + a
+        o = pyrtl.Output(5, 'o')
+        o <<= r + 1
+        self.avals = [1, 0, 2, 0, 3] * 30
+
+    def run_with(self, storage='list', block=None):
+        # after synthesis, only the inputs and outputs keep their names
+        tracked = None if block is None else block.wirevector_subset((pyrtl.Input, pyrtl.Output))
+        tracer = pyrtl.SimulationTrace(wires_to_track=tracked, block=block, storage=storage)
+        self.sim(tracer=tracer, block=block).step_multiple({'a': self.avals})
+        return tracer
+
+    def test_same_traces_match(self):
+        for storage in ('list', 'compact'):
+            diff = pyrtl.compare_traces(self.run_with(), self.run_with(storage))
+            self.assertTrue(diff.equal)
+            self.assertIsNone(diff.first_cycle)
+            self.assertEqual(diff.matching, ['a', 'o', 'r'])
+            self.assertIn('traces match', str(diff))
+
+    def test_before_and_after_synthesis(self):
+        before = self.run_with()
+        pyrtl.synthesize()
+        pyrtl.optimize()
+        after = self.run_with(block=pyrtl.working_block())
+        diff = pyrtl.compare_traces(before, after)
+        self.assertFalse(diff.equal)  # the register is not traced after synthesis
+        self.assertEqual(diff.only_expected, ['r'])
+        self.assertEqual(diff.divergences, {})
+        self.assertTrue(pyrtl.compare_traces(before, after, wires=['a', 'o']).equal)
+
+    def test_first_divergence(self):
+        expected = {name: list(vals) for name, vals in self.run_with().trace.items()}
+        expected['o'][40] += 1
+        expected['o'][100] += 1
+        expected['r'] = expected['r'][:-2]
+        for storage in ('list', 'compact'):
+            actual = self.run_with(storage)
+            reference = {name: pyrtl.simulation.CompactTrace(8, vals)
+                         for name, vals in expected.items()} if storage == 'compact' else expected
+            diff = pyrtl.compare_traces(reference, actual)
+            self.assertEqual(diff.first_cycle, 40)
+            self.assertEqual(diff.first_divergence(), ['o'])
+            self.assertEqual(diff.matching, ['a', 'r'])
+            o = actual.trace['o']
+            self.assertEqual(diff.divergences['o'],
+                             pyrtl.simulation.TraceDivergence(40, 2, o[40] + 1, o[40]))
+            self.assertEqual(diff.lengths, (150, 150))
+            self.assertIn('o: cycle 40', str(diff))
+
+    def test_unknown_wire(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.compare_traces(self.run_with(), self.run_with(), wires=['nope'])
+
+
+class ProfileBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        r = pyrtl.Register(8, 'r')
+        alu_mul = pyrtl.WireVector(16, 'alu_mul')
+        alu_mul <<= a * r
+        alu_add = pyrtl.WireVector(9, 'alu_add')
+        alu_add <<= a + r
+        r.next <<= alu_mul[:8] ^ alu_add[:8]
+        o = pyrtl.Output(8, 'o')
+        o <<= pyrtl.concat(alu_add[3:7], alu_mul[:4])
+        self.nets = [net for net in pyrtl.working_block() if net.op not in 'r@']
+
+    def test_not_profiled_by_default(self):
+        self.assertIsNone(self.sim().profile)
+
+    def test_counts(self):
+        sim = self.sim(profile=True)
+        for cycle in range(10):
+            sim.step({'a': cycle})
+        sim.step_multiple({'a': range(5)})
+        profile = sim.profile
+        self.assertEqual(sorted(profile.nets, key=str), sorted(self.nets, key=str))
+        self.assertEqual(profile.counts, [15] * len(self.nets))
+        self.assertTrue(all(t >= 0 for t in profile.times))
+
+        by_op = {r['name']: r for r in profile.records(by='op')}
+        self.assertEqual(by_op['*']['nets'], 1)
+        self.assertEqual(by_op['*']['count'], 15)
+        self.assertEqual(by_op['s']['nets'], sum(1 for net in self.nets if net.op == 's'))
+        by_prefix = {r['name']: r for r in profile.records(by='prefix')}
+        self.assertEqual(by_prefix['alu']['nets'], 4)  # the multiply, add, and their wires
+        by_wire = {(r['wire'], r['op']): r for r in profile.records()}
+        self.assertEqual(by_wire['alu_mul', '*']['description'], '* 8x8 -> 16')
+        self.assertEqual(by_wire['r', '^']['description'], '^ 8x8 -> 8')
+        times = [r['time'] for r in profile.records()]
+        self.assertEqual(times, sorted(times, reverse=True))
+
+        profile.clear()
+        self.assertEqual(profile.counts, [0] * len(self.nets))
+        sim.step({'a': 1})
+        self.assertEqual(profile.counts, [1] * len(self.nets))
+
+    def test_report_and_dump(self):
+        sim = self.sim(profile=True)
+        sim.step_multiple({'a': range(20)})
+        output = six.StringIO()
+        sim.profile.print_report(file=output)
+        six.assertRegex(self, output.getvalue(), r'tmp\d+ = \* 8x8 -> 16 \(for alu_mul\)')
+        output = six.StringIO()
+        sim.profile.print_report(by='prefix', limit=1, file=output)
+        self.assertEqual(len(output.getvalue().splitlines()), 2)
+        output = six.StringIO()
+        sim.profile.dump(output)
+        dump = json.loads(output.getvalue())
+        self.assertEqual(set(dump), {'net', 'op', 'prefix', 'overhead'})
+        self.assertEqual(sum(r['count'] for r in dump['op']), 20 * len(self.nets))
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.profile.records(by='wire')
+
+
+class StepFastBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        b = pyrtl.Input(4, 'b')
+        r = pyrtl.Register(8, 'r')
+        r.next <<= r + a
+        o = pyrtl.Output(9, 'o')
+        o <<= r + b
+        self.inputs = {'a': [1, 7, 255, 0, 3], 'b': [15, 0, 2, 9, 1]}
+
+    def test_same_as_step(self):
+        sim = self.sim()
+        sim_fast = self.sim()
+        self.assertEqual(sim_fast.input_order, ('a', 'b'))
+        o = sim_fast.inspector('o')
+        r = sim_fast.inspector(pyrtl.working_block().get_wirevector_by_name('r'))
+        for a, b in zip(self.inputs['a'], self.inputs['b']):
+            sim.step({'a': a, 'b': b})
+            sim_fast.step_fast((a, b))
+            self.assertEqual(o(), sim.inspect('o'))
+            self.assertEqual(r(), sim.inspect('r'))
+        self.assertEqual(sim_fast.tracer.trace, sim.tracer.trace)
+
+    def test_validation(self):
+        sim = self.sim()
+        sim.step_fast([1, 2], validate=True)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.step_fast([1], validate=True)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.step_fast([1, 16], validate=True)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.step_fast([-1, 0], validate=True)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.inspector('nonexistent')
+
+
+class ToggleActivityBase(unittest.TestCase):
+    simulators = (pyrtl.FastSimulation,)  # toggles are counted by the generated code
+
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(4, 'a')
+        r = pyrtl.Register(4, 'r')
+        r.next <<= r + a
+        o = pyrtl.Output(4, 'o')
+        o <<= r ^ a
+
+    def test_counts_match_trace(self):
+        sim = self.sim(activity=True)
+        for value in [1, 2, 3, 0]:
+            sim.step({'a': value})
+        sim.step_multiple({'a': [5, 5, 9, 1]})
+        activity = sim.activity
+        self.assertEqual(activity.cycles, 8)
+        for name in ['a', 'r', 'o']:
+            trace = sim.tracer.trace[name]
+            toggles = [sum(1 for prev, cur in zip(trace, trace[1:]) if (prev ^ cur) >> b & 1)
+                       for b in range(4)]
+            high = [sum(v >> b & 1 for v in trace) for b in range(4)]
+            self.assertEqual(activity.bit_toggles(name), toggles)
+            self.assertEqual(activity.bit_time_high(name), high)
+        self.assertEqual(activity.toggle_rate('r'), activity.toggles('r') / 8.0)
+
+        activity.clear()
+        sim.step({'a': 0})
+        self.assertEqual(activity.cycles, 1)
+        self.assertEqual(activity.toggles('r'), 0)
+
+    def test_selected_wires(self):
+        sim = self.sim(activity=['r'])
+        sim.step_multiple({'a': [1, 1, 1]})
+        self.assertEqual([w.name for w in sim.activity.wires], ['r'])
+        self.assertEqual(sim.activity.bit_toggles('r'), [2, 1, 0, 0])
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.activity.toggles('a')
+        with self.assertRaises(pyrtl.PyrtlError):
+            self.sim(activity=[pyrtl.Const(1)])
+
+    def test_fork_counts_from_scratch(self):
+        sim = self.sim(activity=True)
+        sim.step_multiple({'a': [1, 2, 3]})
+        fork = sim.fork()
+        fork.step({'a': 1})
+        self.assertEqual(fork.activity.cycles, 1)
+        self.assertEqual(sim.activity.cycles, 3)
+
+    def test_saif(self):
+        sim = self.sim(activity=['r'])
+        sim.step_multiple({'a': [1, 1, 1]})
+        output = six.StringIO()
+        sim.activity.write_saif(output, period=5)
+        saif = output.getvalue()
+        self.assertIn('(DURATION 15)', saif)
+        self.assertIn('(r\\[0\\]\n      (T0 10) (T1 5) (TX 0)\n      (TC 2) (IG 0)', saif)
+        self.assertNotIn('r\\[4\\]', saif)
+
+
+class VcdWriterBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a = pyrtl.Input(8, 'a')
+        r = pyrtl.Register(8, 'r')
+        r.next <<= r + a
+        o = pyrtl.Output(8, 'o')
+        o <<= r
+        self.avals = [0, 1, 0, 0, 2, 0]
+
+    @staticmethod
+    def vcd_values(vcd):
+        """ The value of every wire at every timestamp of a VCD. """
+        values, current, time = {}, {}, None
+        for line in vcd.splitlines():
+            if line.startswith('#'):
+                if time is not None:
+                    values[time] = dict(current)
+                time = int(line[1:])
+            elif line.startswith('b'):
+                value, name = line.split()
+                current[name] = int(value[1:], 2)
+        return values
+
+    def test_changes_only(self):
+        output = six.StringIO()
+        with pyrtl.VcdWriter(output, include_clock=True) as vcd:
+            sim = self.sim(tracer=vcd)
+            sim.step_multiple({'a': self.avals})
+        self.assertEqual(output.getvalue(), (
+            '$timescale 1ns $end\n$scope module logic $end\n'
+            '$var wire 1 clk clk $end\n$var wire 8 a a $end\n'
+            '$var wire 8 o o $end\n$var wire 8 r r $end\n'
+            '$upscope $end\n$enddefinitions $end\n'
+            '$dumpvars\nb0 a\nb0 o\nb0 r\n$end\n#0\nb1 clk\n\n#5\nb0 clk\n\n'
+            '#10\nb1 a\nb1 clk\n\n#15\nb0 clk\n\n'
+            '#20\nb0 a\nb1 o\nb1 r\nb1 clk\n\n#25\nb0 clk\n\n'
+            '#30\nb1 clk\n\n#35\nb0 clk\n\n'
+            '#40\nb10 a\nb1 clk\n\n#45\nb0 clk\n\n'
+            '#50\nb0 a\nb11 o\nb11 r\nb1 clk\n\n#55\nb0 clk\n\n'
+            '#60\n'))
+
+    def test_same_values_as_print_vcd(self):
+        avals = [(n * 37) % 7 for n in range(3000)]  # more than one batch of cycles
+        tracer = pyrtl.SimulationTrace()
+        self.sim(tracer=tracer).step_multiple({'a': avals})
+        expected = six.StringIO()
+        tracer.print_vcd(expected)
+        for background in (False, True):
+            output = six.StringIO()
+            vcd = pyrtl.VcdWriter(output, background=background, buffer_size=100)
+            sim = self.sim(tracer=vcd)
+            for a in avals:
+                sim.step({'a': a})
+            self.assertEqual(vcd.trace['o'][-1], tracer.trace['o'][-1])
+            self.assertEqual(len(vcd), len(avals))
+            vcd.close()
+            self.assertEqual(self.vcd_values(output.getvalue()),
+                             self.vcd_values(expected.getvalue()))
+            self.assertLess(len(output.getvalue()), len(expected.getvalue()))
+
+    def test_values_are_not_kept(self):
+        vcd = pyrtl.VcdWriter(six.StringIO())
+        sim = self.sim(tracer=vcd)
+        sim.step({'a': 1})
+        sim.step({'a': 2})
+        self.assertEqual(vcd.trace['a'][1], 2)
+        with self.assertRaises(pyrtl.PyrtlError):
+            vcd.print_trace(six.StringIO())
+        with self.assertRaises(pyrtl.PyrtlError):
+            vcd.trace['a'][0]
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.fork()
+
+    def test_reset_starts_over(self):
+        for background in (False, True):
+            expected = six.StringIO()
+            with pyrtl.VcdWriter(expected, background=background) as vcd:
+                self.sim(tracer=vcd).step_multiple({'a': self.avals[::-1]})
+            output = six.StringIO()
+            output.write('not part of the VCD\n')
+            with pyrtl.VcdWriter(output, background=background) as vcd:
+                sim = self.sim(tracer=vcd)
+                sim.step_multiple({'a': self.avals})
+                sim.reset()
+                sim.step_multiple({'a': self.avals[::-1]})
+            self.assertEqual(output.getvalue(),
+                             'not part of the VCD\n' + expected.getvalue())
+
+    def test_reset_needs_seekable_file(self):
+        class Unseekable(object):
+            def write(self, text):
+                pass
+
+            def flush(self):
+                pass
+        sim = self.sim(tracer=pyrtl.VcdWriter(Unseekable()))
+        sim.step({'a': 1})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.reset()
+
+
+class SnapshotBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.a = pyrtl.Input(8, 'a')
+        self.r = pyrtl.Register(8, 'r')
+        self.wide = pyrtl.Register(70, 'wide')
+        self.mem = pyrtl.MemBlock(8, 4, 'mem', asynchronous=True)
+        self.r.next <<= self.r + self.a
+        self.wide.next <<= pyrtl.concat(self.wide[:62], self.r)
+        self.mem[self.a[:4]] <<= self.r
+        self.o = pyrtl.Output(8, 'o')
+        self.o <<= self.mem[self.r[:4]] ^ self.r
+
+    def run_steps(self, sim, avals):
+        for a in avals:
+            sim.step({'a': a})
+        return [sim.inspect('o')]
+
+    def test_snapshot_restore(self):
+        sim = self.sim()
+        self.run_steps(sim, [3, 5, 7, 11])
+        snap = sim.snapshot()
+        self.assertEqual(set(snap), {'registers', 'memories'})
+        self.assertEqual(snap['registers']['r'], 26)
+        mem = sim.inspect_mem(self.mem)
+        for addr in range(16):
+            self.assertEqual(snap['memories']['mem'].get(addr, 0), mem.get(addr, 0))
+        first = self.run_steps(sim, [1, 2, 3, 4, 5])
+        sim.restore(snap)
+        self.assertEqual(sim.snapshot(), snap)
+        self.assertEqual(self.run_steps(sim, [1, 2, 3, 4, 5]), first)
+
+    def test_snapshot_is_picklable(self):
+        import pickle
+        sim = self.sim()
+        self.run_steps(sim, [3, 5, 7])
+        snap = sim.snapshot()
+        self.assertEqual(pickle.loads(pickle.dumps(snap)), snap)
+
+    def test_fork_is_independent(self):
+        sim = self.sim()
+        self.run_steps(sim, [3, 5, 7, 11])
+        fork = sim.fork()
+        expected = self.run_steps(sim, [9, 9, 1])
+        self.assertEqual(self.run_steps(fork, [9, 9, 1]), expected)
+        self.run_steps(fork, [100, 100])
+        self.assertNotEqual(fork.snapshot(), sim.snapshot())
+        self.assertEqual(fork.tracer.trace['o'][:3], sim.tracer.trace['o'][4:7])
+
+    def test_restore_missing_state_to_defaults(self):
+        sim = self.sim(default_value=0)
+        self.run_steps(sim, [3, 5, 7])
+        sim.restore({'registers': {'r': 9}})
+        self.assertEqual(sim.snapshot(), {'registers': {'r': 9, 'wide': 0},
+                                          'memories': {'mem': {}}})
+
+    def test_reset(self):
+        tracer = pyrtl.SimulationTrace()
+        sim = self.sim(tracer=tracer, register_value_map={self.r: 5},
+                       memory_value_map={self.mem: {5: 1, 6: 2}})
+        expected = self.run_steps(sim, [1, 6, 9, 2])
+        expected_trace = {name: list(vals) for name, vals in tracer.trace.items()}
+        sim.reset(register_value_map={self.r: 5}, memory_value_map={self.mem: {5: 1, 6: 2}})
+        self.assertIs(sim.tracer, tracer)
+        self.assertEqual(len(tracer), 0)
+        self.assertEqual(self.run_steps(sim, [1, 6, 9, 2]), expected)
+        self.assertEqual(dict(tracer.trace), expected_trace)
+        sim.reset()
+        self.assertEqual(sim.snapshot(), {'registers': {'r': 0, 'wide': 0},
+                                          'memories': {'mem': {}}})
+
+    def test_reset_with_construction_map(self):
+        init = {self.mem: {0: 7}}
+        sim = self.sim(memory_value_map=init)
+        self.assertEqual(self.run_steps(sim, [1]), [7])
+        sim.reset(memory_value_map=init)
+        self.assertEqual(self.run_steps(sim, [1]), [7])
+        self.assertEqual(init, {self.mem: {0: 7}})
+
+    def test_restore_errors(self):
+        sim = self.sim()
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.restore({'registers': {'nope': 1}})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.restore({'registers': {'r': 256}})
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.restore({'memories': {'mem': {16: 1}}})
+
+
+class NetFunctionsBase(unittest.TestCase):
+    simulators = (pyrtl.Simulation,)  # the only one made of precompiled net functions
+
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def test_value_map_and_single_net_execution(self):
+        a = pyrtl.Input(4, 'a')
+        o = pyrtl.Output(4, 'o')
+        o <<= ~a
+        sim = self.sim()
+        sim.step({a: 5})
+        self.assertEqual(sim.value[o], 10)
+        self.assertEqual(sim.inspect('o'), 10)
+        self.assertEqual(dict(sim.value)[a], 5)
+
+        # the value store can be poked and single nets re-evaluated by hand
+        sim.value[a] = 3
+        for net, dest, func in sim.net_functions:
+            sim._execute(net)
+        self.assertEqual(sim.value[o], 12)
+        self.assertEqual(len(sim.net_functions), len(pyrtl.working_block().logic))
+
+    def test_subclass_ops_and_sanitize_are_used(self):
+        a, b = pyrtl.Input(4, 'a'), pyrtl.Input(4, 'b')
+        total, conj = pyrtl.Output(4, 'total'), pyrtl.Output(4, 'conj')
+        total <<= (a + b)[:4]
+        conj <<= a & b
+        sanitized = []
+
+        class SaturatingSim(self.sim):
+            simple_func = dict(self.sim.simple_func)
+            simple_func['+'] = lambda l, r: min(l + r, 15)
+
+            @staticmethod
+            def _sanitize(val, wirevector):
+                sanitized.append(wirevector.name)
+                return val & wirevector.bitmask
+
+        sim = SaturatingSim()
+        sim.step({a: 9, b: 12})
+        self.assertEqual(sim.inspect('total'), 15)
+        self.assertEqual(sim.inspect('conj'), 8)
+        self.assertIn('conj', sanitized)
+
+
+class LaneParallelBase(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        a, b = pyrtl.Input(4, 'a'), pyrtl.Input(4, 'b')
+        total = pyrtl.Output(5, 'total')
+        acc = pyrtl.Register(4, 'acc')
+        out = pyrtl.Output(4, 'out')
+        total <<= a + b
+        acc.next <<= pyrtl.mux(a[0], acc ^ b, acc + 1)
+        out <<= acc
+        self.inputs = [
+            {'a': [1, 2, 3], 'b': [4, 5, 6]},
+            {'a': [15, 0, 7], 'b': 9},
+            {'a': [8, 9, 1], 'b': [0, 15, 3]},
+            {'a': [3, 3, 3], 'b': [1, 2, 3]},
+        ]
+
+    def test_lanes_match_separate_simulations(self):
+        pyrtl.synthesize()
+        lane_sim = pyrtl.LaneParallelSimulation(lanes=3, register_value_map={
+            pyrtl.working_block().wirevector_by_name['acc_synth_0']: [0, 1, 0]})
+        for step_inputs in self.inputs:
+            lane_sim.step(step_inputs)
+
+        for lane in range(3):
+            sim_trace = pyrtl.SimulationTrace()
+            sim = self.sim(tracer=sim_trace, register_value_map={
+                pyrtl.working_block().wirevector_by_name['acc_synth_0']: [0, 1, 0][lane]})
+            for step_inputs in self.inputs:
+                sim.step({w: v if isinstance(v, int) else v[lane]
+                          for w, v in step_inputs.items()})
+            for name in ('a', 'b', 'total', 'out'):
+                self.assertEqual(lane_sim.tracers[lane].trace[name], sim_trace.trace[name])
+            self.assertEqual(lane_sim.inspect('total')[lane], sim.inspect('total'))
+
+    def test_unsynthesized_arithmetic_is_rejected(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.LaneParallelSimulation(lanes=3)
+
+    def test_wrong_number_of_lane_values(self):
+        pyrtl.synthesize()
+        lane_sim = pyrtl.LaneParallelSimulation(lanes=3)
+        with self.assertRaises(pyrtl.PyrtlError):
+            lane_sim.step({'a': [1, 2], 'b': 0})
+
+    def test_missing_input(self):
+        pyrtl.synthesize()
+        lane_sim = pyrtl.LaneParallelSimulation(lanes=3)
+        with self.assertRaises(pyrtl.PyrtlError):
+            lane_sim.step({'a': [1, 2, 3]})
+
+    def test_failed_assertion_reports_cycle(self):
+        class LaneException(Exception):
+            pass
+        pyrtl.reset_working_block()
+        a, b = pyrtl.Input(2, 'a'), pyrtl.Input(2, 'b')
+        pyrtl.rtl_assert(~(a[0] & b[0]), LaneException('a and b both odd'))
+        lane_sim = pyrtl.LaneParallelSimulation(lanes=2)
+        lane_sim.step({'a': [1, 2], 'b': [2, 1]})
+        with self.assertRaises(LaneException) as error:
+            lane_sim.step({'a': [0, 3], 'b': [3, 3]})
+        self.assertEqual(error.exception.cycle, 1)
+
+    def test_reset(self):
+        pyrtl.synthesize()
+        acc = pyrtl.working_block().wirevector_by_name['acc_synth_0']
+        lane_sim = pyrtl.LaneParallelSimulation(lanes=3, register_value_map={acc: [0, 1, 0]})
+        for step_inputs in self.inputs:
+            lane_sim.step(step_inputs)
+        first = [list(tracer.trace['out']) for tracer in lane_sim.tracers]
+        lane_sim.reset(register_value_map={acc: [0, 1, 0]})
+        self.assertEqual(lane_sim.snapshot()['registers']['acc_synth_0'], [0, 1, 0])
+        for step_inputs in self.inputs:
+            lane_sim.step(step_inputs)
+        self.assertEqual([tracer.trace['out'] for tracer in lane_sim.tracers], first)
+
+
+class EventDrivenBase(unittest.TestCase):
+    simulators = (pyrtl.Simulation,)  # the only one with event driven evaluation
+
+    def setUp(self):
+        pyrtl.reset_working_block()
+
+    def check_same_as_full_evaluation(self, inputs, nsteps, kwargs=dict):
+        full_trace = pyrtl.SimulationTrace()
+        event_trace = pyrtl.SimulationTrace()
+        full = self.sim(tracer=full_trace, **kwargs())
+        event = self.sim(tracer=event_trace, event_driven=True, **kwargs())
+        for i in range(nsteps):
+            step_inputs = {w: v[i] for w, v in inputs.items()}
+            full.step(step_inputs)
+            event.step(step_inputs)
+        self.assertEqual(dict(full_trace.trace), dict(event_trace.trace))
+        return event
+
+    def test_idle_datapath_is_skipped(self):
+        a, b = pyrtl.Input(16, 'a'), pyrtl.Input(16, 'b')
+        prod = pyrtl.Output(32, 'prod')
+        count = pyrtl.Output(3, 'count')
+        r = pyrtl.Register(3, 'r')
+        r.next <<= r + 1
+        count <<= r
+        prod <<= (a * b) + (a ^ b)
+        inputs = {'a': [3] * 10, 'b': [5] * 5 + [7] * 5}
+        sim = self.check_same_as_full_evaluation(inputs, 10)
+        self.assertGreater(sim.skipped_nets, 0)
+
+    def test_memory_write_wakes_readers(self):
+        raddr, waddr = pyrtl.Input(3, 'raddr'), pyrtl.Input(3, 'waddr')
+        wdata, we = pyrtl.Input(8, 'wdata'), pyrtl.Input(1, 'we')
+        rdata = pyrtl.Output(8, 'rdata')
+        mem = pyrtl.MemBlock(8, 3, 'mem')
+        mem[waddr] <<= pyrtl.MemBlock.EnabledWrite(wdata, we)
+        rdata <<= mem[raddr]
+        inputs = {'raddr': [2, 2, 2, 2, 1, 1],
+                  'waddr': [2, 2, 2, 1, 1, 1],
+                  'wdata': [9, 9, 4, 7, 7, 7],
+                  'we': [1, 0, 1, 1, 0, 0]}
+        self.check_same_as_full_evaluation(
+            inputs, 6, lambda: {'memory_value_map': {mem: {1: 3}}})
+
+    def test_register_chain(self):
+        i = pyrtl.Input(4, 'i')
+        r1, r2 = pyrtl.Register(4, 'r1'), pyrtl.Register(4, 'r2')
+        o = pyrtl.Output(5, 'o')
+        r1.next <<= i
+        r2.next <<= r1
+        o <<= r1 + r2
+        inputs = {'i': [1, 1, 1, 2, 2, 0, 0, 0]}
+        self.check_same_as_full_evaluation(inputs, 8)
+
+
 def make_unittests():
     """
-    Generates separate unittests for each of the simulators
+    Generates separate unittests for each of the simulators (or for those
+    listed in the simulators attribute of the base class)
     """
     g = globals()
     unittests = {}
@@ -1242,7 +2043,7 @@ def make_unittests():
             # made the unittest as such
             raise Exception("You should be making unittests that are compatible with"
                             "both Fastsim and Simulation")
-        for sim in sims:
+        for sim in getattr(v, 'simulators', sims):
             unit_name = "Test" + name + sim.__name__
             unittests[unit_name] = type(unit_name, (v,), {'sim': sim})
     g.update(unittests)
@@ -0,0 +1,138 @@
+import unittest
+import random
+import io
+import shutil
+import tempfile
+
+import pyrtl
+
+# see test_compilesim.py for why this is how gcc is checked for
+import subprocess
+try:
+    version = subprocess.check_output(['gcc', '--version'])
+except OSError:
+    raise unittest.SkipTest('TieredSimulation testing requires gcc')
+
+
+class TestTieredSimulation(unittest.TestCase):
+    def setUp(self):
+        pyrtl.reset_working_block()
+        self.cache_dir = tempfile.mkdtemp()
+        a = pyrtl.Input(8, 'a')
+        acc = pyrtl.Register(16, 'acc')
+        mem = pyrtl.MemBlock(16, 4, 'mem', max_write_ports=1)
+        count = pyrtl.Register(4, 'count')
+        count.next <<= count + 1
+        acc.next <<= (acc + a + mem[count])[:16]
+        mem[count] <<= (acc + a)[:16]
+        out = pyrtl.Output(16, 'out')
+        out <<= acc ^ a
+        self.mem = mem
+        self.inputs = {'a': [random.randrange(256) for _ in range(300)]}
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def reference(self):
+        tracer = pyrtl.SimulationTrace()
+        sim = pyrtl.FastSimulation(tracer=tracer)
+        sim.step_multiple(self.inputs)
+        return tracer, sim
+
+    def test_switch_part_way(self):
+        ref_tracer, ref_sim = self.reference()
+        sim = pyrtl.TieredSimulation(cache_dir=self.cache_dir)
+        self.assertEqual(sim.tier, 'fast')
+        for i in range(100):
+            sim.step({'a': self.inputs['a'][i]})
+        self.assertTrue(sim.wait_for_compiled())
+        self.assertEqual(sim.tier, 'compiled')
+        self.assertEqual(sim.inspect('out'), ref_tracer.trace['out'][99])
+        sim.step_multiple({'a': self.inputs['a'][100:]})
+        self.assertEqual(sim.tracer.trace, ref_tracer.trace)
+        self.assertEqual(sim.inspect_mem(self.mem), ref_sim.inspect_mem(self.mem))
+
+    def test_switch_inside_step_multiple(self):
+        ref_tracer, ref_sim = self.reference()
+        sim = pyrtl.TieredSimulation(cache_dir=self.cache_dir)
+        sim._chunk = 7
+        sim._thread.join()  # the switch happens at the first chunk boundary
+        sim.step_multiple(self.inputs, {'out': ref_tracer.trace['out']})
+        self.assertEqual(sim.tier, 'compiled')
+        self.assertEqual(sim.tracer.trace, ref_tracer.trace)
+        self.assertEqual(sim.snapshot(), ref_sim.snapshot())
+
+    def test_failures_reported_across_chunks(self):
+        ref_tracer, _ = self.reference()
+        expected = list(ref_tracer.trace['out'])
+        expected[3] ^= 1
+        expected[250] ^= 1
+        sim = pyrtl.TieredSimulation(cache_dir=self.cache_dir)
+        sim._chunk = 100
+        output = io.StringIO()
+        sim.step_multiple(self.inputs, {'out': expected}, file=output)
+        steps = [int(line.split()[0]) for line in output.getvalue().splitlines()[2:]]
+        self.assertEqual(steps, [3, 250])
+
+    def test_compile_error_stays_fast(self):
+        ref_tracer, _ = self.reference()
+
+        def fail_to_compile(compiled_sim):
+            raise pyrtl.PyrtlError('gcc failed')
+
+        create_dll = pyrtl.CompiledSimulation._create_dll
+        pyrtl.CompiledSimulation._create_dll = fail_to_compile
+        try:
+            sim = pyrtl.TieredSimulation(cache_dir=self.cache_dir)
+            self.assertFalse(sim.wait_for_compiled())
+        finally:
+            pyrtl.CompiledSimulation._create_dll = create_dll
+        self.assertIsInstance(sim.compile_error, pyrtl.PyrtlError)
+        sim.step_multiple(self.inputs)
+        self.assertEqual(sim.tier, 'fast')
+        self.assertEqual(sim.tracer.trace, ref_tracer.trace)
+
+    def test_missing_input(self):
+        sim = pyrtl.TieredSimulation(cache_dir=self.cache_dir)
+        with self.assertRaises(pyrtl.PyrtlError):
+            sim.step_multiple(nsteps=5)
+
+    def test_inspect_same_wires_in_both_tiers(self):
+        sim = pyrtl.TieredSimulation(cache_dir=self.cache_dir)
+        hidden = [w for w in pyrtl.working_block().wirevector_set
+                  if w.name not in list(sim.tracer.trace)][0]
+        sim.step({'a': 1})
+        for wait in (False, True):
+            if wait:
+                self.assertTrue(sim.wait_for_compiled())
+            self.assertEqual(sim.inspect('out'), 1)
+            with self.assertRaises(pyrtl.PyrtlError):
+                sim.inspect(hidden)
+
+        untraced = pyrtl.TieredSimulation(tracer=None, cache_dir=self.cache_dir)
+        untraced.step({'a': 1})
+        self.assertEqual(untraced.inspect('out'), 1)
+        with self.assertRaises(pyrtl.PyrtlError):
+            untraced.inspect('a')
+
+    def test_stop_after_first_error_same_in_both_tiers(self):
+        for tier in ('fast', 'compiled'):
+            sim = pyrtl.TieredSimulation(tracer=None, cache_dir=self.cache_dir)
+            if tier == 'fast':
+                sim._switch_if_ready = lambda: None  # never switches
+            else:
+                self.assertTrue(sim.wait_for_compiled())
+            output = io.StringIO()
+            sim.step_multiple({'a': [1, 2, 3]}, {'a': [1, 2, 4], 'out': [1, 3, 5]},
+                              file=output, stop_after_first_error=True)
+            self.assertEqual(sim.tier, tier)
+            lines = output.getvalue().splitlines()[2:]
+            self.assertEqual([line.split()[:2] for line in lines], [['2', 'a'], ['2', 'out']])
+
+    def test_ring_not_supported(self):
+        with self.assertRaises(pyrtl.PyrtlError):
+            pyrtl.TieredSimulation(trace_ring_size=10)
+
+
+if __name__ == "__main__":
+    unittest.main()